@@ -0,0 +1,162 @@
+# Batched, seeded elastic and affine augmentation of image batches (a batch-level stage of the data loaders)
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+
+"""Adds the --augment* command-line arguments to an existing parser."""
+def add_augment_args(parser):
+    parser.add_argument('--augment', action='store_true', default=False, help='Apply random elastic/affine warps to every training batch.')
+    parser.add_argument('--elastic_alpha', type=float, default=0.0, help='Scale (pixels) of the elastic displacement field (0 disables it).')
+    parser.add_argument('--elastic_sigma', type=float, default=8.0, help='Smoothness (Gaussian sigma, pixels) of the elastic displacement field.')
+    parser.add_argument('--shear', type=float, default=0.2, help='Maximum shear factor (x is shifted by shear * y).')
+    parser.add_argument('--rotation', type=float, default=0.0, help='Maximum rotation (degrees).')
+    parser.add_argument('--scale', type=float, default=0.0, help='Maximum relative zoom in or out.')
+    parser.add_argument('--augment_seed', type=int, default=0)
+    return parser
+
+
+"""Warps whole N x C x H x W batches with one random transform per sample: an affine map (shear, rotation, zoom)
+   composed with an elastic displacement field as in KSimage.elastic_transform (uniform noise in [-1, 1] smoothed
+   by a Gaussian of std sigma and scaled by alpha pixels).
+   - the identity sampling grid is cached per (H, W, device) and the affine maps are applied to it as one batched
+     matrix product; the Gaussian kernels are cached per sigma and applied as two separable convolutions to the
+     noise of the whole batch,
+   - all channels (and all tensors passed to the same call, e.g. an image and its mask) are resampled with one
+     grid_sample per kind, on the device of the batch: floating point tensors bilinearly, integer tensors (masks,
+     labels) with nearest-neighbour sampling so that their values are kept,
+   - random draws come from a private generator, so a given seed gives the same warps on every run; its state is
+     saved with the resume state (see state_dict and preemption.training_state).
+   Usage:
+        augmenter = Augmenter(elastic_alpha=34, elastic_sigma=4, shear=0.2, seed=14)
+        images = augmenter(images)
+"""
+class Augmenter():
+    def __init__(self, elastic_alpha=0.0, elastic_sigma=8.0, shear=0.2, rotation=0.0, scale=0.0, padding_mode='reflection', seed=0):
+        self.elastic_alpha = elastic_alpha
+        self.elastic_sigma = elastic_sigma
+        self.shear = shear
+        self.rotation = math.radians(rotation)
+        self.scale = scale
+        self.padding_mode = padding_mode
+        self.generator = torch.Generator().manual_seed(seed)
+
+        self.grids = {}
+        self.kernels = {}
+
+    #H x W x 3 homogeneous identity grid in grid_sample coordinates (align_corners=False)
+    def _identity_grid(self, H, W, device):
+        key = (H, W, str(device))
+        if key not in self.grids:
+            ys = (torch.arange(H, dtype=torch.float32, device=device) * 2 + 1) / H - 1
+            xs = (torch.arange(W, dtype=torch.float32, device=device) * 2 + 1) / W - 1
+            y, x = torch.meshgrid(ys, xs, indexing='ij')
+            self.grids[key] = torch.stack([x, y, torch.ones_like(x)], dim=-1)
+        return self.grids[key]
+
+    #1D Gaussian kernel of std sigma truncated at 4 sigma (as scipy.ndimage.gaussian_filter)
+    def _kernel(self, sigma, device):
+        key = (sigma, str(device))
+        if key not in self.kernels:
+            radius = int(4 * sigma + 0.5)
+            x = torch.arange(-radius, radius + 1, dtype=torch.float32, device=device)
+            kernel = torch.exp(-0.5 * (x / sigma)**2)
+            self.kernels[key] = kernel / kernel.sum()
+        return self.kernels[key]
+
+    """N x 2 x 3 random affine maps (in normalized coordinates, around the image centre)."""
+    def affine(self, n):
+        def uniform(limit):
+            return (torch.rand(n, generator=self.generator) * 2 - 1) * limit
+
+        shear, angle, zoom = uniform(self.shear), uniform(self.rotation), 1 + uniform(self.scale)
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        #rotation x shear (x' = x + shear * y) x zoom, applied to output coordinates to find input coordinates
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = cos / zoom
+        theta[:, 0, 1] = (cos * shear - sin) / zoom
+        theta[:, 1, 0] = sin / zoom
+        theta[:, 1, 1] = (sin * shear + cos) / zoom
+        return theta
+
+    """N x H x W x 2 elastic displacement fields in pixels (x, y), generated for the whole batch at once."""
+    def displacement(self, n, H, W, device):
+        noise = torch.rand(n * 2, 1, H, W, generator=self.generator).to(device) * 2 - 1
+        kernel = self._kernel(self.elastic_sigma, device)
+        radius = (len(kernel) - 1) // 2
+        noise = F.conv2d(noise, kernel.view(1, 1, -1, 1), padding=(radius, 0))
+        noise = F.conv2d(noise, kernel.view(1, 1, 1, -1), padding=(0, radius))
+        return (noise * self.elastic_alpha).view(n, 2, H, W).permute(0, 2, 3, 1)
+
+    """N x H x W x 2 sampling grids for grid_sample."""
+    def grid(self, n, H, W, device):
+        grid = torch.matmul(self._identity_grid(H, W, device), self.affine(n).to(device).transpose(1, 2)[:, None])
+        if self.elastic_alpha:
+            pixels = self.displacement(n, H, W, device)
+            grid = grid + pixels * torch.tensor([2.0 / W, 2.0 / H], device=device)
+        return grid
+
+    """Warps one or more N x C x H x W batches of the same N, H and W with the same random transforms."""
+    def __call__(self, *batches):
+        first = batches[0]
+        n, _, H, W = first.shape
+        grid = self.grid(n, H, W, first.device)
+
+        outputs = [None] * len(batches)
+        for mode, floating in (('bilinear', True), ('nearest', False)):
+            group = [i for i, batch in enumerate(batches) if batch.is_floating_point() == floating]
+            if not group:
+                continue
+
+            stacked = torch.cat([batches[i].float() for i in group], dim=1)
+            warped = F.grid_sample(stacked, grid, mode=mode, padding_mode=self.padding_mode, align_corners=False)
+            for i, w in zip(group, torch.split(warped, [batches[i].size(1) for i in group], dim=1)):
+                outputs[i] = w.to(batches[i].dtype)
+
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def state_dict(self):
+        return {'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state):
+        self.generator.set_state(state['generator'])
+
+
+"""DataLoader wrapper that warps the images of every batch with an Augmenter (on device, e.g. the GPU the
+   trainer uses) as they are drawn. The sampler and dataset of the wrapped loader stay reachable, so
+   checkpointing the sampler position (see preemption.py) works as before."""
+class AugmentedLoader():
+    def __init__(self, loader, augmenter, device='cpu'):
+        self.loader = loader
+        self.augmenter = augmenter
+        self.device = torch.device(device)
+        self.sampler = loader.sampler
+        self.dataset = loader.dataset
+        self.batch_size = loader.batch_size
+
+    def __iter__(self):
+        return _AugmentedIterator(iter(self.loader), self.augmenter, self.device)
+
+    def __len__(self):
+        return len(self.loader)
+
+
+#Iterator of an AugmentedLoader (supports len() and next() like the DataLoader iterators the training loops use)
+class _AugmentedIterator():
+    def __init__(self, iterator, augmenter, device):
+        self.iterator = iterator
+        self.augmenter = augmenter
+        self.device = device
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        images, labels = next(self.iterator)
+        return self.augmenter(images.to(self.device, non_blocking=True)), labels
+
+    def __len__(self):
+        return len(self.iterator)
@@ -0,0 +1,75 @@
+# Training-step time of a generator pair run sequentially vs fused (models.DualGenerator)
+
+import time
+import argparse
+
+import torch
+
+from models import CycleGenerator, DualGenerator
+
+
+"""Median time (ms) of function() over repeats runs (after one warm-up run)."""
+def time_ms(function, repeats, device):
+    function()
+    times = []
+    for _ in range(repeats):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        function()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.time() - start)
+    return 1000 * sorted(times)[len(times) // 2]
+
+
+"""Prints the forward + backward time of both directions on one batch each, sequential and fused, and the part
+   of the fused time spent stacking the weights of the two networks (the copy DualGenerator makes per call)."""
+def benchmark(conv_dim, n_res_blocks, image_size, batch_size, repeats, device):
+    G_XtoY = CycleGenerator(conv_dim=conv_dim, n_res_blocks=n_res_blocks).to(device)
+    G_YtoX = CycleGenerator(conv_dim=conv_dim, n_res_blocks=n_res_blocks).to(device)
+    images_X = torch.rand(batch_size, 3, image_size, image_size, device=device) * 2 - 1
+    images_Y = torch.rand(batch_size, 3, image_size, image_size, device=device) * 2 - 1
+
+    rows = []
+    for fused in (False, True):
+        G_pair = DualGenerator(G_XtoY, G_YtoX, fused=fused)
+
+        def step():
+            fake_Y, fake_X = G_pair(images_X, images_Y)
+            (fake_Y.mean() + fake_X.mean()).backward()
+
+        rows.append(('fused' if G_pair.fused(images_X, images_Y) else 'sequential', time_ms(step, repeats, device)))
+
+    params_a, params_b = dict(G_XtoY.named_parameters()), dict(G_YtoX.named_parameters())
+
+    def stack():
+        stacked = [torch.stack([params_a[name], params_b[name]]) for name in params_a]
+        sum(s.sum() for s in stacked).backward()
+
+    rows.append(('weight stacking', time_ms(stack, repeats, device)))
+
+    print('{} x 3 x {} x {} per direction, conv_dim {}, {} res blocks, {}'.format(batch_size, image_size, image_size, conv_dim, n_res_blocks, device))
+    for name, ms in rows:
+        print('{:<16} {:10.1f} ms'.format(name, ms))
+    return rows
+
+
+"""Creates the command-line parser for the benchmark."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--g_conv_dim', type=int, default=64)
+    parser.add_argument('--g_res_blocks', type=int, default=9)
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=4, help='Training batch size (cycle_gan.py default: 4).')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+    benchmark(opts.g_conv_dim, opts.g_res_blocks, opts.image_size, opts.batch_size, opts.repeats, torch.device(opts.device))
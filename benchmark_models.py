@@ -0,0 +1,125 @@
+# Cost table (FLOPs, parameters, CPU latency, peak memory) of generator and discriminator configurations
+
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import torch.nn as nn
+
+from models import CycleGenerator, PatchGANDiscriminator
+
+
+"""Builds a model from a configuration string: 'G:<conv_dim>:<n_res_blocks>:<n_downsampling>' for a CycleGenerator
+   or 'D:<conv_dim>:<n_layers>' for a PatchGANDiscriminator."""
+def build_model(config):
+    kind, values = config.split(':', 1)
+    values = [int(v) for v in values.split(':')]
+    if kind == 'G':
+        return CycleGenerator(conv_dim=values[0], n_res_blocks=values[1], n_downsampling=values[2])
+    if kind == 'D':
+        return PatchGANDiscriminator(conv_dim=values[0], n_layers=values[1])
+    raise ValueError('Unknown model configuration {}'.format(config))
+
+
+"""Multiply-accumulate count of the convolutions and transposed convolutions of one forward pass
+   (FLOPs are reported as 2 x MACs; normalization and activations are not counted)."""
+def count_macs(model, x):
+    macs = []
+
+    def hook(module, inputs, output):
+        if isinstance(module, nn.Conv2d):
+            kernel_ops = module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+            macs.append(output.numel() * kernel_ops)
+        else:
+            kernel_ops = module.out_channels // module.groups * module.kernel_size[0] * module.kernel_size[1]
+            macs.append(inputs[0].numel() * kernel_ops)
+
+    hooks = [m.register_forward_hook(hook) for m in model.modules() if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d))]
+    with torch.no_grad():
+        model(x)
+    for h in hooks:
+        h.remove()
+    return sum(macs)
+
+
+"""Mean CPU latency (s) of a forward pass under inference mode, after warm-up."""
+def latency(model, x, repeats):
+    with torch.inference_mode():
+        model(x)
+        start = time.time()
+        for _ in range(repeats):
+            model(x)
+    return (time.time() - start) / repeats
+
+
+#Resident set size and its peak (bytes) from /proc/self/status
+def _rss():
+    values = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                name, kb = line.split()[:2]
+                values[name[:-1]] = int(kb) * 1024
+    return values['VmRSS'], values['VmHWM']
+
+
+#Runs in a fresh process: growth of the peak resident set size (bytes) during one forward pass
+def _peak_memory(config, size, batch_size, threads):
+    torch.set_num_threads(threads)
+    model = build_model(config).eval()
+    x = torch.rand(batch_size, 3, size, size)
+
+    #reset the peak to the current RSS so that it only reflects the forward pass
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    before, _ = _rss()
+    with torch.inference_mode():
+        model(x)
+    return _rss()[1] - before
+
+
+"""Prints one row per configuration. Peak memory is measured in a separate process per configuration
+   (the increase of the peak RSS during a forward pass, i.e. activations and workspace; Linux only)."""
+def benchmark(configs, size, batch_size, repeats, threads):
+    torch.set_num_threads(threads)
+    context = multiprocessing.get_context('spawn')
+
+    print('{:>16} {:>10} {:>10} {:>12} {:>12}'.format('config', 'GFLOPs', 'params (M)', 'latency (ms)', 'peak (MB)'))
+    rows = []
+    for config in configs:
+        model = build_model(config).eval()
+        x = torch.rand(batch_size, 3, size, size)
+
+        flops = 2 * count_macs(model, x)
+        params = sum(p.numel() for p in model.parameters())
+        seconds = latency(model, x, repeats)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            peak = pool.submit(_peak_memory, config, size, batch_size, threads).result()
+
+        rows.append({'config': config, 'flops': flops, 'params': params, 'latency': seconds, 'peak_memory': peak})
+        print('{:>16} {:10.2f} {:10.2f} {:12.1f} {:12.1f}'.format(config, flops / 1e9, params / 1e6, 1000 * seconds, peak / 2**20))
+
+    return rows
+
+
+"""Creates the command-line parser for the model benchmark."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--configs', type=str, nargs='+',
+                        default=['G:64:9:2', 'G:64:6:2', 'G:32:9:2', 'G:32:6:2', 'G:16:6:2', 'G:32:6:3', 'D:64:3', 'D:32:3', 'D:64:2'],
+                        help='G:<conv_dim>:<n_res_blocks>:<n_downsampling> (G:64:9:2 is the original generator) or D:<conv_dim>:<n_layers> (D:64:3 is the original discriminator).')
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help='Number of CPU threads used by torch.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+    benchmark(opts.configs, opts.image_size, opts.batch_size, opts.repeats, opts.threads)
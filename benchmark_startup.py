@@ -0,0 +1,116 @@
+# Startup-time benchmark of the command-line entry points (python -X importtime), with a regression budget
+
+import os
+import sys
+import argparse
+import subprocess
+import collections
+
+
+# Modules that the inference and preprocessing paths must not load at startup
+INFERENCE_FORBIDDEN = ['torchvision', 'matplotlib', 'cv2', 'skimage', 'sklearn', 'imageio', 'pandas', 'tensorflow']
+TRAINING_FORBIDDEN = ['matplotlib', 'cv2', 'skimage', 'sklearn', 'imageio', 'pandas', 'tensorflow']
+
+# Entry point: (module, directory it is imported from, import budget in ms, forbidden modules)
+ENTRY_POINTS = collections.OrderedDict([
+    ('cycle_gan', ('cycle_gan', '.', 4000, TRAINING_FORBIDDEN)),
+    ('cycle_gan_3d', ('cycle_gan_3d', '.', 4000, TRAINING_FORBIDDEN)),
+    ('xnet_2d', ('xnet_2d', '.', 4000, TRAINING_FORBIDDEN)),
+    ('distill', ('distill', '.', 4000, TRAINING_FORBIDDEN)),
+    ('test_cycle_gan', ('test_cycle_gan', '.', 3500, INFERENCE_FORBIDDEN)),
+    ('serve', ('serve', '.', 3500, INFERENCE_FORBIDDEN)),
+    ('volume_inference', ('volume_inference', '.', 3500, INFERENCE_FORBIDDEN + ['scipy.io'])),
+    ('quantize', ('quantize', '.', 3500, INFERENCE_FORBIDDEN)),
+    ('inference_graph', ('inference_graph', '.', 3500, INFERENCE_FORBIDDEN)),
+    ('video', ('video', '.', 3500, INFERENCE_FORBIDDEN)),
+    ('preview', ('preview', '.', 3500, INFERENCE_FORBIDDEN)),
+    ('sweep', ('sweep', '.', 3500, INFERENCE_FORBIDDEN)),
+    ('preprocess', ('preprocess', '.', 1000, ['torch', 'pandas', 'cv2', 'scipy.io', 'scipy.misc'])),
+    ('KSimage', ('KSimage', 'checker_files', 1500, ['torch', 'cv2', 'skimage', 'sklearn', 'matplotlib', 'tensorflow'])),
+])
+
+
+"""Parses the stderr of python -X importtime into (module, self us, cumulative us, depth) rows."""
+def parse_importtime(stderr):
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+"""Runs python -X importtime -c 'import <module>' in a fresh interpreter and returns its parsed rows."""
+def measure(module, directory):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.abspath(directory), os.environ.get('PYTHONPATH', '')]))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=os.path.abspath(directory), env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('import {} failed:\n{}'.format(module, result.stderr[-2000:]))
+    return parse_importtime(result.stderr)
+
+
+"""Total import time (ms): the sum of the cumulative times of the top-level imports."""
+def total_ms(rows):
+    return sum(cumulative for _, _, cumulative, depth in rows if depth == 0) / 1000.0
+
+
+"""(package, ms) of the top-level packages with the largest import time (self time of all their modules)."""
+def heaviest_packages(rows, top=5):
+    packages = collections.Counter()
+    for name, self_us, _, _ in rows:
+        packages[name.split('.')[0]] += self_us
+    return [(package, us / 1000.0) for package, us in packages.most_common(top)]
+
+
+"""Modules of the forbidden list (or their submodules) that were imported."""
+def forbidden_imports(rows, forbidden):
+    names = set(name for name, _, _, _ in rows)
+    return [f for f in forbidden if any(name == f or name.startswith(f + '.') for name in names)]
+
+
+"""Measures every entry point (the fastest of repeat runs) and prints its import time, heaviest packages and budget
+   violations. Returns the list of failures (empty when every entry point is within budget)."""
+def benchmark(entry_points, repeat=3, budget_scale=1.0, top=5):
+    failures = []
+    print('{:<18} {:>10} {:>10}  {}'.format('entry point', 'time (ms)', 'budget', 'heaviest packages (ms)'))
+    for entry in entry_points:
+        module, directory, budget, forbidden = ENTRY_POINTS[entry]
+        runs = [measure(module, directory) for _ in range(repeat)]
+        rows = min(runs, key=total_ms)
+        milliseconds, budget = total_ms(rows), budget * budget_scale
+
+        heavy = ', '.join('{} {:.0f}'.format(package, ms) for package, ms in heaviest_packages(rows, top))
+        print('{:<18} {:10.0f} {:10.0f}  {}'.format(entry, milliseconds, budget, heavy))
+
+        if milliseconds > budget:
+            failures.append('{}: {:.0f} ms over the {:.0f} ms budget'.format(entry, milliseconds, budget))
+        loaded = forbidden_imports(rows, forbidden)
+        if loaded:
+            failures.append('{}: imports {} at startup'.format(entry, ', '.join(loaded)))
+    return failures
+
+
+"""Creates the command-line parser for the startup benchmark."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--entry_points', type=str, nargs='+', default=list(ENTRY_POINTS), choices=list(ENTRY_POINTS))
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per entry point; the fastest one is reported.')
+    parser.add_argument('--budget_scale', type=float, default=1.0, help='Multiplies every budget (e.g. 2 on slow machines).')
+    parser.add_argument('--top', type=int, default=5, help='Number of heaviest packages shown per entry point.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+
+    failures = benchmark(opts.entry_points, opts.repeat, opts.budget_scale, opts.top)
+    for failure in failures:
+        print('FAIL ' + failure)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,110 @@
+# Microbenchmarks of the batch transforms of util.py against their former per-image implementations
+
+import time
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+import util
+
+
+#Former util.imgs_resize, with scipy.misc.imresize (removed from scipy) replaced by what it did:
+#byte-scale the image, then a PIL bilinear resize
+def _reference_resize(imgs, resize_scale):
+    outputs = torch.FloatTensor(imgs.size()[0], imgs.size()[1], resize_scale, resize_scale)
+    for i in range(imgs.size()[0]):
+        img = imgs[i].numpy().transpose(1, 2, 0)
+        img = ((img - img.min()) / max(img.max() - img.min(), 1e-8) * 255 + 0.5).astype(np.uint8)
+        img = np.asarray(Image.fromarray(img).resize((resize_scale, resize_scale), Image.BILINEAR))
+        outputs[i] = torch.FloatTensor((img.transpose(2, 0, 1).astype(np.float32) - 127.5) / 127.5)
+    return outputs
+
+
+#Former util.random_crop
+def _reference_crop(imgs, crop_size):
+    outputs = torch.FloatTensor(imgs.size()[0], imgs.size()[1], crop_size, crop_size)
+    for i in range(imgs.size()[0]):
+        rand1 = np.random.randint(0, imgs.size()[2] - crop_size)
+        rand2 = np.random.randint(0, imgs.size()[2] - crop_size)
+        outputs[i] = imgs[i][:, rand1: crop_size + rand1, rand2: crop_size + rand2]
+    return outputs
+
+
+#Former util.random_fliplr
+def _reference_fliplr(imgs):
+    outputs = torch.FloatTensor(imgs.size())
+    for i in range(imgs.size()[0]):
+        if torch.rand(1)[0] < 0.5:
+            img = torch.FloatTensor(
+                (np.fliplr(imgs[i].numpy().transpose(1, 2, 0)).transpose(2, 0, 1).reshape(-1, imgs.size()[1], imgs.size()[2], imgs.size()[3]) + 1) / 2)
+            outputs[i] = (img - 0.5) / 0.5
+        else:
+            outputs[i] = imgs[i]
+    return outputs
+
+
+"""Median time (ms) of function(*args) over repeat runs (after one warm-up run)."""
+def time_ms(function, args, repeat):
+    function(*args)
+    times = []
+    for _ in range(repeat):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.time()
+        function(*args)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.time() - start)
+    return 1000 * float(np.median(times))
+
+
+"""Prints the time of every transform (on device) and of its per-image predecessor (on the CPU, as it went through
+   numpy) on a batch in [-1, 1], with the largest difference of the outputs (resize) or a check that the outputs
+   are crops/flips of the batch."""
+def benchmark(batch_size, image_size, resize_scale, crop_size, repeat, device='cpu'):
+    imgs = torch.rand(batch_size, 3, image_size, image_size) * 2 - 1
+    imgs_device = imgs.to(device)
+    resized = util.imgs_resize(imgs_device, resize_scale)
+
+    flipped = util.random_fliplr(imgs_device).cpu()
+    flips_valid = all(torch.equal(f, i) or torch.equal(f, i.flip(2)) for f, i in zip(flipped, imgs))
+    np.random.seed(0)
+    cropped = util.random_crop(resized, crop_size).cpu()
+    np.random.seed(0)
+    offsets = zip(np.random.randint(0, resize_scale - crop_size + 1, size=batch_size), np.random.randint(0, resize_scale - crop_size + 1, size=batch_size))
+    crops_valid = all(torch.equal(c, r[:, a:a + crop_size, b:b + crop_size]) for c, r, (a, b) in zip(cropped, resized.cpu(), offsets))
+
+    rows = [
+        ('imgs_resize', time_ms(_reference_resize, (imgs, resize_scale), repeat), time_ms(util.imgs_resize, (imgs_device, resize_scale), repeat),
+         'max |diff| {:.4f}'.format((_reference_resize(imgs, resize_scale) - resized.cpu()).abs().max().item())),
+        ('random_crop', time_ms(_reference_crop, (resized.cpu(), crop_size), repeat), time_ms(util.random_crop, (resized, crop_size), repeat),
+         'valid crops' if crops_valid else 'INVALID crops'),
+        ('random_fliplr', time_ms(_reference_fliplr, (imgs,), repeat), time_ms(util.random_fliplr, (imgs_device,), repeat),
+         'valid flips' if flips_valid else 'INVALID flips'),
+    ]
+
+    print('{:<14} {:>14} {:>12} {:>8}  {}'.format('transform', 'per-image (ms)', 'batched (ms)', 'speedup', 'check'))
+    for name, before, after, check in rows:
+        print('{:<14} {:14.2f} {:12.2f} {:7.1f}x  {}'.format(name, before, after, before / after, check))
+
+
+"""Creates the command-line parser for the benchmark."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--resize_scale', type=int, default=286)
+    parser.add_argument('--crop_size', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device of the batched transforms.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+    benchmark(opts.batch_size, opts.image_size, opts.resize_scale, opts.crop_size, opts.repeat, opts.device)
@@ -1,21 +1,17 @@
-import cv2
-import matplotlib.pyplot as plt
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from scipy import misc
 from scipy import ndimage
 from scipy.ndimage.filters import gaussian_filter
 from scipy.ndimage.interpolation import map_coordinates
 from scipy.ndimage.morphology import distance_transform_cdt
-from scipy.spatial.distance import pdist
-from scipy.spatial.distance import squareform
-from skimage import feature
-from skimage import transform
-from skimage.feature import peak_local_max
-from skimage.filters import rank
-from skimage.morphology import disk, remove_small_objects
-from sklearn.cluster import KMeans
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 
-from KS_lib.misc.ELSClique import ESLclique
+# cv2, skimage and matplotlib are imported by the functions that use them, so that importing
+# KSimage for one function does not load all of them
 
 
 ###########################################
@@ -25,6 +21,8 @@ def imread(image_path):
     :param image_path:
     :return:
     """
+    import cv2
+
     I = cv2.imread(image_path,-1)
     # I = misc.imread(image_path)
     if I.ndim == 3:
@@ -40,6 +38,8 @@ def imwrite(I, save_path):
     :param save_path:
     :return:
     """
+    import cv2
+
     if I.ndim == 3 and I.shape[2] == 1:
         I = np.squeeze(I, axis=2)
 
@@ -51,6 +51,8 @@ def imwrite(I, save_path):
 
 ###########################################
 def imshow(I):
+    import matplotlib.pyplot as plt
+
     plt.imshow(I)
     # plt.show()
 
@@ -72,6 +74,8 @@ def rgb2gray(rgb):
 
 ###########################################
 def auto_canny(image, sigma=0.33):
+    from skimage import feature
+
     # preprocessing
     image = ndimage.gaussian_filter(image, 1)
 
@@ -103,49 +107,46 @@ def bwperim(bw, n=4):
     Parameters
     ----------
       bw : A black-and-white image
-      n : Connectivity. Must be 4 or 8 (default: 8)
+      n : Connectivity. Must be 4 or 8 (default: 4)
     Returns
     -------
       perim : A boolean image
     """
+    return bwperim_stack(np.asarray(bw)[None], n)[0]
 
+###########################################
+def bwperim_stack(bw, n=4):
+    """
+    Perimeters of a stack of binary images (see bwperim).
+    :param bw: N x H x W stack of binary images
+    :param n: connectivity, 4 or 8
+    :return: N x H x W boolean stack
+    """
     if n not in (4,8):
         raise ValueError('mahotas.bwperim: n must be 4 or 8')
-    rows,cols = bw.shape
-
-    # Translate image by one pixel in all directions
-    north = np.zeros((rows,cols))
-    south = np.zeros((rows,cols))
-    west = np.zeros((rows,cols))
-    east = np.zeros((rows,cols))
-
-    north[:-1,:] = bw[1:,:]
-    south[1:,:]  = bw[:-1,:]
-    west[:,:-1]  = bw[:,1:]
-    east[:,1:]   = bw[:,:-1]
-    idx = (north == bw) & \
-          (south == bw) & \
-          (west  == bw) & \
-          (east  == bw)
+    bw = np.asarray(bw).astype(bool, copy=False)
+    rows, cols = bw.shape[1:3]
+
+    # pixels outside the image count as background; neighbours are shifted views of the padded stack
+    padded = np.pad(bw, ((0, 0), (1, 1), (1, 1)), mode='constant')
+    def shifted(dy, dx):
+        return padded[:, 1 + dy:1 + dy + rows, 1 + dx:1 + dx + cols]
+
+    interior = bw.copy()
+    offsets = [(-1, 0), (1, 0), (0, -1), (0, 1)]
     if n == 8:
-        north_east = np.zeros((rows, cols))
-        north_west = np.zeros((rows, cols))
-        south_east = np.zeros((rows, cols))
-        south_west = np.zeros((rows, cols))
-        north_east[:-1, 1:]   = bw[1:, :-1]
-        north_west[:-1, :-1] = bw[1:, 1:]
-        south_east[1:, 1:]     = bw[:-1, :-1]
-        south_west[1:, :-1]   = bw[:-1, 1:]
-        idx &= (north_east == bw) & \
-               (south_east == bw) & \
-               (south_west == bw) & \
-               (north_west == bw)
-    return ~idx * bw
+        offsets += [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+    for dy, dx in offsets:
+        interior &= shifted(dy, dx)
+
+    return bw & ~interior
 
 ####################################################
 def shearing(img_file):
-    # Load the image as a matrix
-    image = imread(img_file)
+    from skimage import transform
+
+    # Load the image as a matrix (or use it directly if an array is given)
+    image = imread(img_file) if isinstance(img_file, str) else img_file
 
     # Create Afine transform
     afine_tf = transform.AffineTransform(shear=0.2)
@@ -155,6 +156,15 @@ def shearing(img_file):
 
     return modified
 
+#####################################################
+_coordinate_grids = dict()
+
+def _coordinate_grid(shape):
+    # cached (row, column) index grids of an image shape
+    if shape not in _coordinate_grids:
+        _coordinate_grids[shape] = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    return _coordinate_grids[shape]
+
 #####################################################
 def elastic_transform(image, alpha, sigma, random_state=None):
     """Elastic deformation of images as described in [Simard2003]_.
@@ -162,137 +172,233 @@ def elastic_transform(image, alpha, sigma, random_state=None):
        Convolutional Neural Networks applied to Visual Document Analysis", in
        Proc. of the International Conference on Document Analysis and
        Recognition, 2003.
+    The index grid is cached per shape and the sampling coordinates are computed once for all channels.
+    For whole batches see augment.Augmenter.
     """
 
     if random_state is None:
         random_state = np.random.RandomState(None)
 
-    if len(image.shape) == 2:
-        shape = image.shape[0:2]
-        dx = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
-        dy = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
-        x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
-        indices = np.reshape(x + dx, (-1, 1)), np.reshape(y + dy, (-1, 1))
+    shape = image.shape[0:2]
+    dx = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
+    dy = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
+    x, y = _coordinate_grid(shape)
+    indices = (x + dx, y + dy)
 
-        image = map_coordinates(image, indices, order=1).reshape(shape)
+    if len(image.shape) == 2:
+        image = map_coordinates(image, indices, order=1)
     else:
-
-        shape = image.shape[0:2]
-        dx = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
-        dy = gaussian_filter((random_state.rand(*shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha
-
-        x, y = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
-        indices = np.reshape(x + dx, (-1, 1)), np.reshape(y + dy, (-1, 1))
-
-        for i in range(image.ndim):
-            image[:,:,i] = map_coordinates(image[:,:,i], indices, order=1).reshape(shape)
+        for i in range(image.shape[2]):
+            image[:,:,i] = map_coordinates(image[:,:,i], indices, order=1)
 
     return image
 
 #####################################################
-def imresize(image,size,mode=None):
-    # if image.ndim == 3 and image.shape[2] == 1:
-    #     image = np.squeeze(image,2)
-    resize_img = list()
-    for i in range(image.shape[2]):
-        resize_img.append(misc.imresize(image[:,:,i],size,interp='bicubic',mode=mode))
-
-    return np.dstack(resize_img)
+def _map_stack(function, stack, workers=None):
+    # applies function to every image of a stack in a thread pool (cv2 releases the GIL) and stacks the results
+    workers = workers or os.cpu_count() or 1
+    if len(stack) <= 1 or workers == 1:
+        return np.stack([function(image) for image in stack])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return np.stack(list(pool.map(function, stack)))
 
 #####################################################
-def adaptive_histeq(img):
-    # create a CLAHE object (Arguments are optional).
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-    cl = list()
+def _output_size(shape, size):
+    # (height, width) of an image resized as scipy.misc.imresize did: int = percent, float = fraction, tuple = size
+    if isinstance(size, (int, np.integer)):
+        return int(shape[0] * size / 100.0), int(shape[1] * size / 100.0)
+    if isinstance(size, (float, np.floating)):
+        return int(shape[0] * size), int(shape[1] * size)
+    return int(size[0]), int(size[1])
 
-    if img.ndim == 2:
-        img = np.expand_dims(img, axis=2)
+#####################################################
+def imresize(image,size,mode=None):
+    """
+    bicubic resize of an H x W x C image (size as in scipy.misc.imresize; mode is accepted and ignored,
+    the dtype of the image is kept)
+    """
+    return imresize_stack(image[None], size)[0]
 
-    for i in range(img.shape[2]):
-        cl.append(clahe.apply(img[:,:,i]))
+#####################################################
+def imresize_stack(stack, size, workers=None):
+    """
+    bicubic resize of an N x H x W[ x C] stack, all channels of an image at once
+    :param size: percent (int), fraction (float) or (height, width)
+    """
+    import cv2
 
-    img = np.dstack(cl)
+    height, width = _output_size(stack.shape[1:3], size)
 
-    if img.ndim == 3 and img.shape[img.ndim-1] == 1:
-        img = np.squeeze(img, axis = 2)
+    def resize(image):
+        resized = cv2.resize(image, (width, height), interpolation=cv2.INTER_CUBIC)
+        return resized.reshape((height, width) + image.shape[2:])
 
-    return img
+    return _map_stack(resize, stack, workers)
 
 #####################################################
-def find_local_maxima(img, min_distance, threshold_rel):
-    img = np.squeeze(img)
-    coordinate = peak_local_max(img, min_distance=min_distance, threshold_rel=threshold_rel)
-
-    nparts = np.int(np.ceil(coordinate.shape[0] / 1000.0))
-    kmeans = KMeans(n_clusters=nparts, n_init = 1).fit(coordinate)
-    idx = kmeans.labels_
-
-    all_coordinate = list()
-
-    for i in range(nparts):
-        temp_coordinate = coordinate[idx == i,:]
+def adaptive_histeq(img):
+    img = np.asarray(img)
+    squeeze = img.ndim == 2 or (img.ndim == 3 and img.shape[2] == 1)
 
-        for min_distance in np.linspace(int(min_distance/2.0),min_distance+1,3):
+    img = adaptive_histeq_stack(img.reshape(img.shape[:2] + (-1,))[None])[0]
 
-            dist_mat = squareform(pdist(temp_coordinate, 'euclidean'))
+    if squeeze:
+        img = img[:, :, 0]
 
-            dBinary = dist_mat < min_distance
-            dBinary[np.eye(dBinary.shape[0]).astype(np.bool)] = 0
+    return img
 
-            m = ESLclique(dBinary)
-            m1 = m.tocsc()
+#####################################################
+def adaptive_histeq_stack(stack, clip_limit=2.0, tile_grid_size=(8,8), workers=None):
+    """
+    CLAHE of every channel of an N x H x W[ x C] uint8 stack
+    """
+    import cv2
 
-            nCliques = m1.shape[1]
+    def equalize(image):
+        # CLAHE objects are not shared between threads
+        clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+        if image.ndim == 2:
+            return clahe.apply(image)
+        return np.dstack([clahe.apply(np.ascontiguousarray(image[:, :, i])) for i in range(image.shape[2])])
 
-            Ic = np.zeros((nCliques, 1))
-            Jc = np.zeros((nCliques, 1))
+    return _map_stack(equalize, stack, workers)
 
-            for i in range(nCliques):
-                Im = temp_coordinate[np.squeeze(m1[:, i].toarray().astype(np.bool)),0]
-                Jm = temp_coordinate[np.squeeze(m1[:, i].toarray().astype(np.bool)),1]
+#####################################################
+def find_local_maxima(img, min_distance, threshold_rel):
+    """
+    Local maxima of an image, with nearby peaks merged (see merge_local_maxima).
+    :return: n x 2 array of (row, column) coordinates
+    """
+    from skimage.feature import peak_local_max
 
-                Ic[i] = np.mean(Im)
-                Jc[i] = np.mean(Jm)
+    img = np.squeeze(img)
+    coordinate = peak_local_max(img, min_distance=min_distance, threshold_rel=threshold_rel)
 
-            Ic = np.round(Ic)
-            Jc = np.round(Jc)
+    for radius in np.linspace(int(min_distance/2.0), min_distance+1, 3):
+        coordinate = merge_local_maxima(coordinate, radius)
 
-            temp_coordinate = np.column_stack((Ic,Jc))
+    return coordinate.astype(int)
 
-        all_coordinate.append(temp_coordinate)
+#####################################################
+def merge_local_maxima(coordinate, radius):
+    """
+    Replaces every maximal clique of points closer than radius to each other by its rounded centroid
+    (isolated points are cliques of one and are kept). Neighbours come from cKDTree radius queries and
+    the cliques are enumerated per connected component of the sparse neighbour graph, so time and memory
+    grow with the number of close pairs rather than with the square of the number of points.
+    :param coordinate: n x 2 array of points
+    :return: m x 2 array of rounded clique centroids
+    """
+    coordinate = np.asarray(coordinate, dtype=float)
+    n = coordinate.shape[0]
+    if n == 0:
+        return coordinate.reshape(0, 2)
+
+    pairs = cKDTree(coordinate).query_pairs(radius, output_type='ndarray')
+    if len(pairs):
+        pairs = pairs[np.linalg.norm(coordinate[pairs[:, 0]] - coordinate[pairs[:, 1]], axis=1) < radius]
+
+    adjacency = sparse.coo_matrix((np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])), shape=(n, n)).tocsr() if len(pairs) else sparse.csr_matrix((n, n), dtype=bool)
+    adjacency = (adjacency + adjacency.T).tocsr()
+
+    # isolated points are their own clique; the others are enumerated component by component
+    degree = np.diff(adjacency.indptr)
+    cliques = [[i] for i in np.flatnonzero(degree == 0)]
+
+    _, component = connected_components(adjacency, directed=False)
+    connected = np.flatnonzero(degree > 0)
+    order = connected[np.argsort(component[connected], kind='stable')]
+    bounds = np.flatnonzero(np.diff(component[order])) + 1
+    for nodes in np.split(order, bounds) if len(order) else []:
+        neighbours = {i: set(adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i + 1]]) for i in nodes}
+        cliques.extend(_maximal_cliques(neighbours))
+
+    # centroids of all cliques at once: (clique membership matrix) x (coordinates) / (clique sizes)
+    sizes = np.array([len(c) for c in cliques])
+    members = sparse.csr_matrix((np.ones(sizes.sum()), (np.repeat(np.arange(len(cliques)), sizes), np.concatenate(cliques))),
+                                shape=(len(cliques), n))
+    centroid = members.dot(coordinate) / sizes[:, None]
+
+    return np.round(centroid)
 
-    coordinate = np.row_stack(all_coordinate)
+#####################################################
+def _maximal_cliques(neighbours):
+    # Bron-Kerbosch with pivoting (iterative) over a graph given as {node: set of neighbours}
+    cliques = list()
+    stack = [(list(), set(neighbours), set())]
+    while stack:
+        clique, candidates, excluded = stack.pop()
+        if not candidates and not excluded:
+            cliques.append(clique)
+            continue
+        pivot = max(candidates | excluded, key=lambda u: len(candidates & neighbours[u]))
+        for v in list(candidates - neighbours[pivot]):
+            stack.append((clique + [v], candidates & neighbours[v], excluded & neighbours[v]))
+            candidates.remove(v)
+            excluded.add(v)
+    return cliques
 
-    return coordinate.astype(np.int)
+#####################################################
+def _as_uint8(mask):
+    # 0/1 uint8 version of a mask for cv2 (a view of contiguous bool masks, without a copy)
+    if mask.dtype == bool and mask.flags.c_contiguous:
+        return mask.view(np.uint8)
+    return (mask != 0).astype(np.uint8)
 
 #####################################################
 def bwareaopen(mask,area_limit):
+    return bwareaopen_stack(np.asarray(mask)[None], area_limit)[0]
+
+#####################################################
+def bwareaopen_stack(masks, area_limit, workers=None):
+    """
+    removes the 4-connected objects smaller than area_limit pixels from every mask of an N x H x W stack
+    (as skimage.morphology.remove_small_objects)
+    :return: N x H x W boolean stack
+    """
+    import cv2
 
-    mask = mask.astype(np.bool)
-    # mask = mask.astype(np.uint8) * 255
-    # im, contours, hierarchy = cv2.findContours(mask, 1, 2)
-    #
-    # temp_mask = np.zeros(mask.shape[:2], dtype='uint8')
-    # for cnt in contours:
-    #     area = cv2.contourArea(cnt)
-    #     if area > area_limit:
-    #         cv2.drawContours(temp_mask, [cnt], -1, 255, -1)
-    temp_mask = remove_small_objects(mask, area_limit)
+    def open_area(mask):
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(_as_uint8(mask), connectivity=4)
+        keep = stats[:, cv2.CC_STAT_AREA] >= area_limit
+        keep[0] = False
+        return keep[labels]
 
-    return temp_mask.astype(np.bool)
+    return _map_stack(open_area, masks, workers)
 
 #####################################################
 def imdilate(bw,r):
-    selem = disk(r)
+    return imdilate_stack(np.asarray(bw)[None], r)[0]
+
+#####################################################
+def imdilate_stack(bw, r, workers=None):
+    """
+    dilation of every mask of an N x H x W stack by a disk of radius r
+    :return: N x H x W boolean stack
+    """
+    import cv2
+    from skimage.morphology import disk
 
-    return rank.maximum(bw, selem).astype(np.bool)
-    # return cv2.dilate(bw,cv2.getStructuringElement(cv2.MORPH_RECT,(5,5)),iterations = 1)
+    selem = disk(r).astype(np.uint8)
+
+    return _map_stack(lambda mask: cv2.dilate(_as_uint8(mask), selem) > 0, bw, workers)
 
 #####################################################
 def imclose(bw, r):
-    salem = disk(r)
+    return imclose_stack(np.asarray(bw)[None], r)[0]
+
+#####################################################
+def imclose_stack(bw, r, workers=None):
+    """
+    closing of every mask of an N x H x W stack by a disk of radius r
+    :return: N x H x W boolean stack
+    """
+    import cv2
+    from skimage.morphology import disk
+
+    selem = disk(r).astype(np.uint8)
 
-    return cv2.morphologyEx(bw, cv2.MORPH_CLOSE, salem)
+    return _map_stack(lambda mask: cv2.morphologyEx(_as_uint8(mask), cv2.MORPH_CLOSE, selem) > 0, bw, workers)
 
 #####################################################
 def label2idx(L):
@@ -301,8 +407,12 @@ def label2idx(L):
 
 #####################################################
 def rgb2hsv(rgb):
+    import cv2
+
     return cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
 
 #####################################################
 def hsv2rgb(hsv):
+    import cv2
+
     return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
@@ -0,0 +1,69 @@
+# Scaling benchmark of the local maxima merge of KSimage.find_local_maxima
+
+import time
+import argparse
+
+import numpy as np
+from scipy.spatial.distance import pdist, squareform
+
+from KSimage import merge_local_maxima
+
+
+"""Peaks of a synthetic dense nuclei image: n_peaks points in clusters of 1-4 around nucleus centres,
+   spread over a square image with about one nucleus per spacing x spacing pixels."""
+def synthetic_peaks(n_peaks, spacing=12, seed=0):
+    rng = np.random.RandomState(seed)
+    n_nuclei = max(n_peaks // 2, 1)
+    size = int(np.sqrt(n_nuclei) * spacing)
+    centres = rng.randint(0, size, size=(n_nuclei, 2))
+    counts = rng.randint(1, 5, size=n_nuclei)
+    peaks = np.repeat(centres, counts, axis=0) + rng.randint(-3, 4, size=(counts.sum(), 2))
+    return np.clip(peaks, 0, size - 1)[:n_peaks]
+
+
+"""Time (s) of the three merge passes of find_local_maxima on the given peaks."""
+def time_merge(coordinate, min_distance):
+    start = time.time()
+    for radius in np.linspace(int(min_distance / 2.0), min_distance + 1, 3):
+        coordinate = merge_local_maxima(coordinate, radius)
+    return time.time() - start, len(coordinate)
+
+
+"""Time (s) and size (bytes) of the three dense squareform(pdist(...)) distance matrices the previous
+   implementation built for n points (before its clique enumeration)."""
+def time_dense_distances(coordinate):
+    start = time.time()
+    for _ in range(3):
+        dist_mat = squareform(pdist(coordinate, 'euclidean'))
+    return time.time() - start, dist_mat.nbytes
+
+
+"""Prints one row per number of peaks."""
+def benchmark(sizes, min_distance, dense_limit):
+    print('{:>8} {:>8} {:>10} {:>16} {:>14}'.format('peaks', 'merged', 'merge (s)', 'dense dist (s)', 'dense (MB)'))
+    for n in sizes:
+        coordinate = synthetic_peaks(n)
+        seconds, merged = time_merge(coordinate, min_distance)
+        if n <= dense_limit:
+            dense_seconds, dense_bytes = time_dense_distances(coordinate)
+            dense = '{:16.2f} {:14.1f}'.format(dense_seconds, dense_bytes / 2**20)
+        else:
+            dense = '{:>16} {:14.1f}'.format('skipped', 8.0 * n * n / 2**20)
+        print('{:8d} {:8d} {:10.2f} {}'.format(n, merged, seconds, dense))
+
+
+"""Creates the command-line parser for the benchmark."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Numbers of peaks.')
+    parser.add_argument('--min_distance', type=int, default=5, help='min_distance of find_local_maxima.')
+    parser.add_argument('--dense_limit', type=int, default=20000, help='Largest number of peaks for which the dense distance matrices are built.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+    benchmark(opts.sizes, opts.min_distance, opts.dense_limit)
@@ -1,4 +1,4 @@
-import os, util, pdb, pickle, argparse, itertools
+import os, util, json, argparse, itertools
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -8,17 +8,17 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.autograd import Variable
-from torchvision import transforms
 
-# Numpy & Scipy imports
+# Numpy imports
 import numpy as np
-import scipy
-import scipy.misc
 
 # Local imports
 import utils
 from data_loader import get_data_loader
-from models import CycleGenerator, PatchGANDiscriminator
+from models import CycleGenerator, PatchGANDiscriminator, DualGenerator
+from profiling import WindowedProfiler, add_profiler_args
+from augment import add_augment_args
+from preemption import PreemptionHandler, add_preemption_args, resume_path, set_rng_state, save_resume_state, load_resume_state, training_state, restore_training_state
 
 
 SEED = 14
@@ -32,10 +32,10 @@ if torch.cuda.is_available():
 
 """Builds the generators and discriminators using the CycleGenerator."""
 def create_model(opts):
-    G_XtoY = CycleGenerator(init_zero_weights=opts.init_zero_weights)
-    G_YtoX = CycleGenerator(init_zero_weights=opts.init_zero_weights)
-    D_X = PatchGANDiscriminator()
-    D_Y = PatchGANDiscriminator()
+    G_XtoY = CycleGenerator(init_zero_weights=opts.init_zero_weights, conv_dim=opts.g_conv_dim, n_res_blocks=opts.g_res_blocks, n_downsampling=opts.g_downsampling)
+    G_YtoX = CycleGenerator(init_zero_weights=opts.init_zero_weights, conv_dim=opts.g_conv_dim, n_res_blocks=opts.g_res_blocks, n_downsampling=opts.g_downsampling)
+    D_X = PatchGANDiscriminator(conv_dim=opts.d_conv_dim, n_layers=opts.d_layers)
+    D_Y = PatchGANDiscriminator(conv_dim=opts.d_conv_dim, n_layers=opts.d_layers)
 
     if torch.cuda.is_available():
         G_XtoY.cuda()
@@ -108,23 +108,18 @@ def load_checkpoint(opts):
    from the corresponding images in the first column.
 """
 def merge_images(sources, targets, opts, k=10):
-    _, _, h, w = sources.shape
+    _, c, h, w = sources.shape
     row = 2#int(np.sqrt(opts.batch_size))
-    merged = np.zeros([3, row*h, row*w*2])
-    for idx, (s, t) in enumerate(zip(sources, targets)):
-        i = idx // row
-        j = idx % row
+    n = min(len(sources), row * row)
+    pairs = np.zeros([row * row, 2, c, h, w])
+    pairs[:n, 0], pairs[:n, 1] = sources[:n], targets[:n]
+    return pairs.reshape(row, row * 2, c, h, w).transpose(0, 3, 1, 4, 2).reshape(row * h, row * 2 * w, c)
 
-        print("I: ", i, "H: ", h, "J: ", j)
-        if(i * h >= merged.shape[1] or j * 2 * h >= merged.shape[2]):
-            break
-        merged[:, i*h:(i+1)*h, (j*2)*h:(j*2+1)*h] = s
-        merged[:, i*h:(i+1)*h, (j*2+1)*h:(j*2+2)*h] = t
-    return merged.transpose(1, 2, 0)
 
+"""Saves samples from both generators X->Y and Y->X (and appends a frame to the progress animation if given)."""
+def save_samples(iteration, fixed_Y, fixed_X, G_YtoX, G_XtoY, opts, animation=None):
+    from PIL import Image
 
-"""Saves samples from both generators X->Y and Y->X."""
-def save_samples(iteration, fixed_Y, fixed_X, G_YtoX, G_XtoY, opts):
     fake_X = G_YtoX(fixed_Y)
     fake_Y = G_XtoY(fixed_X)
 
@@ -136,24 +131,28 @@ def save_samples(iteration, fixed_Y, fixed_X, G_YtoX, G_XtoY, opts):
 
     merged = merge_images(X, fake_Y, opts)
     path = os.path.join(opts.sample_dir, 'sample-{:06d}-X-Y.png'.format(iteration))
-    scipy.misc.imsave(path, merged)
+    Image.fromarray(util.to_uint8(merged)).save(path)
     print('Saved {}'.format(path))
 
     merged = merge_images(Y, fake_X, opts)
     path = os.path.join(opts.sample_dir, 'sample-{:06d}-Y-X.png'.format(iteration))
-    scipy.misc.imsave(path, merged)
+    Image.fromarray(util.to_uint8(merged)).save(path)
     print('Saved {}'.format(path))
 
     merged = merge_images(X, cycle_X, opts)
     path = os.path.join(opts.sample_dir, 'sample-{:06d}-X-cycle_X.png'.format(iteration))
-    scipy.misc.imsave(path, merged)
+    Image.fromarray(util.to_uint8(merged)).save(path)
     print('Saved {}'.format(path))
 
     merged = merge_images(Y, cycle_Y, opts)
     path = os.path.join(opts.sample_dir, 'sample-{:06d}-Y-cycle_Y.png'.format(iteration))
-    scipy.misc.imsave(path, merged)
+    Image.fromarray(util.to_uint8(merged)).save(path)
     print('Saved {}'.format(path))
 
+    # one row per test image: X | X->Y | Y | Y->X
+    if animation is not None:
+        animation.append(util.sample_grid([X[:4], fake_Y[:4], Y[:4], fake_X[:4]]))
+
 
 """Runs the training loop.
         1. Saves checkpoint every opts.checkpoint_every iterations
@@ -172,11 +171,14 @@ def training_loop(dataloader_X, dataloader_Y, test_dataloader_X, test_dataloader
 
     # Set fixed data from domains X and Y for sampling. These are images that are held constant throughout training, that allow us to inspect the model's performance.
 
-    fixed_X = utils.to_var(test_iter_X.next()[0])
-    fixed_Y = utils.to_var(test_iter_Y.next()[0])
+    fixed_X = utils.to_var(next(test_iter_X)[0])
+    fixed_Y = utils.to_var(next(test_iter_Y)[0])
 
     iter_per_epoch = min(len(iter_X), len(iter_Y))
 
+    # progress animation (one frame per sample step, written as it is produced)
+    animation = util.AnimationWriter(opts.animation, opts.animation_fps, opts.animation_max_frames, opts.animation_max_size) if opts.animation else None
+
 
     # loss terms
     MSE_loss = nn.MSELoss().cuda()
@@ -186,25 +188,54 @@ def training_loop(dataloader_X, dataloader_Y, test_dataloader_X, test_dataloader
     fake_X_store = util.ImagePool(50)
     fake_Y_store = util.ImagePool(50)
 
-    for iteration in range(1, opts.train_iters+1):
+    # runs G_XtoY and G_YtoX together (as one vectorized call when --fused_generators is set)
+    G_pair = DualGenerator(G_XtoY, G_YtoX, fused=opts.fused_generators)
+
+    # profiler (only hooks into the models inside the --profile_start/--profile_steps window)
+    profiler = WindowedProfiler(opts, {'G_XtoY': G_XtoY, 'G_YtoX': G_YtoX, 'D_X': D_X, 'D_Y': D_Y})
+
+    # everything restored on resume (consumed counts the samples used from the current epoch of each loader)
+    models = {'G_XtoY': G_XtoY, 'G_YtoX': G_YtoX, 'D_X': D_X, 'D_Y': D_Y}
+    optimizers = {'g_optimizer': g_optimizer, 'dx_optimizer': dx_optimizer, 'dy_optimizer': dy_optimizer}
+    pools = {'fake_X_store': fake_X_store, 'fake_Y_store': fake_Y_store}
+    loaders = {'X': dataloader_X, 'Y': dataloader_Y}
+    consumed = {'X': 0, 'Y': 0}
+    start_iteration = 1
+
+    state = load_resume_state(resume_path(opts)) if opts.resume else None
+    if state is not None:
+        start_iteration, consumed = restore_training_state(state, models, optimizers, pools, loaders)
+        iter_X = iter(dataloader_X)
+        iter_Y = iter(dataloader_Y)
+        set_rng_state(state['rng'])
+        print('Resumed after iteration {}'.format(start_iteration - 1))
+
+    # flushes an emergency checkpoint when the job receives SIGTERM/SIGINT/SIGUSR1
+    preemption = PreemptionHandler(opts.preempt_budget).install()
+
+    for iteration in range(start_iteration, opts.train_iters+1):
+        profiler.step_begin(iteration)
+
         # Reset data_iter for each epoch
         if iteration % iter_per_epoch == 0:
             iter_X = iter(dataloader_X)
             iter_Y = iter(dataloader_Y)
+            consumed = {'X': 0, 'Y': 0}
 
 
-        images_X, labels_X = iter_X.next()
+        images_X, labels_X = next(iter_X)
         images_X, labels_X = utils.to_var(images_X), utils.to_var(labels_X).long().squeeze()
+        consumed['X'] += images_X.size(0)
        
-        images_Y, labels_Y = iter_Y.next()
+        images_Y, labels_Y = next(iter_Y)
         images_Y, labels_Y = utils.to_var(images_Y), utils.to_var(labels_Y).long().squeeze()
+        consumed['Y'] += images_Y.size(0)
 
         #### GENERATOR TRAINING ####
         g_optimizer.zero_grad()
 
         # 1. GAN loss term
-        fake_X = G_YtoX(images_Y)
-        fake_Y = G_XtoY(images_X)
+        fake_Y, fake_X = G_pair(images_X, images_Y)
 
         d_x_pred = D_X(fake_X)
         d_y_pred = D_Y(fake_Y)
@@ -214,14 +245,12 @@ def training_loop(dataloader_X, dataloader_Y, test_dataloader_X, test_dataloader
 
 
         #2. Identity loss term
-        identity_X = G_YtoX(images_X)
-        identity_Y = G_XtoY(images_Y)
+        identity_Y, identity_X = G_pair(images_Y, images_X)
 
         identity_loss = L1_loss(images_X, identity_X) + L1_loss(images_Y, identity_Y)
 
         #3. Cycle consistency loss term
-        reconstructed_Y = G_XtoY(fake_X)
-        reconstructed_X = G_YtoX(fake_Y)
+        reconstructed_Y, reconstructed_X = G_pair(fake_X, fake_Y)
 
         cycle_consistency_loss = L1_loss(images_X, reconstructed_X) + L1_loss(images_Y, reconstructed_Y)
 
@@ -269,12 +298,28 @@ def training_loop(dataloader_X, dataloader_Y, test_dataloader_X, test_dataloader
 
         # Save the generated samples
         if iteration % opts.sample_every == 0:
-            save_samples(iteration, fixed_Y, fixed_X, G_YtoX, G_XtoY, opts)
+            save_samples(iteration, fixed_Y, fixed_X, G_YtoX, G_XtoY, opts, animation)
 
         # Save the model parameters
         if iteration % opts.checkpoint_every == 0:
             checkpoint(iteration, G_XtoY, G_YtoX, D_X, D_Y, g_optimizer, dx_optimizer, dy_optimizer, opts)
 
+        # Save the resume state (and stop if the job is being preempted)
+        if iteration % opts.checkpoint_every == 0 or preemption.requested:
+            save_resume_state(training_state(iteration, models, optimizers, pools, loaders, consumed), resume_path(opts))
+
+        profiler.step_end(iteration)
+
+        if preemption.requested:
+            profiler.close()
+            if animation is not None:
+                animation.close()
+            preemption.exit()
+
+    profiler.close()
+    if animation is not None:
+        animation.close()
+
 """Loads the data, creates checkpoint and sample directories, and starts the training loop."""
 def main(opts):
     # Create train and test dataloaders for images from the two domains X and Y
@@ -285,6 +330,10 @@ def main(opts):
     utils.create_dir(opts.checkpoint_dir)
     utils.create_dir(opts.sample_dir)
 
+    # Record the generator architecture for the inference scripts (see inference.load_generator)
+    with open(os.path.join(opts.checkpoint_dir, 'generator_config.json'), 'w') as f:
+        json.dump({'model': 'CycleGenerator', 'conv_dim': opts.g_conv_dim, 'n_res_blocks': opts.g_res_blocks, 'n_downsampling': opts.g_downsampling}, f)
+
     # Start training
     training_loop(dataloader_X, dataloader_Y, test_dataloader_X, test_dataloader_Y, opts)
 
@@ -305,10 +354,14 @@ def create_parser():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--image_size', type=int, default=256, help='The side length N to convert images to NxN.')
-    parser.add_argument('--g_conv_dim', type=int, default=256)
-    parser.add_argument('--d_conv_dim', type=int, default=256)
+    parser.add_argument('--g_conv_dim', type=int, default=64, help='Width of the first generator layer (doubled by each downsampling).')
+    parser.add_argument('--g_res_blocks', type=int, default=9, help='Number of ResNet blocks of the generators.')
+    parser.add_argument('--g_downsampling', type=int, default=2, help='Number of down/up-sampling stages of the generators.')
+    parser.add_argument('--d_conv_dim', type=int, default=64, help='Width of the first discriminator layer (doubled by each strided layer).')
+    parser.add_argument('--d_layers', type=int, default=3, help='Number of strided instance-normalized discriminator layers.')
     parser.add_argument('--use_cycle_consistency_loss', action='store_true', default=True, help='Choose whether to include the cycle consistency term in the loss.')
     parser.add_argument('--init_zero_weights', action='store_true', default=False, help='Choose whether to initialize the generator conv weights to 0 (implements the identity function).')
+    parser.add_argument('--fused_generators', action='store_true', default=False, help='Run both generator directions in one vectorized call; measure with benchmark_fused.py, it is slower on CPU (checkpoints are unchanged).')
 
     # Training hyper-parameters
     parser.add_argument('--train_iters', type=int, default=200000, help='The number of training iterations to run (you can Ctrl-C out earlier if you want).')
@@ -334,6 +387,21 @@ def create_parser():
     parser.add_argument('--checkpoint_every', type=int , default=500)
     parser.add_argument('--start_iter', type=int, default=0)
 
+    # Training-progress animation
+    parser.add_argument('--animation', type=str, default=None, help='Write the samples of every sample step to this .gif, .png (animated) or .mp4 file as training runs (rewritten on resume).')
+    parser.add_argument('--animation_fps', type=float, default=5)
+    parser.add_argument('--animation_max_frames', type=int, default=200, help='Frames after which the animation keeps only every other sample step (repeatedly), 0 for all.')
+    parser.add_argument('--animation_max_size', type=int, default=0, help='Longest side of the animation frames, 0 for full size.')
+
+    # Batch-level augmentation
+    add_augment_args(parser)
+
+    # Preemption and resume
+    add_preemption_args(parser)
+
+    # Profiling
+    add_profiler_args(parser)
+
     return parser
 
 
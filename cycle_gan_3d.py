@@ -0,0 +1,225 @@
+# CycleGAN training on random patches of MRI volumes, with the 3D generator and discriminator
+
+import os, util, json, random, argparse, itertools
+
+import warnings
+warnings.filterwarnings("ignore")
+
+# Torch imports
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+# Numpy imports
+import numpy as np
+from PIL import Image
+
+# Local imports
+import utils
+from data_loader import get_volume_loader
+from models import CycleGenerator3d, PatchGANDiscriminator3d
+from volumes import read_volume, to_dhw, intensity_range, normalize, patch_shape, stitched_forward, activation_bytes_per_voxel
+
+
+SEED = 14
+
+# Set the random seed manually for reproducibility.
+random.seed(SEED)
+np.random.seed(SEED)
+torch.manual_seed(SEED)
+if torch.cuda.is_available():
+    torch.cuda.manual_seed(SEED)
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+"""Builds the 3D generators and discriminators."""
+def create_model(opts):
+    G_XtoY = CycleGenerator3d(init_zero_weights=opts.init_zero_weights, conv_dim=opts.g_conv_dim, n_res_blocks=opts.g_res_blocks, n_downsampling=opts.g_downsampling)
+    G_YtoX = CycleGenerator3d(init_zero_weights=opts.init_zero_weights, conv_dim=opts.g_conv_dim, n_res_blocks=opts.g_res_blocks, n_downsampling=opts.g_downsampling)
+    D_X = PatchGANDiscriminator3d(conv_dim=opts.d_conv_dim, n_layers=opts.d_layers)
+    D_Y = PatchGANDiscriminator3d(conv_dim=opts.d_conv_dim, n_layers=opts.d_layers)
+
+    return G_XtoY.to(device), G_YtoX.to(device), D_X.to(device), D_Y.to(device)
+
+
+"""Saves the parameters of both generators and discriminators (same file names as cycle_gan.py)."""
+def checkpoint(iteration, G_XtoY, G_YtoX, D_X, D_Y, opts):
+    for name, model in (('G_XtoY', G_XtoY), ('G_YtoX', G_YtoX), ('D_X', D_X), ('D_Y', D_Y)):
+        torch.save(model.state_dict(), os.path.join(opts.checkpoint_dir, name + '_' + str(iteration) + '_.pkl'))
+
+
+"""Returns a test volume as a 1 x D x H x W tensor in [-1, 1] (a path or an in-memory synthetic volume)."""
+def load_test_volume(volume):
+    if isinstance(volume, str):
+        volume = read_volume(volume)
+        volume = normalize(to_dhw(volume), *intensity_range(volume))
+    return torch.from_numpy(np.ascontiguousarray(volume, dtype=np.float32))[None]
+
+
+"""Saves the middle slice of a test volume next to the middle slice of its whole-volume translation
+   (run by overlapping-patch stitching, as at inference time)."""
+def save_samples(iteration, volume, G, name, opts):
+    G.eval()
+    with torch.no_grad():
+        fake = stitched_forward(G, volume, opts.patch_size, opts.patch_batch)
+    G.train()
+
+    middle = volume.size(1) // 2
+    merged = torch.cat([volume[0, middle], fake[0, middle]], dim=1)
+    path = os.path.join(opts.sample_dir, 'sample-{:06d}-{}.png'.format(iteration, name))
+    Image.fromarray(((merged + 1) * 127.5).clamp(0, 255).byte().numpy()).save(path)
+    print('Saved {}'.format(path))
+
+
+#Next batch of a patch loader, restarting it when it runs out
+def _next(iterator, loader):
+    try:
+        return next(iterator), iterator
+    except StopIteration:
+        iterator = iter(loader)
+        return next(iterator), iterator
+
+
+"""Runs the training loop on random patches (the losses of cycle_gan.py: least-squares GAN, identity and cycle
+   consistency). The generators and discriminators only ever see batch_size x 1 x patch_size inputs, so the
+   activation memory is set by the patch size and batch size, whatever the size of the volumes."""
+def training_loop(dataloader_X, dataloader_Y, test_volumes_X, test_volumes_Y, opts):
+    G_XtoY, G_YtoX, D_X, D_Y = create_model(opts)
+
+    g_optimizer = optim.Adam(itertools.chain(G_XtoY.parameters(), G_YtoX.parameters()), lr=opts.lr, betas=(opts.beta1, opts.beta2))
+    dx_optimizer = optim.Adam(D_X.parameters(), lr=opts.lr, betas=(opts.beta1, opts.beta2))
+    dy_optimizer = optim.Adam(D_Y.parameters(), lr=opts.lr, betas=(opts.beta1, opts.beta2))
+
+    voxels = opts.batch_size * int(np.prod(patch_shape(opts.patch_size, dataloader_X.dataset.volumes[0].shape)))
+    print('Generator activations: ~{:.0f} MB per forward pass ({} voxels per batch)'.format(
+        activation_bytes_per_voxel(G_XtoY) * voxels / 2**20, voxels))
+
+    fixed_X = load_test_volume(test_volumes_X[0])
+    fixed_Y = load_test_volume(test_volumes_Y[0])
+
+    MSE_loss = nn.MSELoss()
+    L1_loss = nn.L1Loss()
+
+    fake_X_store = util.ImagePool(50)
+    fake_Y_store = util.ImagePool(50)
+
+    iter_X = iter(dataloader_X)
+    iter_Y = iter(dataloader_Y)
+
+    for iteration in range(1, opts.train_iters + 1):
+        (images_X, _), iter_X = _next(iter_X, dataloader_X)
+        (images_Y, _), iter_Y = _next(iter_Y, dataloader_Y)
+        images_X, images_Y = images_X.to(device), images_Y.to(device)
+
+        #### GENERATOR TRAINING ####
+        g_optimizer.zero_grad()
+
+        fake_Y = G_XtoY(images_X)
+        fake_X = G_YtoX(images_Y)
+
+        d_x_pred = D_X(fake_X)
+        d_y_pred = D_Y(fake_Y)
+        gan_loss = MSE_loss(d_x_pred, torch.ones_like(d_x_pred)) + MSE_loss(d_y_pred, torch.ones_like(d_y_pred))
+
+        identity_loss = L1_loss(images_X, G_YtoX(images_X)) + L1_loss(images_Y, G_XtoY(images_Y))
+        cycle_consistency_loss = L1_loss(images_X, G_YtoX(fake_Y)) + L1_loss(images_Y, G_XtoY(fake_X))
+
+        g_loss = gan_loss + opts.identity_lambda * identity_loss + opts.cycle_consistency_lambda * cycle_consistency_loss
+        g_loss.backward()
+        g_optimizer.step()
+
+        #### DISCRIMINATOR TRAINING ####
+        dx_optimizer.zero_grad()
+        d_x_real = D_X(images_X)
+        d_x_fake = D_X(fake_X_store.query(fake_X.detach()))
+        D_X_loss = (MSE_loss(d_x_real, torch.ones_like(d_x_real)) + MSE_loss(d_x_fake, torch.zeros_like(d_x_fake))) * .5
+        D_X_loss.backward()
+        dx_optimizer.step()
+
+        dy_optimizer.zero_grad()
+        d_y_real = D_Y(images_Y)
+        d_y_fake = D_Y(fake_Y_store.query(fake_Y.detach()))
+        D_Y_loss = (MSE_loss(d_y_real, torch.ones_like(d_y_real)) + MSE_loss(d_y_fake, torch.zeros_like(d_y_fake))) * .5
+        D_Y_loss.backward()
+        dy_optimizer.step()
+
+        if iteration % opts.log_step == 0:
+            print('Iteration [{:5d}/{:5d}] | d_Y_loss: {:6.4f} | d_X_loss: {:6.4f} | g_loss: {:6.4f}'
+                  .format(iteration, opts.train_iters, D_Y_loss.item(), D_X_loss.item(), g_loss.item()))
+
+        if iteration % opts.sample_every == 0 or iteration == opts.train_iters:
+            save_samples(iteration, fixed_X, G_XtoY, 'X-Y', opts)
+            save_samples(iteration, fixed_Y, G_YtoX, 'Y-X', opts)
+
+        if iteration % opts.checkpoint_every == 0 or iteration == opts.train_iters:
+            checkpoint(iteration, G_XtoY, G_YtoX, D_X, D_Y, opts)
+
+
+"""Loads the volumes, creates checkpoint and sample directories, and starts the training loop."""
+def main(opts):
+    dataloader_X, test_volumes_X = get_volume_loader(opts, opts.X)
+    dataloader_Y, test_volumes_Y = get_volume_loader(opts, opts.Y)
+
+    utils.create_dir(opts.checkpoint_dir)
+    utils.create_dir(opts.sample_dir)
+
+    # Record the generator architecture for the inference scripts (see inference.load_generator)
+    with open(os.path.join(opts.checkpoint_dir, 'generator_config.json'), 'w') as f:
+        json.dump({'model': 'CycleGenerator3d', 'conv_dim': opts.g_conv_dim, 'n_res_blocks': opts.g_res_blocks, 'n_downsampling': opts.g_downsampling}, f)
+
+    training_loop(dataloader_X, dataloader_Y, test_volumes_X, test_volumes_Y, opts)
+
+
+"""Creates the command-line parser for 3D training."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    # Models
+    parser.add_argument('--g_conv_dim', type=int, default=32, help='Width of the first generator layer (doubled by each downsampling).')
+    parser.add_argument('--g_res_blocks', type=int, default=6, help='Number of 3D ResNet blocks of the generators.')
+    parser.add_argument('--g_downsampling', type=int, default=2, help='Number of down/up-sampling stages of the generators.')
+    parser.add_argument('--d_conv_dim', type=int, default=32, help='Width of the first discriminator layer.')
+    parser.add_argument('--d_layers', type=int, default=3, help='Number of strided discriminator layers (patches need 2**(d_layers + 2) voxels per axis).')
+    parser.add_argument('--init_zero_weights', action='store_true', default=False)
+
+    # Patches
+    parser.add_argument('--patch_size', type=int, nargs=3, default=[32, 64, 64], help='Training/inference patch size (slices, rows, columns); 0 takes the whole axis, e.g. 16 0 0 for slabs.')
+    parser.add_argument('--patch_batch', type=int, default=2, help='Number of patches run together when stitching whole volumes.')
+    parser.add_argument('--samples_per_epoch', type=int, default=1000, help='Number of random patches per epoch of each domain.')
+
+    # Training hyper-parameters
+    parser.add_argument('--train_iters', type=int, default=100000)
+    parser.add_argument('--batch_size', type=int, default=2, help='The number of patches in a batch.')
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--lr', type=float, default=0.0002)
+    parser.add_argument('--beta1', type=float, default=0.5)
+    parser.add_argument('--beta2', type=float, default=0.999)
+    parser.add_argument('--cycle_consistency_lambda', type=float, default=10.0)
+    parser.add_argument('--identity_lambda', type=float, default=5.0)
+
+    # Data sources (pre_img.mat or H x W x S .npy volumes in <data_dir>/Train_<X|Y> and Test_<X|Y>)
+    parser.add_argument('--data_dir', type=str, default=os.path.join('/home', 'adithya', 'Training_Set_Mat_Files'))
+    parser.add_argument('--X', type=str, default='GE')
+    parser.add_argument('--Y', type=str, default='Siemens')
+    parser.add_argument('--synthetic', action='store_true', default=False, help='Train on small generated volumes instead (runs on CPU).')
+    parser.add_argument('--synthetic_shape', type=int, nargs=3, default=[32, 64, 64])
+    parser.add_argument('--synthetic_volumes', type=int, default=4)
+
+    # Saving directories and checkpoint/sample iterations
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints_cyclegan_3d')
+    parser.add_argument('--sample_dir', type=str, default='samples_cyclegan_3d')
+    parser.add_argument('--log_step', type=int, default=10)
+    parser.add_argument('--sample_every', type=int, default=500)
+    parser.add_argument('--checkpoint_every', type=int, default=500)
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+
+    if opts.synthetic:
+        opts.X, opts.Y = 'X', 'Y'
+    main(opts)
@@ -2,12 +2,55 @@ import os
 
 # Torch imports
 import torch
-from torch.utils.data import DataLoader
-from torchvision import datasets, transforms
-from datasets import ImageDataset
+from torch.utils.data import DataLoader, Sampler
+from datasets import ImageDataset, VolumePatchDataset
+from augment import Augmenter, AugmentedLoader
+from volumes import synthetic_volume
+
+"""Random sampler whose position inside the current epoch can be saved and restored.
+   The permutation of each epoch is drawn from a private generator (seeded from the global torch RNG),
+   so a resumed run replays the remaining samples of the interrupted epoch and then the same later epochs.
+"""
+class ResumableRandomSampler(Sampler):
+    def __init__(self, data_source):
+        self.data_source = data_source
+        self.generator = torch.Generator()
+        self.generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        self.perm = None
+        self.resume_perm = None
+        self.resume_start = 0
+
+    def __iter__(self):
+        if self.resume_perm is not None:
+            self.perm, start = self.resume_perm, self.resume_start
+            self.resume_perm, self.resume_start = None, 0
+        else:
+            self.perm, start = torch.randperm(len(self.data_source), generator=self.generator), 0
+
+        return iter(self.perm[start:].tolist())
+
+    def __len__(self):
+        return len(self.data_source)
+
+    """consumed: number of samples of the current epoch the training loop has already used."""
+    def state_dict(self, consumed):
+        return {'generator': self.generator.get_state(), 'perm': self.perm, 'consumed': consumed}
+
+    """Makes the next epoch started by iter() continue the saved one after its consumed samples
+       (or draw a new permutation when the saved epoch was used up)."""
+    def load_state_dict(self, state):
+        self.generator.set_state(state['generator'])
+        if state['perm'] is not None and state['consumed'] < len(state['perm']):
+            self.resume_perm, self.resume_start = state['perm'], state['consumed']
+        else:
+            self.resume_perm, self.resume_start = None, 0
+
 
 """Creates training and test data loaders and pipeline."""
 def get_data_loader(opts, image_type):
+    from torchvision import transforms
+
     transform = transforms.Compose([
                     transforms.Resize(opts.image_size), #resize 512x512 images to 256x256
                     transforms.RandomHorizontalFlip(), #new addition as a data augmentation tactic
@@ -19,7 +62,33 @@ def get_data_loader(opts, image_type):
     test_path = os.path.join(opts.data_dir, 'Test_' + image_type)
 
     print("train_path: ", train_path, " test_path: ", test_path)
-    train_dloader = DataLoader(ImageDataset(train_path, transformations=transform), batch_size=opts.batch_size, shuffle=True, num_workers=opts.num_workers)
+    train_dataset = ImageDataset(train_path, transformations=transform)
+    train_dloader = DataLoader(train_dataset, batch_size=opts.batch_size, sampler=ResumableRandomSampler(train_dataset), num_workers=opts.num_workers)
     test_dloader = DataLoader(ImageDataset(test_path, transformations=transform), batch_size=opts.batch_size, shuffle=False, num_workers=opts.num_workers)
 
+    # Batch-level elastic/affine augmentation of the training images (on the GPU when there is one)
+    if getattr(opts, 'augment', False):
+        augmenter = Augmenter(opts.elastic_alpha, opts.elastic_sigma, opts.shear, opts.rotation, opts.scale, seed=opts.augment_seed + (image_type == opts.Y))
+        train_dloader = AugmentedLoader(train_dloader, augmenter, 'cuda' if torch.cuda.is_available() else 'cpu')
+
     return train_dloader, test_dloader
+
+
+"""Creates the patch loader of one domain for 3D training (cycle_gan_3d.py) and the list of its test volumes.
+   Volumes are the pre_img.mat / .npy files of <data_dir>/Train_<domain> and Test_<domain>; with opts.synthetic,
+   small synthetic volumes of opts.synthetic_shape are generated instead (see volumes.synthetic_volume)."""
+def get_volume_loader(opts, domain):
+    if opts.synthetic:
+        offset = 0 if domain == opts.X else 1000
+        train_volumes = [synthetic_volume(opts.synthetic_shape, domain, seed=offset + i) for i in range(opts.synthetic_volumes)]
+        test_volumes = [synthetic_volume(opts.synthetic_shape, domain, seed=offset + 500)]
+    else:
+        def volume_files(path):
+            return [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(('.mat', '.npy'))]
+        train_volumes = volume_files(os.path.join(opts.data_dir, 'Train_' + domain))
+        test_volumes = volume_files(os.path.join(opts.data_dir, 'Test_' + domain))
+
+    train_dataset = VolumePatchDataset(train_volumes, opts.patch_size, samples_per_epoch=opts.samples_per_epoch, seed=0 if domain == opts.X else 1)
+    train_dloader = DataLoader(train_dataset, batch_size=opts.batch_size, num_workers=opts.num_workers, drop_last=True)
+
+    return train_dloader, test_volumes
@@ -3,9 +3,10 @@ import random
 import os
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 from PIL import Image
-import torchvision.transforms as transforms
+
+from volumes import read_volume, to_dhw, intensity_range, normalize, patch_shape, random_patch
 
 class ImageDataset(Dataset):
     def __init__(self, root, transformations=None, unaligned=False, mode='train'):
@@ -24,3 +25,41 @@ class ImageDataset(Dataset):
 
     def __len__(self):
         return len(self.files_)
+
+
+"""Random patches of MRI volumes (see volumes.py), as 1 x d x h x w tensors in [-1, 1].
+   Volumes are given as paths (pre_img.mat / .npy files, each normalized by its own intensity range) or as
+   in-memory D x H x W arrays already in [-1, 1]. Every item draws a new patch from a random volume, so an epoch
+   is samples_per_epoch patches; only the patches, never whole volumes, go through the model.
+   DataLoader workers reseed the patch RNG from their own torch seed, so they do not draw the same patches.
+"""
+class VolumePatchDataset(Dataset):
+    def __init__(self, volumes, patch_size, samples_per_epoch=1000, seed=0):
+        self.volumes, self.ranges = [], []
+        for volume in volumes:
+            if isinstance(volume, str):
+                volume = read_volume(volume)
+                self.ranges.append(intensity_range(volume))
+                volume = to_dhw(volume)
+            else:
+                self.ranges.append((-1.0, 1.0))
+            self.volumes.append(volume)
+
+        self.patch_size = patch_size
+        self.samples_per_epoch = samples_per_epoch
+        self.rng = random.Random(seed)
+        self.worker_seed = None
+
+    def __getitem__(self, index):
+        worker = get_worker_info()
+        if worker is not None and worker.seed != self.worker_seed:
+            self.worker_seed = worker.seed
+            self.rng.seed(worker.seed)
+
+        v = self.rng.randrange(len(self.volumes))
+        volume = self.volumes[v]
+        patch = random_patch(volume, patch_shape(self.patch_size, volume.shape), self.rng)
+        return (torch.from_numpy(normalize(patch, *self.ranges[v]))[None], 0)
+
+    def __len__(self):
+        return self.samples_per_epoch
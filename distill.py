@@ -0,0 +1,148 @@
+# Distills a trained CycleGenerator into a lightweight StudentGenerator
+
+import os
+import json
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+import utils
+from models import StudentGenerator
+from data_loader import get_data_loader
+from inference import load_generator, inference_mode
+from metrics import psnr, ssim
+
+
+"""Number of parameters of a model."""
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+"""Mean latency (s) of a forward pass over a batch, after one warm-up pass."""
+def latency(model, batch, repeats=3):
+    with inference_mode():
+        model(batch)
+        if batch.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeats):
+            model(batch)
+        if batch.is_cuda:
+            torch.cuda.synchronize()
+    return (time.time() - start) / repeats
+
+
+"""Compares the student with its teacher on up to num_batches test batches: mean PSNR/SSIM of the student
+   output against the teacher output, and the latency and parameter count of both."""
+def report(teacher, student, test_loader, num_batches=8):
+    student.eval()
+    psnrs, ssims, batch = [], [], None
+    with inference_mode():
+        for i, (images, _) in enumerate(test_loader):
+            if i == num_batches:
+                break
+            batch = utils.to_var(images)
+            target, output = teacher(batch), student(batch)
+            psnrs.append(psnr(output, target))
+            ssims.append(ssim(output, target))
+
+    teacher_time, student_time = latency(teacher, batch), latency(student, batch)
+    student.train()
+
+    print('student vs teacher: PSNR {:.2f} dB | SSIM {:.4f} | params {:.2f}M vs {:.2f}M | latency {:.1f} ms vs {:.1f} ms (batch {}, {:.1f}x faster)'.format(
+        sum(psnrs) / len(psnrs), sum(ssims) / len(ssims), count_parameters(student) / 1e6, count_parameters(teacher) / 1e6,
+        1000 * student_time, 1000 * teacher_time, batch.size(0), teacher_time / student_time))
+
+
+"""Saves the student in the checkpoint format of cycle_gan.py (G_<direction>_<iteration>_.pkl) together with the
+   generator_config.json that lets load_generator (and so test_cycle_gan.py, serve.py, ...) rebuild it."""
+def checkpoint(iteration, student, opts):
+    with open(os.path.join(opts.checkpoint_dir, 'generator_config.json'), 'w') as f:
+        json.dump({'model': 'StudentGenerator', 'conv_dim': opts.conv_dim, 'n_res_blocks': opts.n_res_blocks}, f)
+    torch.save(student.state_dict(), os.path.join(opts.checkpoint_dir, 'G_' + opts.direction + '_' + str(iteration) + '_.pkl'))
+
+
+"""Trains the student to reproduce the teacher's output on unpaired images of the teacher's input domain
+   (L1 loss on the outputs; the teacher is frozen and run under inference mode)."""
+def distill(opts):
+    domain = opts.X if opts.direction == 'XtoY' else opts.Y
+    train_loader, test_loader = get_data_loader(opts, domain)
+
+    teacher = load_generator(opts.teacher_dir, opts.teacher_iteration, opts.direction).eval()
+    student = StudentGenerator(conv_dim=opts.conv_dim, n_res_blocks=opts.n_res_blocks)
+    if torch.cuda.is_available():
+        teacher.cuda()
+        student.cuda()
+    for param in teacher.parameters():
+        param.requires_grad_(False)
+
+    optimizer = optim.Adam(student.parameters(), opts.lr, [opts.beta1, opts.beta2])
+    L1_loss = nn.L1Loss()
+
+    train_iter = iter(train_loader)
+    for iteration in range(1, opts.train_iters + 1):
+        try:
+            images, _ = next(train_iter)
+        except StopIteration:
+            train_iter = iter(train_loader)
+            images, _ = next(train_iter)
+
+        images = utils.to_var(images)
+        with inference_mode():
+            target = teacher(images)
+
+        loss = L1_loss(student(images), target.clone())
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        if iteration % opts.log_step == 0:
+            print('Iteration [{:5d}/{:5d}] | L1: {:6.4f}'.format(iteration, opts.train_iters, loss.item()))
+
+        if iteration % opts.checkpoint_every == 0 or iteration == opts.train_iters:
+            checkpoint(iteration, student, opts)
+            report(teacher, student, test_loader, opts.report_batches)
+
+
+"""Creates the command-line parser for distillation."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    # Teacher and student
+    parser.add_argument('--teacher_dir', type=str, default='checkpoints_cyclegan')
+    parser.add_argument('--teacher_iteration', type=int, default=37000)
+    parser.add_argument('--direction', type=str, default='YtoX', choices=['XtoY', 'YtoX'])
+    parser.add_argument('--conv_dim', type=int, default=32, help='Base width of the student (the trunk has 4 * conv_dim channels).')
+    parser.add_argument('--n_res_blocks', type=int, default=4, help='Number of depthwise-separable ResNet blocks of the student.')
+
+    # Training hyper-parameters
+    parser.add_argument('--image_size', type=int, default=256, help='The side length N to convert images to NxN.')
+    parser.add_argument('--train_iters', type=int, default=20000)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--lr', type=float, default=0.0002)
+    parser.add_argument('--beta1', type=float, default=0.5)
+    parser.add_argument('--beta2', type=float, default=0.999)
+
+    # Data sources (images of the teacher's input domain)
+    parser.add_argument('--data_dir', type=str, default=os.path.join('/home', 'adithya', 'Breast_Style_Transfer', 'Datasets', 'horse2zebra'))
+    parser.add_argument('--X', type=str, default='A')
+    parser.add_argument('--Y', type=str, default='B')
+
+    # Saving and reporting
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints_student')
+    parser.add_argument('--log_step', type=int, default=10)
+    parser.add_argument('--checkpoint_every', type=int, default=1000)
+    parser.add_argument('--report_batches', type=int, default=8, help='Number of test batches of the speed/fidelity report.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+    utils.create_dir(opts.checkpoint_dir)
+    distill(opts)
@@ -0,0 +1,510 @@
+# Cached-model batch inference for the trained CycleGAN generators
+
+import io
+import os
+import json
+import math
+import time
+import queue
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from PIL import Image
+
+import utils
+from models import build_generator
+from result_cache import file_digest
+
+
+"""Architecture of the generators of a checkpoint directory: the contents of its generator_config.json
+   (written e.g. by distill.py), or None for the CycleGenerator checkpoints written by cycle_gan.py."""
+def load_generator_config(checkpoint_dir):
+    config_path = os.path.join(checkpoint_dir, 'generator_config.json')
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path) as f:
+        return json.load(f)
+
+
+"""Loads one generator (direction 'XtoY' or 'YtoX') from the checkpoint of the given iteration."""
+def load_generator(checkpoint_dir, iteration, direction='YtoX'):
+    G_path = os.path.join(checkpoint_dir, 'G_' + direction + '_' + str(iteration) + '_.pkl')
+    G = build_generator(load_generator_config(checkpoint_dir))
+    G.load_state_dict(torch.load(G_path, map_location=lambda storage, loc: storage))
+    return G
+
+
+"""Context manager that disables autograd bookkeeping (torch.inference_mode where available)."""
+def inference_mode():
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+"""Reads an image as a 3 x H x W float tensor in [0, 1]. Single-band images (the MRI slices) are
+   replicated to three channels, as the generators were trained on three-channel inputs."""
+def load_image(path):
+    return _image_to_tensor(Image.open(path))
+
+
+"""Decodes an encoded image (e.g. the body of an HTTP request) like load_image()."""
+def decode_image(data):
+    return _image_to_tensor(Image.open(io.BytesIO(data)))
+
+
+def _image_to_tensor(image):
+    if len(image.getbands()) == 1:
+        image = np.stack((image, image, image), axis=2)
+    else:
+        image = np.array(image.convert('RGB'))
+
+    #as torchvision's to_tensor (without importing torchvision): C x H x W, uint8 scaled to [0, 1]
+    tensor = torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))
+    if tensor.dtype == torch.uint8:
+        return tensor.float().div(255)
+    return tensor
+
+
+"""Converts a C x H x W generator output to an H x W x C uint8 array, rescaling its min..max range
+   to 0..255 (the same byte scaling scipy.misc.imsave applied)."""
+def to_uint8(image):
+    return hwc_to_uint8(image.detach().permute(1, 2, 0))
+
+
+"""Byte-scales an H x W x C output (e.g. a view of a permuted batch) to uint8."""
+def hwc_to_uint8(image):
+    image = image.float()
+    lo, hi = image.min(), image.max()
+    scale = 255.0 / (hi - lo).clamp(min=1e-12)
+    return ((image - lo) * scale + 0.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+
+
+"""Encodes and writes one C x H x W generator output."""
+def save_image(image, path):
+    Image.fromarray(to_uint8(image)).save(path)
+
+
+"""Encodes and writes one H x W x C generator output."""
+def save_image_hwc(image, path):
+    Image.fromarray(hwc_to_uint8(image)).save(path)
+
+
+"""Encodes one H x W x C generator output to bytes in the given format."""
+def encode_image_hwc(image, format='PNG'):
+    buffer = io.BytesIO()
+    Image.fromarray(hwc_to_uint8(image)).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+"""PIL format name for the extension of an output path (PNG if unknown)."""
+def image_format(path):
+    return Image.registered_extensions().get(os.path.splitext(path)[1].lower(), 'PNG')
+
+
+"""True if output_path exists and was written after the checkpoint it would be generated from."""
+def is_up_to_date(output_path, checkpoint_mtime):
+    try:
+        return os.path.getmtime(output_path) > checkpoint_mtime
+    except OSError:
+        return False
+
+
+"""Size (width, height) of an image, read from its header without decoding the pixels."""
+def image_size(path):
+    with Image.open(path) as image:
+        return image.size
+
+
+"""Returns (margin, stride) of a fully convolutional model: margin is the number of input pixels on each side
+   that can influence an output pixel (accumulated over the convolutions, strided convolutions and transposed
+   convolutions in registration order), stride is the largest downsampling factor inside the model.
+   Works for 2D and 3D models (the kernels are assumed to be the same size along every axis).
+   Reflection pads add no context of their own; their effect is covered by the kernel of the following conv.
+"""
+def receptive_field(model):
+    margin, jump, stride = 0.0, 1.0, 1.0
+    for module in model.modules():
+        if isinstance(module, (nn.Conv2d, nn.Conv3d)):
+            margin += (module.kernel_size[0] - 1) / 2.0 * module.dilation[0] * jump
+            jump *= module.stride[0]
+        elif isinstance(module, (nn.ConvTranspose2d, nn.ConvTranspose3d)):
+            margin += math.ceil((module.kernel_size[0] - 1) / 2.0 / module.stride[0]) * jump
+            jump /= module.stride[0]
+        stride = max(stride, jump)
+    return int(math.ceil(margin)), int(stride)
+
+
+"""Estimate of the activation memory (bytes) a forward pass needs per input pixel: four live float32
+   feature maps at the densest layer (channels per input pixel). For CycleGenerator this gives 1 KB/px,
+   slightly above the ~0.9 KB/px peak measured on CPU under inference mode."""
+def activation_bytes_per_pixel(model, live_maps=4):
+    density, jump = 3.0, 1.0
+    for module in model.modules():
+        if isinstance(module, nn.Conv2d):
+            jump *= module.stride[0]
+            density = max(density, module.out_channels / jump**2)
+        elif isinstance(module, nn.ConvTranspose2d):
+            jump /= module.stride[0]
+            density = max(density, module.out_channels / jump**2)
+    return 4.0 * live_maps * density
+
+
+#Starts of the tiles covering [0, size): tile-sized windows stepping by step, the last one flush with the end
+def _tile_starts(size, tile, step):
+    if tile >= size:
+        return [0]
+    starts = list(range(0, size - tile, step))
+    return starts + [size - tile]
+
+
+#Feathered blending weights along one axis: ~0 within margin/2 of an interior tile edge, ramping to 1 over margin pixels
+def _feather(length, margin, lead, trail):
+    w = torch.ones(length)
+    ramp = ((torch.arange(2 * margin, dtype=torch.float32) - margin / 2.0) / max(margin, 1)).clamp(1e-3, 1)
+    if lead:
+        w[:2 * margin] = torch.min(w[:2 * margin], ramp)
+    if trail:
+        w[length - 2 * margin:] = torch.min(w[length - 2 * margin:], ramp.flip(0))
+    return w
+
+
+"""Reflect-pads a C x H x W image on the bottom/right to a multiple of stride."""
+def pad_to_stride(x, stride):
+    _, H, W = x.shape
+    return F.pad(x[None], (0, (-W) % stride, 0, (-H) % stride), mode='reflect')[0]
+
+
+"""Rounds a tile size to the model stride, keeping it at least 4 margins (so that at most half of each tile is overlap)."""
+def round_tile_size(tile, margin, stride):
+    return max(tile // stride * stride, 4 * margin + (-(4 * margin)) % stride)
+
+
+"""Overlapping tiles of at most tile x tile covering an Hp x Wp (stride-padded) image, each extending margin pixels
+   beyond the part it contributes. Returns (th, tw, [(y, z), ...]) with the tile height, width and top-left corners."""
+def tile_layout(Hp, Wp, tile, margin, stride):
+    th, tw = min(tile, Hp), min(tile, Wp)
+    step_h = max((th - 2 * margin) // stride * stride, stride)
+    step_w = max((tw - 2 * margin) // stride * stride, stride)
+    return th, tw, [(y, z) for y in _tile_starts(Hp, th, step_h) for z in _tile_starts(Wp, tw, step_w)]
+
+
+"""Feathered 1 x th x tw blending weights of the tile at (y, z) in an Hp x Wp image (full weight on image borders)."""
+def tile_weight(y, z, th, tw, Hp, Wp, margin):
+    return (_feather(th, margin, y > 0, y + th < Hp)[:, None] * _feather(tw, margin, z > 0, z + tw < Wp)[None, :])[None]
+
+
+"""Runs a fully convolutional model on one C x H x W image in overlapping tiles sized to memory_budget (bytes).
+   Tiles extend by the model's receptive-field margin around the part they contribute, are run tile_batch at a time,
+   and are blended with feathered weights. InstanceNorm statistics are per tile, so the result approaches
+   full-frame inference as the budget (and with it the tile size) grows.
+   Activation memory is bounded by the budget; only the C x H x W output accumulator scales with the image.
+"""
+def tiled_forward(model, x, memory_budget, tile_batch=4):
+    device = next(model.parameters()).device
+    margin, stride = receptive_field(model)
+    bytes_per_pixel = activation_bytes_per_pixel(model)
+
+    #1. Pad to a multiple of the model stride so that the output has the size of the input
+    _, H, W = x.shape
+    x = pad_to_stride(x, stride)
+    _, Hp, Wp = x.shape
+
+    #2. Tile size from the memory budget
+    tile = round_tile_size(int(math.sqrt(memory_budget / (bytes_per_pixel * tile_batch))), margin, stride)
+    if Hp <= tile and Wp <= tile:
+        return model(x[None].to(device))[0, :, :H, :W].cpu()
+
+    th, tw, tiles = tile_layout(Hp, Wp, tile, margin, stride)
+
+    #3. Run the tiles in batches and blend them into the output
+    out, weight = None, torch.zeros(1, Hp, Wp)
+
+    for start in range(0, len(tiles), tile_batch):
+        chunk = tiles[start:start + tile_batch]
+        batch = torch.stack([x[:, y:y + th, z:z + tw] for y, z in chunk]).to(device)
+        result = model(batch).float().cpu()
+
+        if out is None:
+            out = torch.zeros(result.size(1), Hp, Wp)
+
+        for tile_out, (y, z) in zip(result, chunk):
+            w = tile_weight(y, z, th, tw, Hp, Wp, margin)
+            out[:, y:y + th, z:z + tw] += tile_out * w
+            weight[:, y:y + th, z:z + tw] += w
+
+    return (out / weight)[:, :H, :W]
+
+
+"""Loads the generators once and runs them over many images.
+   Inputs of equal size are decoded and run as one batch under inference mode,
+   and outputs are encoded and written by a pool of writer threads.
+   With a memory_budget (bytes), every image is instead run in overlapping tiles (see tiled_forward).
+   With quantized=True, the int8 TorchScript generators written by quantize.py are run on the CPU instead.
+   With optimize=True, the float generators are rewritten by inference_graph.optimize_for_inference.
+   With a ResultCache, inputs whose output is cached are copied from the cache without being decoded,
+   and every new output is added to it.
+
+   Usage:
+        engine = InferenceEngine('checkpoints_cyclegan', 37000)
+        engine.stylize_dir('test_images', 'test_paintings', direction='YtoX')
+        engine.close()
+"""
+class InferenceEngine():
+    def __init__(self, checkpoint_dir, iteration, directions=('YtoX',), batch_size=8, num_writers=4, device=None, memory_budget=None, tile_batch=4, quantized=False, cache=None, optimize=False):
+        if quantized and memory_budget:
+            raise ValueError('Tiled inference is not supported for quantized generators.')
+
+        self.checkpoint_dir = checkpoint_dir
+        self.iteration = iteration
+        self.batch_size = batch_size
+        self.memory_budget = memory_budget
+        self.tile_batch = tile_batch
+        self.quantized = quantized
+        self.optimize = optimize and not quantized
+        if quantized:
+            device = 'cpu'
+        self.device = torch.device(device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.cache = cache
+        self.checkpoint_digests = {}
+        self.profiler = None
+        self.step = 0
+
+        self.generators = collections.OrderedDict()
+        for direction in directions:
+            self.generator(direction)
+
+        self.writers = ThreadPoolExecutor(max_workers=num_writers)
+        self.pending_writes = threading.BoundedSemaphore(4 * num_writers)
+        self.write_futures = []
+
+    def checkpoint_path(self, direction):
+        if self.quantized:
+            return os.path.join(self.checkpoint_dir, 'G_' + direction + '_' + str(self.iteration) + '_int8.pt')
+        return os.path.join(self.checkpoint_dir, 'G_' + direction + '_' + str(self.iteration) + '_.pkl')
+
+    """SHA-256 of the checkpoint file of a direction (computed once)."""
+    def checkpoint_digest(self, direction):
+        if direction not in self.checkpoint_digests:
+            self.checkpoint_digests[direction] = file_digest(self.checkpoint_path(direction))
+        return self.checkpoint_digests[direction]
+
+    """Result cache key of one input (raw file bytes) whose output is encoded in the given format."""
+    def cache_key(self, data, direction, format='PNG'):
+        settings = {'format': format, 'quantized': self.quantized, 'optimize': self.optimize, 'device': self.device.type,
+                    'memory_budget': self.memory_budget or 0, 'tile_batch': self.tile_batch if self.memory_budget else 0}
+        return self.cache.key(data, self.checkpoint_digest(direction), direction, settings)
+
+    """Returns the cached generator for a direction, loading it on first use."""
+    def generator(self, direction):
+        if direction not in self.generators:
+            if self.quantized:
+                from quantize import load_quantized
+                self.generators[direction] = load_quantized(self.checkpoint_path(direction))
+                return self.generators[direction]
+
+            G = load_generator(self.checkpoint_dir, self.iteration, direction)
+            G.to(self.device).eval()
+            for param in G.parameters():
+                param.requires_grad_(False)
+            if self.optimize:
+                from inference_graph import optimize_for_inference
+                G = optimize_for_inference(G)
+            self.generators[direction] = G
+        return self.generators[direction]
+
+    """Runs a N x 3 x H x W batch through the generator of the given direction."""
+    def stylize(self, batch, direction='YtoX'):
+        G = self.generator(direction)
+        with inference_mode():
+            if self.memory_budget:
+                return torch.stack([tiled_forward(G, x, self.memory_budget, self.tile_batch) for x in batch])
+            return G(batch.to(self.device))
+
+    """Stylizes the images in paths and writes them to output_paths, batching images of equal size."""
+    def stylize_files(self, paths, output_paths, direction='YtoX'):
+        groups = collections.OrderedDict()
+        for path, output_path in zip(paths, output_paths):
+            key = None
+            if self.cache is not None:
+                with open(path, 'rb') as f:
+                    key = self.cache_key(f.read(), direction, image_format(output_path))
+                if self.cache.copy_to(key, output_path):
+                    continue
+            groups.setdefault(image_size(path), []).append((path, output_path, key))
+
+        #tiled images are run one at a time (the tiles of each image form the batches)
+        batch_size = 1 if self.memory_budget else self.batch_size
+
+        self.step = 0
+        for jobs in groups.values():
+            for start in range(0, len(jobs), batch_size):
+                chunk = jobs[start:start + batch_size]
+                self._run_batch([load_image(job[0]) for job in chunk], [job[1] for job in chunk], direction, [job[2] for job in chunk])
+
+        self.flush()
+
+    """Stylizes every image in img_dir into output_dir (keeping the file names)."""
+    def stylize_dir(self, img_dir, output_dir, direction='YtoX'):
+        utils.create_dir(output_dir)
+        names = sorted(os.listdir(img_dir))
+        self.stylize_files([os.path.join(img_dir, name) for name in names], [os.path.join(output_dir, name) for name in names], direction)
+
+    """Streaming variant of stylize_dir for very large directories. A pool of decode threads feeds a bounded queue;
+       the model consumes it in batches of equally sized images while the writer threads encode the outputs.
+       Outputs that exist and are newer than the checkpoint are skipped, and result cache hits are copied by the
+       decode threads without decoding. Returns (processed, skipped, seconds); processed includes cache hits.
+       At most queue_depth decoded images wait in the queue and at most max_buffered (default queue_depth) in
+       partially filled size groups; past that, the group holding the most pixels is run as a smaller batch.
+    """
+    def stylize_dir_pipelined(self, img_dir, output_dir, direction='YtoX', decode_workers=4, queue_depth=64, skip_existing=True, max_buffered=None):
+        start_time = time.time()
+        utils.create_dir(output_dir)
+        checkpoint_mtime = os.path.getmtime(self.checkpoint_path(direction))
+
+        jobs, skipped = [], 0
+        for name in sorted(entry.name for entry in os.scandir(img_dir) if entry.is_file()):
+            output_path = os.path.join(output_dir, name)
+            if skip_existing and is_up_to_date(output_path, checkpoint_mtime):
+                skipped += 1
+            else:
+                jobs.append((os.path.join(img_dir, name), output_path))
+
+        #1. Decode: futures are queued in input order; the queue bound limits the number of decoded images in flight
+        decoded = queue.Queue(maxsize=queue_depth)
+        decoders = ThreadPoolExecutor(max_workers=decode_workers)
+        stop = threading.Event()
+
+        def produce():
+            for path, output_path in jobs:
+                if stop.is_set():
+                    return
+                decoded.put((decoders.submit(self._load, path, output_path, direction), path, output_path))
+            decoded.put(None)
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+
+        #2. Infer: group decoded images by size and run each group once it holds a full batch
+        batch_size = 1 if self.memory_budget else self.batch_size
+        max_buffered = queue_depth if max_buffered is None else max_buffered
+        buckets = collections.OrderedDict()
+        processed, cached, buffered = 0, 0, 0
+        self.step = 0
+
+        def run(shape):
+            bucket = buckets.pop(shape)
+            self._run_batch([b[0] for b in bucket], [b[1] for b in bucket], direction, [b[2] for b in bucket])
+            return len(bucket)
+
+        try:
+            while True:
+                item = decoded.get()
+                if item is None:
+                    break
+
+                future, path, output_path = item
+                try:
+                    loaded = future.result()
+                except Exception as e:
+                    print('Skipping {}: {}'.format(path, e))
+                    continue
+
+                if loaded is None:
+                    cached += 1
+                    continue
+
+                x, key = loaded
+                bucket = buckets.setdefault(tuple(x.shape), [])
+                bucket.append((x, output_path, key))
+                buffered += 1
+                if len(bucket) == batch_size:
+                    done = run(tuple(x.shape))
+                    processed, buffered = processed + done, buffered - done
+
+                #many distinct sizes: run the partial group holding the most pixels rather than buffer without bound
+                elif buffered > max_buffered:
+                    largest = max(buckets, key=lambda shape: len(buckets[shape]) * int(np.prod(shape)))
+                    done = run(largest)
+                    processed, buffered = processed + done, buffered - done
+
+            for shape in list(buckets):
+                processed += run(shape)
+            processed += cached
+
+            #3. Encode: wait for the writer threads
+            self.flush()
+        finally:
+            #on failure, unblock and stop the producer and drop the decodes that have not started
+            stop.set()
+            while producer.is_alive():
+                try:
+                    item = decoded.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is not None:
+                    item[0].cancel()
+            decoders.shutdown(cancel_futures=True)
+
+        seconds = time.time() - start_time
+        print('Stylized {} images ({} from the result cache, {} up to date) in {:.1f}s ({:.1f} images/s)'.format(processed, cached, skipped, seconds, processed / max(seconds, 1e-9)))
+        return processed, skipped, seconds
+
+    #Runs in a decode thread: None if the output was copied from the result cache, else (3 x H x W tensor, cache key)
+    def _load(self, path, output_path, direction):
+        if self.cache is None:
+            return load_image(path), None
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = self.cache_key(data, direction, image_format(output_path))
+        if self.cache.copy_to(key, output_path):
+            return None
+        return decode_image(data), key
+
+    #Runs one batch of equally sized 3 x H x W tensors and queues the outputs for writing (and caching, with keys)
+    def _run_batch(self, tensors, output_paths, direction, keys=None):
+        self.step += 1
+        if self.profiler is not None:
+            self.profiler.step_begin(self.step)
+
+        outputs = self.stylize(torch.stack(tensors), direction)
+
+        #one permute of the whole batch to N x H x W x C (a view, no copy)
+        for output, output_path, key in zip(outputs.cpu().permute(0, 2, 3, 1), output_paths, keys or [None] * len(output_paths)):
+            self._write(output, output_path, key)
+
+        if self.profiler is not None:
+            self.profiler.step_end(self.step)
+
+    def _write(self, output, output_path, key=None):
+        self.pending_writes.acquire()
+        future = self.writers.submit(self._save, output, output_path, key)
+        future.add_done_callback(lambda f: self.pending_writes.release())
+        self.write_futures.append(future)
+
+    #Runs in a writer thread
+    def _save(self, output, output_path, key):
+        if key is None:
+            save_image_hwc(output, output_path)
+            return
+
+        data = encode_image_hwc(output, image_format(output_path))
+        with open(output_path, 'wb') as f:
+            f.write(data)
+        self.cache.put(key, data)
+
+    """Waits for all queued writes and re-raises the first write error, if any."""
+    def flush(self):
+        futures, self.write_futures = self.write_futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.flush()
+        self.writers.shutdown()
@@ -0,0 +1,165 @@
+# Export step that rewrites a trained generator into a leaner inference-only module
+
+import copy
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+from models import ResnetBlock2d, SeparableResnetBlock2d
+from inference import load_generator, inference_mode
+
+
+"""Returns a copy of an nn.Sequential in which every ReflectionPad2d directly followed by an unpadded Conv2d is
+   folded into that convolution (padding_mode='reflect'). Other modules are copied as they are."""
+def fold_reflection_pads(module):
+    if not isinstance(module, nn.Sequential):
+        return module
+
+    layers = list(module.children())
+    folded = []
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        following = layers[i + 1] if i + 1 < len(layers) else None
+
+        if (isinstance(layer, nn.ReflectionPad2d) and isinstance(following, nn.Conv2d) and following.padding == (0, 0)
+                and len(set(layer.padding)) == 1):
+            pad = layer.padding[0]
+            conv = nn.Conv2d(following.in_channels, following.out_channels, following.kernel_size, following.stride, pad,
+                             following.dilation, following.groups, following.bias is not None, padding_mode='reflect')
+            conv.weight = following.weight
+            conv.bias = following.bias
+            folded.append(conv)
+            i += 2
+        else:
+            folded.append(fold_reflection_pads(layer))
+            i += 1
+
+    return nn.Sequential(*folded)
+
+
+"""Inference-only version of a generator whose child modules run in registration order, each followed by a ReLU
+   except the last, which is followed by tanh (CycleGenerator and StudentGenerator).
+   - reflection pads are folded into the convolutions that follow them (padding_mode='reflect'),
+   - ResNet block sums are accumulated into the block output and ReLU/tanh are applied in place (every layer
+     ends in a freshly allocated tensor, so nothing that is still needed is overwritten),
+   - parameters are frozen and the module is meant to be run under inference mode.
+   Use optimize_for_inference() to build one; it checks equivalence with the original.
+"""
+class InferenceGenerator(nn.Module):
+    def __init__(self, G):
+        super(InferenceGenerator, self).__init__()
+        children = [copy.deepcopy(child) for child in G.children()]
+
+        self.layers = nn.ModuleList()
+        self.residual = []
+        for child in children[:-1]:
+            if isinstance(child, (ResnetBlock2d, SeparableResnetBlock2d)):
+                child.conv_layer = fold_reflection_pads(child.conv_layer)
+                self.layers.append(child.conv_layer)
+                self.residual.append(True)
+            else:
+                self.layers.append(fold_reflection_pads(child))
+                self.residual.append(False)
+        self.output_layer = fold_reflection_pads(children[-1])
+
+    def forward(self, x):
+        out = x
+        for layer, residual in zip(self.layers, self.residual):
+            if residual:
+                h = layer(out)
+                h += out
+                out = h.relu_()
+            else:
+                out = layer(out).relu_()
+        return self.output_layer(out).tanh_()
+
+
+"""Builds the InferenceGenerator of a generator, frozen and in eval mode, and checks that it matches the original
+   on a random input of the given size (raises ValueError beyond atol)."""
+def optimize_for_inference(G, check_size=64, atol=1e-4):
+    G.eval()
+    optimized = InferenceGenerator(G).eval()
+    for param in optimized.parameters():
+        param.requires_grad_(False)
+
+    device = next(G.parameters()).device
+    error = max_difference(G, optimized, torch.rand(1, 3, check_size, check_size, device=device) * 2 - 1)
+    if error > atol:
+        raise ValueError('Optimized generator differs from the original by {:.2e} (> {:.0e}).'.format(error, atol))
+    return optimized
+
+
+"""Maximum absolute difference between the outputs of two models on x."""
+def max_difference(a, b, x):
+    with inference_mode():
+        return (a(x) - b(x)).abs().max().item()
+
+
+"""Traces, freezes and saves an optimized generator as a standalone TorchScript file."""
+def export_torchscript(optimized, example, path):
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(optimized, example))
+    torch.jit.save(scripted, path)
+    print('Saved {}'.format(path))
+    return scripted
+
+
+"""Mean latency (s) of a forward pass under inference mode, after warm-up."""
+def latency(model, x, repeats=5):
+    with inference_mode():
+        model(x)
+        model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(repeats):
+            model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize()
+    return (time.time() - start) / repeats
+
+
+"""Checks numerical equivalence and compares the latency of the original generator (run under no_grad, as the
+   inference scripts used to), the optimized module and its frozen TorchScript version at several sizes."""
+def main(opts):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    G = load_generator(opts.checkpoint_dir, opts.iteration, opts.direction).to(device).eval()
+    optimized = optimize_for_inference(G, atol=opts.atol)
+
+    for size in opts.sizes:
+        x = torch.rand(opts.batch_size, 3, size, size, device=device) * 2 - 1
+        scripted = export_torchscript(optimized, x, opts.export) if opts.export else torch.jit.freeze(torch.jit.trace(optimized, x))
+
+        error = max(max_difference(G, optimized, x), max_difference(G, scripted, x))
+        print('{}x{} (batch {}): max |difference| {:.2e} ({})'.format(size, size, opts.batch_size, error, 'ok' if error <= opts.atol else 'FAILED'))
+
+        with torch.no_grad():
+            baseline = latency(G, x, opts.repeats)
+        for name, model in (('optimized', optimized), ('optimized + frozen TorchScript', scripted)):
+            t = latency(model, x, opts.repeats)
+            print('    original {:8.1f} ms | {} {:8.1f} ms | speedup {:.2f}x'.format(1000 * baseline, name, 1000 * t, baseline / t))
+
+
+"""Creates the command-line parser for the inference graph export."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints_cyclegan')
+    parser.add_argument('--iteration', type=int, default=37000)
+    parser.add_argument('--direction', type=str, default='YtoX', choices=['XtoY', 'YtoX'])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512], help='Input sizes to check and time.')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--atol', type=float, default=1e-4, help='Maximum allowed absolute difference to the original outputs.')
+    parser.add_argument('--export', type=str, default=None, help='Also save the frozen TorchScript module to this path.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+    main(opts)
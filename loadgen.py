@@ -0,0 +1,111 @@
+# Open-loop load generator for serve.py: measures p50/p99 latency against offered throughput
+
+import os
+import time
+import random
+import asyncio
+import argparse
+import collections
+import urllib.parse
+
+import numpy as np
+
+
+#Sends one HTTP/1.1 POST and returns (status, body)
+async def post(host, port, path, body):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(('POST {} HTTP/1.1\r\nHost: {}:{}\r\nContent-Type: application/octet-stream\r\n'
+                      'Content-Length: {}\r\nConnection: close\r\n\r\n').format(path, host, port, len(body)).encode('latin-1') + body)
+        await writer.drain()
+
+        status = int((await reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        return status, await reader.readexactly(length)
+    finally:
+        writer.close()
+
+
+"""Offers requests at the given rate (Poisson arrivals) for duration seconds, independently of how fast
+   the server answers, and returns the latencies of the successful requests and a count per outcome."""
+async def run_rate(url, bodies, rate, duration, timeout):
+    parts = urllib.parse.urlsplit(url)
+    outcomes = collections.Counter()
+    latencies = []
+
+    async def one(body):
+        start = time.time()
+        try:
+            status, _ = await asyncio.wait_for(post(parts.hostname, parts.port or 80, parts.path + ('?' + parts.query if parts.query else ''), body), timeout)
+        except asyncio.TimeoutError:
+            outcomes['timeout'] += 1
+            return
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+            outcomes['error'] += 1
+            return
+
+        outcomes[status] += 1
+        if status == 200:
+            latencies.append(time.time() - start)
+
+    tasks = []
+    start = time.time()
+    next_arrival = start
+    while next_arrival < start + duration:
+        await asyncio.sleep(max(0.0, next_arrival - time.time()))
+        tasks.append(asyncio.ensure_future(one(random.choice(bodies))))
+        next_arrival += random.expovariate(rate)
+
+    await asyncio.gather(*tasks)
+    return latencies, outcomes, time.time() - start
+
+
+async def main(opts):
+    names = sorted(os.listdir(opts.images))[:opts.num_images]
+    bodies = []
+    for name in names:
+        with open(os.path.join(opts.images, name), 'rb') as f:
+            bodies.append(f.read())
+
+    url = opts.url.rstrip('/') + '/stylize?direction=' + opts.direction
+    random.seed(opts.seed)
+
+    print('{:>10} {:>10} {:>10} {:>10} {:>10} {:>8} {:>8}'.format('offered/s', 'served/s', 'p50 ms', 'p99 ms', 'max ms', '503', 'failed'))
+    for rate in opts.rates:
+        latencies, outcomes, seconds = await run_rate(url, bodies, rate, opts.duration, opts.timeout)
+        failed = sum(count for outcome, count in outcomes.items() if outcome not in (200, 503))
+
+        if latencies:
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            print('{:10.1f} {:10.1f} {:10.1f} {:10.1f} {:10.1f} {:8d} {:8d}'.format(rate, len(latencies) / seconds, p50, p99, max(latencies) * 1000, outcomes[503], failed))
+        else:
+            print('{:10.1f} {:10.1f} {:>10} {:>10} {:>10} {:8d} {:8d}'.format(rate, 0.0, '-', '-', '-', outcomes[503], failed))
+
+
+"""Creates the command-line parser for the load generator."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--images', type=str, required=True, help='Directory of image files sent as request bodies.')
+    parser.add_argument('--num_images', type=int, default=32)
+    parser.add_argument('--direction', type=str, default='YtoX', choices=['XtoY', 'YtoX'])
+    parser.add_argument('--rates', type=float, nargs='+', default=[1, 2, 4, 8, 16], help='Offered request rates (requests/s) to measure.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of load per rate.')
+    parser.add_argument('--timeout', type=float, default=60, help='Per-request timeout in seconds.')
+    parser.add_argument('--seed', type=int, default=0)
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+    asyncio.run(main(opts))
@@ -0,0 +1,42 @@
+# Image quality metrics used to compare generator variants against the fp32 CycleGenerator
+
+import torch
+import torch.nn.functional as F
+
+
+"""Peak signal-to-noise ratio (dB) between two N x C x H x W batches, averaged over the batch.
+   data_range is the span of the values (2 for the generators' tanh outputs)."""
+def psnr(x, y, data_range=2.0):
+    mse = ((x.float() - y.float())**2).flatten(1).mean(1).clamp(min=1e-12)
+    return (10 * torch.log10(data_range**2 / mse)).mean().item()
+
+
+#Normalized 1D Gaussian kernel
+def _gaussian(size, sigma):
+    coords = torch.arange(size, dtype=torch.float32) - (size - 1) / 2.0
+    g = torch.exp(-coords**2 / (2 * sigma**2))
+    return g / g.sum()
+
+
+"""Structural similarity (Wang et al. 2004) between two N x C x H x W batches, with an 11x11 Gaussian window
+   (sigma 1.5) applied per channel, averaged over channels, pixels and the batch."""
+def ssim(x, y, data_range=2.0, window_size=11, sigma=1.5):
+    x, y = x.float(), y.float()
+    channels = x.size(1)
+
+    g = _gaussian(window_size, sigma).to(x.device)
+    window = (g[:, None] * g[None, :]).expand(channels, 1, window_size, window_size).contiguous()
+
+    def blur(t):
+        return F.conv2d(t, window, groups=channels)
+
+    c1 = (0.01 * data_range)**2
+    c2 = (0.03 * data_range)**2
+
+    mu_x, mu_y = blur(x), blur(y)
+    sigma_x = blur(x * x) - mu_x**2
+    sigma_y = blur(y * y) - mu_y**2
+    sigma_xy = blur(x * y) - mu_x * mu_y
+
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * sigma_xy + c2)) / ((mu_x**2 + mu_y**2 + c1) * (sigma_x + sigma_y + c2))
+    return ssim_map.mean().item()
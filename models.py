@@ -6,6 +6,11 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+try:
+    from torch.func import functional_call, vmap
+except ImportError:
+    functional_call, vmap = None, None
+
 #########################################
 ################2D MODELS###############
 #########################################
@@ -54,33 +59,36 @@ class ResnetBlock2d(nn.Module):
         out = x + self.conv_layer(x)
         return out
 
-"""Defines the architecture of the generator network (both generators G_XtoY an G_YtoX have the same architecture)."""
+"""Defines the architecture of the generator network (both generators G_XtoY an G_YtoX have the same architecture).
+   conv_dim is the width of the first layer, doubled by each of the n_downsampling strided convolutions (the trunk of
+   n_res_blocks ResNet blocks has conv_dim * 2**n_downsampling channels) and halved again by each transposed convolution.
+   The defaults (64, 9, 2) are the original architecture, and the layer names (conv1..conv<n_downsampling + 1>,
+   resnet_block1.., deconv2d_1.., conv<n_downsampling + 2>) keep its checkpoints loadable.
+"""
 class CycleGenerator(nn.Module):
-    def __init__(self, init_zero_weights=False):
+    def __init__(self, init_zero_weights=False, conv_dim=64, n_res_blocks=9, n_downsampling=2):
         super(CycleGenerator, self).__init__()
+        self.conv_dim = conv_dim
+        self.n_res_blocks = n_res_blocks
+        self.n_downsampling = n_downsampling
 
         ####   GENERATOR ARCHITECTURE   ####
 
         # 1. Define the encoder part of the generator (that extracts features from the input image)
-        self.conv1 = conv2d(in_channels=3, out_channels=64, kernel_size=7, stride=1, padding=0, reflect_pad=True)
-        self.conv2 = conv2d(in_channels=64, out_channels=128, kernel_size=5, stride=2, padding=2) #prev kernel_size = 3, padding = 1
-        self.conv3 = conv2d(in_channels=128, out_channels=256, kernel_size=3, stride=2, padding=1)
+        self.conv1 = conv2d(in_channels=3, out_channels=conv_dim, kernel_size=7, stride=1, padding=0, reflect_pad=True)
+        for i in range(n_downsampling):
+            kernel_size = 5 if i == 0 else 3 #first downsampling: prev kernel_size = 3, padding = 1
+            setattr(self, 'conv' + str(i + 2), conv2d(in_channels=conv_dim * 2**i, out_channels=conv_dim * 2**(i + 1), kernel_size=kernel_size, stride=2, padding=kernel_size // 2))
 
         # 2. Define the transformation part of the generator
-        self.resnet_block1 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block2 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block3 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block4 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block5 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block6 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block7 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block8 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block9 = ResnetBlock2d(conv_dim=256)
+        for i in range(1, n_res_blocks + 1):
+            setattr(self, 'resnet_block' + str(i), ResnetBlock2d(conv_dim=conv_dim * 2**n_downsampling))
 
         # 3. Define the decoder part of the generator (that builds up the output image from features)
-        self.deconv2d_1 = deconv2d(in_channels=256, out_channels=128, kernel_size=3, stride=2, padding=1, output_padding=1)
-        self.deconv2d_2 = deconv2d(in_channels=128, out_channels=64, kernel_size=5, stride=2, padding=2, output_padding=1) #prev kernel_size = 3, padding = 1
-        self.conv4 = conv2d(in_channels=64, out_channels=3, kernel_size=7, stride=1, padding=0, reflect_pad=True, instance_norm=False)
+        for i in range(n_downsampling):
+            kernel_size = 5 if i == n_downsampling - 1 else 3 #last upsampling: prev kernel_size = 3, padding = 1
+            setattr(self, 'deconv2d_' + str(i + 1), deconv2d(in_channels=conv_dim * 2**(n_downsampling - i), out_channels=conv_dim * 2**(n_downsampling - i - 1), kernel_size=kernel_size, stride=2, padding=kernel_size // 2, output_padding=1))
+        setattr(self, 'conv' + str(n_downsampling + 2), conv2d(in_channels=conv_dim, out_channels=3, kernel_size=7, stride=1, padding=0, reflect_pad=True, instance_norm=False))
 
     def forward(self, x):
         """Generates an image conditioned
@@ -95,130 +103,321 @@ class CycleGenerator(nn.Module):
                 out: batch_size x 1 x N x N
         """
 
+        out = F.relu(self.conv1(x))
+        for i in range(self.n_downsampling):
+            out = F.relu(getattr(self, 'conv' + str(i + 2))(out))
+
+        for i in range(1, self.n_res_blocks + 1):
+            out = F.relu(getattr(self, 'resnet_block' + str(i))(out))
+
+        for i in range(1, self.n_downsampling + 1):
+            out = F.relu(getattr(self, 'deconv2d_' + str(i))(out))
+        out = F.tanh(getattr(self, 'conv' + str(self.n_downsampling + 2))(out))
+
+        return out
+
+
+"""Creates a depthwise-separable convolutional layer (a per-channel k x k convolution followed by a 1x1 convolution), with optional instance normalization."""
+def separable_conv2d(in_channels, out_channels, kernel_size, stride=1, padding=1, instance_norm=True):
+    layers = []
+    layers.append(nn.Conv2d(in_channels, in_channels, kernel_size, stride, padding, groups=in_channels, bias=False))
+    layers.append(nn.Conv2d(in_channels, out_channels, 1, bias=False))
+
+    if instance_norm:
+       layers.append(nn.InstanceNorm2d(out_channels))
+
+    return nn.Sequential(*layers)
+
+
+"""ResNet block made of two depthwise-separable 3x3 convolutions."""
+class SeparableResnetBlock2d(nn.Module):
+    def __init__(self, conv_dim):
+        super(SeparableResnetBlock2d, self).__init__()
+        self.conv_layer = nn.Sequential(separable_conv2d(conv_dim, conv_dim, 3), nn.ReLU(inplace=True), separable_conv2d(conv_dim, conv_dim, 3))
+
+    def forward(self, x):
+        out = x + self.conv_layer(x)
+        return out
+
+
+"""Lightweight generator distilled from a trained CycleGenerator (see distill.py). Same encoder / trunk / decoder
+   layout and 4x downsampling as CycleGenerator, with conv_dim base channels (conv_dim, 2 * conv_dim, 4 * conv_dim
+   in the trunk instead of 64, 128, 256) and n_res_blocks depthwise-separable ResNet blocks."""
+class StudentGenerator(nn.Module):
+    def __init__(self, conv_dim=32, n_res_blocks=4):
+        super(StudentGenerator, self).__init__()
+        self.n_res_blocks = n_res_blocks
+
+        self.conv1 = conv2d(in_channels=3, out_channels=conv_dim, kernel_size=7, stride=1, padding=0, reflect_pad=True)
+        self.conv2 = conv2d(in_channels=conv_dim, out_channels=2 * conv_dim, kernel_size=5, stride=2, padding=2)
+        self.conv3 = conv2d(in_channels=2 * conv_dim, out_channels=4 * conv_dim, kernel_size=3, stride=2, padding=1)
+
+        for i in range(1, n_res_blocks + 1):
+            setattr(self, 'resnet_block' + str(i), SeparableResnetBlock2d(conv_dim=4 * conv_dim))
+
+        self.deconv2d_1 = deconv2d(in_channels=4 * conv_dim, out_channels=2 * conv_dim, kernel_size=3, stride=2, padding=1, output_padding=1)
+        self.deconv2d_2 = deconv2d(in_channels=2 * conv_dim, out_channels=conv_dim, kernel_size=5, stride=2, padding=2, output_padding=1)
+        self.conv4 = conv2d(in_channels=conv_dim, out_channels=3, kernel_size=7, stride=1, padding=0, reflect_pad=True, instance_norm=False)
+
+    def forward(self, x):
         out = F.relu(self.conv1(x))
         out = F.relu(self.conv2(out))
         out = F.relu(self.conv3(out))
 
-        out = F.relu(self.resnet_block1(out))
-        out = F.relu(self.resnet_block2(out))
-        out = F.relu(self.resnet_block3(out))
-        out = F.relu(self.resnet_block4(out))
-        out = F.relu(self.resnet_block5(out))
-        out = F.relu(self.resnet_block6(out))
-        out = F.relu(self.resnet_block7(out))
-        out = F.relu(self.resnet_block8(out))
-        out = F.relu(self.resnet_block9(out))
+        for i in range(1, self.n_res_blocks + 1):
+            out = F.relu(getattr(self, 'resnet_block' + str(i))(out))
 
         out = F.relu(self.deconv2d_1(out))
         out = F.relu(self.deconv2d_2(out))
-        out = F.tanh(self.conv4(out))
+        out = torch.tanh(self.conv4(out))
 
         return out
 
 
-#XNet encoder
+#XNet encoder (conv_dim, n_res_blocks and n_downsampling as in CycleGenerator)
 class XNetEncoder(nn.Module):
-    def __init__(self, init_zero_weights=False):
+    def __init__(self, init_zero_weights=False, conv_dim=64, n_res_blocks=9, n_downsampling=2):
         super(XNetEncoder, self).__init__()
+        self.n_res_blocks = n_res_blocks
+        self.n_downsampling = n_downsampling
 
         # 1. Define the encoder part of the generator (that extracts features from the input image)
-        self.conv1 = conv2d(in_channels=3, out_channels=64, kernel_size=7, stride=1, padding=0, reflect_pad=True)
-        self.conv2 = conv2d(in_channels=64, out_channels=128, kernel_size=3, stride=2, padding=1)
-        self.conv3 = conv2d(in_channels=128, out_channels=256, kernel_size=3, stride=2, padding=1)
+        self.conv1 = conv2d(in_channels=3, out_channels=conv_dim, kernel_size=7, stride=1, padding=0, reflect_pad=True)
+        for i in range(n_downsampling):
+            setattr(self, 'conv' + str(i + 2), conv2d(in_channels=conv_dim * 2**i, out_channels=conv_dim * 2**(i + 1), kernel_size=3, stride=2, padding=1))
 
         # 2. Define the transformation part of the generator
-        self.resnet_block1 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block2 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block3 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block4 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block5 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block6 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block7 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block8 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block9 = ResnetBlock2d(conv_dim=256)
+        for i in range(1, n_res_blocks + 1):
+            setattr(self, 'resnet_block' + str(i), ResnetBlock2d(conv_dim=conv_dim * 2**n_downsampling))
 
     def forward(self, x):
         out = F.relu(self.conv1(x))
-        out = F.relu(self.conv2(out))
-        out = F.relu(self.conv3(out))
+        for i in range(self.n_downsampling):
+            out = F.relu(getattr(self, 'conv' + str(i + 2))(out))
 
-        out = F.relu(self.resnet_block1(out))
-        out = F.relu(self.resnet_block2(out))
-        out = F.relu(self.resnet_block3(out))
-        out = F.relu(self.resnet_block4(out))
-        out = F.relu(self.resnet_block5(out))
-        out = F.relu(self.resnet_block6(out))
-        out = F.relu(self.resnet_block7(out))
-        out = F.relu(self.resnet_block8(out))
-        out = F.relu(self.resnet_block9(out))
+        for i in range(1, self.n_res_blocks + 1):
+            out = F.relu(getattr(self, 'resnet_block' + str(i))(out))
 
         return out
 
 
 #XNet decoder
 class XNetDecoder(nn.Module):
-    def __init__(self, init_zero_weights=False):
+    def __init__(self, init_zero_weights=False, conv_dim=64, n_downsampling=2):
         super(XNetDecoder, self).__init__()
+        self.n_downsampling = n_downsampling
 
         # 3. Define the decoder part of the generator (that builds up the output image from features)
-        self.deconv2d_1 = deconv2d(in_channels=256, out_channels=128, kernel_size=3, stride=2, padding=1, output_padding=1)
-        self.deconv2d_2 = deconv2d(in_channels=128, out_channels=64, kernel_size=3, stride=2, padding=1, output_padding=1)
-        self.conv4 = conv2d(in_channels=64, out_channels=3, kernel_size=7, stride=1, padding=0, reflect_pad=True, instance_norm=False)
+        for i in range(n_downsampling):
+            setattr(self, 'deconv2d_' + str(i + 1), deconv2d(in_channels=conv_dim * 2**(n_downsampling - i), out_channels=conv_dim * 2**(n_downsampling - i - 1), kernel_size=3, stride=2, padding=1, output_padding=1))
+        setattr(self, 'conv' + str(n_downsampling + 2), conv2d(in_channels=conv_dim, out_channels=3, kernel_size=7, stride=1, padding=0, reflect_pad=True, instance_norm=False))
 
     def forward(self, x):
-        out = F.relu(self.deconv2d_1(x))
-        out = F.relu(self.deconv2d_2(out))
-        out = F.tanh(self.conv4(out))
+        out = x
+        for i in range(1, self.n_downsampling + 1):
+            out = F.relu(getattr(self, 'deconv2d_' + str(i))(out))
+        out = F.tanh(getattr(self, 'conv' + str(self.n_downsampling + 2))(out))
 
         return out
 
 #XNet translator
 class XNetTranslator(nn.Module):
-    def __init__(self, init_zero_weights=False):
+    def __init__(self, init_zero_weights=False, conv_dim=64, n_res_blocks=9, n_downsampling=2):
         super(XNetTranslator, self).__init__()
+        self.n_res_blocks = n_res_blocks
 
         # 2. Define the transformation part of the generator
-        self.resnet_block1 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block2 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block3 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block4 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block5 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block6 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block7 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block8 = ResnetBlock2d(conv_dim=256)
-        self.resnet_block9 = ResnetBlock2d(conv_dim=256)
+        for i in range(1, n_res_blocks + 1):
+            setattr(self, 'resnet_block' + str(i), ResnetBlock2d(conv_dim=conv_dim * 2**n_downsampling))
 
     def forward(self, x):
-        out = F.relu(self.resnet_block1(x))
-        out = F.relu(self.resnet_block2(out))
-        out = F.relu(self.resnet_block3(out))
-        out = F.relu(self.resnet_block4(out))
-        out = F.relu(self.resnet_block5(out))
-        out = F.relu(self.resnet_block6(out))
-        out = F.relu(self.resnet_block7(out))
-        out = F.relu(self.resnet_block8(out))
-        out = F.relu(self.resnet_block9(out))
+        out = x
+        for i in range(1, self.n_res_blocks + 1):
+            out = F.relu(getattr(self, 'resnet_block' + str(i))(out))
 
         return out
 
-"""Defines the architecture of the discriminator network (both discriminators D_X and D_Y have the same architecture)."""
+"""Defines the architecture of the discriminator network (both discriminators D_X and D_Y have the same architecture).
+   conv_dim is the width of the first layer, doubled by each of the n_layers following strided convolutions
+   (the defaults 64, 3 are the original 64/128/256/512 architecture, with the same layer names conv1..conv5)."""
 class PatchGANDiscriminator(nn.Module):
-    def __init__(self):
+    def __init__(self, conv_dim=64, n_layers=3):
         super(PatchGANDiscriminator, self).__init__()
+        self.n_layers = n_layers
 
         #### ARCHITECTURE ####
-        self.conv1 = conv2d(in_channels=3, out_channels=64, kernel_size=4, stride=2, padding=1, instance_norm=False)
-        self.conv2 = conv2d(in_channels=64, out_channels=128, kernel_size=4, stride=2, padding=1)
-        self.conv3 = conv2d(in_channels=128, out_channels=256, kernel_size=4, stride=2, padding=1)
-        self.conv4 = conv2d(in_channels=256, out_channels=512, kernel_size=4, stride=2, padding=1)
-        self.conv5 = conv2d(in_channels=512, out_channels=1, kernel_size=4, stride=1, padding=1, instance_norm=False)
+        self.conv1 = conv2d(in_channels=3, out_channels=conv_dim, kernel_size=4, stride=2, padding=1, instance_norm=False)
+        for i in range(n_layers):
+            setattr(self, 'conv' + str(i + 2), conv2d(in_channels=conv_dim * 2**i, out_channels=conv_dim * 2**(i + 1), kernel_size=4, stride=2, padding=1))
+        setattr(self, 'conv' + str(n_layers + 2), conv2d(in_channels=conv_dim * 2**n_layers, out_channels=1, kernel_size=4, stride=1, padding=1, instance_norm=False))
 
 
     def forward(self, x):
         out = F.leaky_relu(self.conv1(x), negative_slope=0.2, inplace=True)
-        out = F.leaky_relu(self.conv2(out), negative_slope=0.2, inplace=True)
-        out = F.leaky_relu(self.conv3(out), negative_slope=0.2, inplace=True)
-        out = F.leaky_relu(self.conv4(out), negative_slope=0.2, inplace=True)
-        out = F.sigmoid(self.conv5(out))
+        for i in range(self.n_layers):
+            out = F.leaky_relu(getattr(self, 'conv' + str(i + 2))(out), negative_slope=0.2, inplace=True)
+        out = F.sigmoid(getattr(self, 'conv' + str(self.n_layers + 2))(out))
 
         return out
+
+
+
+#########################################
+################3D MODELS###############
+#########################################
+
+"""Creates a 3D transposed-convolutional layer, with optional instance normalization."""
+def deconv3d(in_channels, out_channels, kernel_size, stride=2, padding=1, output_padding=0, instance_norm=True):
+    layers = []
+    layers.append(nn.ConvTranspose3d(in_channels, out_channels, kernel_size, stride, padding, output_padding, bias=False))
+
+    if instance_norm:
+       layers.append(nn.InstanceNorm3d(out_channels))
+
+    return nn.Sequential(*layers)
+
+
+"""Creates a 3D convolutional layer, with optional instance normalization."""
+def conv3d(in_channels, out_channels, kernel_size, stride=2, padding=1, instance_norm=True, init_zero_weights=False, reflect_pad=False):
+    layers = []
+
+    if reflect_pad:
+       layers.append(nn.ReflectionPad3d(3))
+
+    conv_layer = nn.Conv3d(in_channels=in_channels, out_channels=out_channels, kernel_size=kernel_size, stride=stride, padding=padding, bias=False)
+
+    if init_zero_weights:
+       conv_layer.weight.data = torch.randn(out_channels, in_channels, kernel_size, kernel_size, kernel_size) * 0.001
+
+    layers.append(conv_layer)
+
+    if instance_norm:
+       layers.append(nn.InstanceNorm3d(out_channels))
+
+    return nn.Sequential(*layers)
+
+
+"""3D version of ResnetBlock2d."""
+class ResnetBlock3d(nn.Module):
+    def __init__(self, conv_dim):
+        super(ResnetBlock3d, self).__init__()
+        self.conv_layer = conv3d(in_channels=conv_dim, out_channels=conv_dim, kernel_size=3, stride=1, padding=1)
+
+    def forward(self, x):
+        out = x + self.conv_layer(x)
+        return out
+
+
+"""3D version of CycleGenerator for MRI volumes (batch_size x in_channels x D x H x W, with D, H and W multiples of
+   2**n_downsampling). It is trained on random patches (see cycle_gan_3d.py), so its activation memory depends on the
+   patch size only; whole volumes are run patch by patch with volumes.stitched_forward.
+   Same layer layout and names as CycleGenerator; the defaults are narrower and shallower, since every 3D feature map
+   has a depth dimension as well.
+"""
+class CycleGenerator3d(nn.Module):
+    def __init__(self, init_zero_weights=False, conv_dim=32, n_res_blocks=6, n_downsampling=2, in_channels=1):
+        super(CycleGenerator3d, self).__init__()
+        self.conv_dim = conv_dim
+        self.n_res_blocks = n_res_blocks
+        self.n_downsampling = n_downsampling
+        self.in_channels = in_channels
+
+        # 1. Encoder
+        self.conv1 = conv3d(in_channels=in_channels, out_channels=conv_dim, kernel_size=7, stride=1, padding=0, reflect_pad=True)
+        for i in range(n_downsampling):
+            kernel_size = 5 if i == 0 else 3
+            setattr(self, 'conv' + str(i + 2), conv3d(in_channels=conv_dim * 2**i, out_channels=conv_dim * 2**(i + 1), kernel_size=kernel_size, stride=2, padding=kernel_size // 2))
+
+        # 2. Transformation
+        for i in range(1, n_res_blocks + 1):
+            setattr(self, 'resnet_block' + str(i), ResnetBlock3d(conv_dim=conv_dim * 2**n_downsampling))
+
+        # 3. Decoder
+        for i in range(n_downsampling):
+            kernel_size = 5 if i == n_downsampling - 1 else 3
+            setattr(self, 'deconv3d_' + str(i + 1), deconv3d(in_channels=conv_dim * 2**(n_downsampling - i), out_channels=conv_dim * 2**(n_downsampling - i - 1), kernel_size=kernel_size, stride=2, padding=kernel_size // 2, output_padding=1))
+        setattr(self, 'conv' + str(n_downsampling + 2), conv3d(in_channels=conv_dim, out_channels=in_channels, kernel_size=7, stride=1, padding=0, reflect_pad=True, instance_norm=False))
+
+    def forward(self, x):
+        out = F.relu(self.conv1(x))
+        for i in range(self.n_downsampling):
+            out = F.relu(getattr(self, 'conv' + str(i + 2))(out))
+
+        for i in range(1, self.n_res_blocks + 1):
+            out = F.relu(getattr(self, 'resnet_block' + str(i))(out))
+
+        for i in range(1, self.n_downsampling + 1):
+            out = F.relu(getattr(self, 'deconv3d_' + str(i))(out))
+        out = torch.tanh(getattr(self, 'conv' + str(self.n_downsampling + 2))(out))
+
+        return out
+
+
+"""3D version of PatchGANDiscriminator: one score per overlapping sub-volume of a patch. With n_layers strided
+   layers the input needs at least 2**(n_layers + 2) voxels along each axis (32 for the default 3)."""
+class PatchGANDiscriminator3d(nn.Module):
+    def __init__(self, conv_dim=32, n_layers=3, in_channels=1):
+        super(PatchGANDiscriminator3d, self).__init__()
+        self.n_layers = n_layers
+
+        self.conv1 = conv3d(in_channels=in_channels, out_channels=conv_dim, kernel_size=4, stride=2, padding=1, instance_norm=False)
+        for i in range(n_layers):
+            setattr(self, 'conv' + str(i + 2), conv3d(in_channels=conv_dim * 2**i, out_channels=conv_dim * 2**(i + 1), kernel_size=4, stride=2, padding=1))
+        setattr(self, 'conv' + str(n_layers + 2), conv3d(in_channels=conv_dim * 2**n_layers, out_channels=1, kernel_size=4, stride=1, padding=1, instance_norm=False))
+
+    def forward(self, x):
+        out = F.leaky_relu(self.conv1(x), negative_slope=0.2, inplace=True)
+        for i in range(self.n_layers):
+            out = F.leaky_relu(getattr(self, 'conv' + str(i + 2))(out), negative_slope=0.2, inplace=True)
+        out = torch.sigmoid(getattr(self, 'conv' + str(self.n_layers + 2))(out))
+
+        return out
+
+
+"""Runs two architecturally identical networks (e.g. G_XtoY and G_YtoX) in one call.
+   The parameters of both networks are stacked and the forward pass is vectorized with torch.func.vmap,
+   which lowers the convolutions to grouped convolutions, so both directions share one set of kernel launches.
+
+   The wrapped networks stay the owners of their parameters: gradients flow back into them, the optimizers
+   are built from them as before, and their state_dicts are saved and loaded separately as before.
+   Falls back to two sequential calls when fused=False, torch.func is unavailable or the two inputs differ in shape.
+   Whether fusing pays off depends on the device: on CPU the grouped convolutions are slower than two sequential
+   calls (see benchmark_fused.py); the per-call weight stacking is a negligible part of the step either way.
+"""
+class DualGenerator(nn.Module):
+    def __init__(self, net_a, net_b, fused=True):
+        super(DualGenerator, self).__init__()
+        self.net_a = net_a
+        self.net_b = net_b
+        self.fuse = fused
+
+    def fused(self, x_a, x_b):
+        return self.fuse and vmap is not None and x_a.shape == x_b.shape
+
+    def forward(self, x_a, x_b):
+        """Returns (net_a(x_a), net_b(x_b))."""
+        if not self.fused(x_a, x_b):
+            return self.net_a(x_a), self.net_b(x_b)
+
+        params_a = dict(self.net_a.named_parameters())
+        params_b = dict(self.net_b.named_parameters())
+        buffers_a = dict(self.net_a.named_buffers())
+        buffers_b = dict(self.net_b.named_buffers())
+
+        params = {name: torch.stack([params_a[name], params_b[name]]) for name in params_a}
+        buffers = {name: torch.stack([buffers_a[name], buffers_b[name]]) for name in buffers_a}
+
+        def call(params, buffers, x):
+            return functional_call(self.net_a, (params, buffers), (x,))
+
+        out = vmap(call)(params, buffers, torch.stack([x_a, x_b]))
+        return out[0], out[1]
+
+
+GENERATORS = {'CycleGenerator': CycleGenerator, 'StudentGenerator': StudentGenerator, 'CycleGenerator3d': CycleGenerator3d}
+
+
+"""Builds a generator from a config dict {'model': <class name>, <constructor arguments>...} (a CycleGenerator if None)."""
+def build_generator(config=None):
+    config = dict(config or {'model': 'CycleGenerator'})
+    return GENERATORS[config.pop('model')](**config)
@@ -0,0 +1,153 @@
+# Preemption handling and exact resume support for the training scripts
+
+import os
+import sys
+import time
+import random
+import signal
+import threading
+
+import numpy as np
+import torch
+
+
+"""Adds the preemption/resume command-line arguments to an existing parser."""
+def add_preemption_args(parser):
+    parser.add_argument('--resume', action='store_true', default=False, help='Resume from <checkpoint_dir>/resume.pkl if it exists (models, optimizers, image pools, RNG states and data position).')
+    parser.add_argument('--preempt_budget', type=float, default=60.0, help='Seconds allowed between a termination signal and the end of the emergency checkpoint.')
+    return parser
+
+
+"""Path of the resume state written on preemption and at every checkpoint."""
+def resume_path(opts):
+    return os.path.join(opts.checkpoint_dir, 'resume.pkl')
+
+
+"""Catches the signals a scheduler sends before killing a job (SIGTERM, SIGINT, SIGUSR1).
+   The handler only sets a flag; the training loop polls it at the end of each iteration (so the
+   saved state is always between two complete steps), writes the emergency checkpoint and calls exit().
+   A watchdog hard-exits the process if that has not happened within the time budget; since the resume
+   state is written atomically, the previous resume file is left intact in that case.
+"""
+class PreemptionHandler():
+    def __init__(self, budget):
+        self.budget = budget
+        self.signum = None
+        self.signal_time = None
+        self.watchdog = None
+
+    def install(self):
+        signals = [signal.SIGTERM, signal.SIGINT]
+        if hasattr(signal, 'SIGUSR1'):
+            signals.append(signal.SIGUSR1)
+
+        for signum in signals:
+            signal.signal(signum, self._handle)
+        return self
+
+    @property
+    def requested(self):
+        return self.signum is not None
+
+    def _handle(self, signum, frame):
+        if self.requested:
+            print('Received signal {} again, exiting without checkpoint.'.format(signum))
+            os._exit(128 + signum)
+
+        self.signum = signum
+        self.signal_time = time.time()
+        print('Received signal {}, writing an emergency checkpoint (budget {:.0f}s).'.format(signum, self.budget))
+
+        self.watchdog = threading.Timer(self.budget, self._expire)
+        self.watchdog.daemon = True
+        self.watchdog.start()
+
+    def _expire(self):
+        print('Emergency checkpoint did not finish within {:.0f}s, exiting.'.format(self.budget))
+        sys.stdout.flush()
+        os._exit(128 + self.signum)
+
+    def exit(self):
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        print('Emergency checkpoint written {:.1f}s after signal {}.'.format(time.time() - self.signal_time, self.signum))
+        sys.exit(128 + self.signum)
+
+
+"""Captures the python, numpy, torch and CUDA random number generator states."""
+def get_rng_state():
+    np_state = np.random.get_state()
+    return {'python': random.getstate(),
+            'numpy': (np_state[0], torch.from_numpy(np_state[1].astype(np.int64)), np_state[2], np_state[3], np_state[4]),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+"""Restores the states captured by get_rng_state()."""
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np_state = state['numpy']
+    np.random.set_state((np_state[0], np_state[1].numpy().astype(np.uint32), np_state[2], np_state[3], np_state[4]))
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+"""Writes the resume state atomically (to a temporary file that then replaces the previous one)."""
+def save_resume_state(state, path):
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+    print('Saved {}'.format(path))
+
+
+"""Loads a resume state written by save_resume_state(), or returns None if there is none."""
+def load_resume_state(path):
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location=lambda storage, loc: storage)
+
+
+#Sampler of a training loader, which must be able to save its position (see data_loader.ResumableRandomSampler)
+def _resumable_sampler(name, loader):
+    sampler = getattr(loader, 'sampler', None)
+    if not hasattr(sampler, 'state_dict') or not hasattr(sampler, 'load_state_dict'):
+        raise ValueError('Loader {} cannot be resumed exactly: its sampler ({}) has no state_dict/load_state_dict '
+                         '(build it with data_loader.get_data_loader).'.format(name, type(sampler).__name__))
+    return sampler
+
+
+"""Collects everything needed to continue training bit-for-bit after the given iteration.
+   models/optimizers/pools/loaders are dicts of name -> object; consumed maps each loader name to the
+   number of samples of its current epoch already used by the training loop. Every loader must have a
+   resumable sampler (ValueError otherwise); the random state of augmenting loaders (augment.AugmentedLoader)
+   is saved with it.
+"""
+def training_state(iteration, models, optimizers, pools, loaders, consumed):
+    return {'iteration': iteration,
+            'models': {name: model.state_dict() for name, model in models.items()},
+            'optimizers': {name: optimizer.state_dict() for name, optimizer in optimizers.items()},
+            'pools': {name: pool.state_dict() for name, pool in pools.items()},
+            'data': {name: _resumable_sampler(name, loader).state_dict(consumed[name]) for name, loader in loaders.items()},
+            'augment': {name: loader.augmenter.state_dict() for name, loader in loaders.items() if hasattr(loader, 'augmenter')},
+            'consumed': dict(consumed),
+            'rng': get_rng_state()}
+
+
+"""Loads a state from training_state() back into the given objects and returns (next iteration, consumed).
+   The caller must re-create its data iterators and only then call set_rng_state(state['rng']),
+   since creating an iterator draws from the global RNG.
+"""
+def restore_training_state(state, models, optimizers, pools, loaders):
+    for name, model in models.items():
+        model.load_state_dict(state['models'][name])
+    for name, optimizer in optimizers.items():
+        optimizer.load_state_dict(state['optimizers'][name])
+    for name, pool in pools.items():
+        pool.load_state_dict(state['pools'][name])
+    for name, loader in loaders.items():
+        _resumable_sampler(name, loader).load_state_dict(state['data'][name])
+        if hasattr(loader, 'augmenter'):
+            loader.augmenter.load_state_dict(state['augment'][name])
+
+    return state['iteration'] + 1, dict(state['consumed'])
@@ -1,17 +1,14 @@
 import math
 import numpy as np
 import os
-import pandas as pd
 import csv
 import shutil
 import errno
 from PIL import Image
-from distutils.dir_util import copy_tree
-from scipy.io import loadmat
-from scipy.misc import imsave
 from shutil import copyfile
 import random
-import cv2
+
+# pandas, scipy.io, scipy.misc and cv2 are imported by the functions that use them
 
 
 random.seed(14) #ensure same results when code with random shuffling is re-run
@@ -45,6 +42,8 @@ def convert_mat_to_png(mat_dir, dataset_dir, param_csv):
 
 
 def prep_train_test_lists(src_dir, param_csv):
+        import pandas as pd
+
         img_list = os.listdir(src_dir)
         param_df = pd.read_csv(param_csv)
 
@@ -101,6 +100,9 @@ def aggregate_and_save_patches(png_dir, dataset_dir, img_list, sub_dir):
 
 
 def aggregate_and_save_slices(mat_dir, dataset_dir, img_list, sub_dir):
+        from scipy.io import loadmat
+        from scipy.misc import imsave
+
         for img in img_list:
             current_img = os.path.join(mat_dir, img, 'pre_img.mat') #only looking at pre contrast images right now
 
@@ -121,6 +123,9 @@ def aggregate_and_save_slices(mat_dir, dataset_dir, img_list, sub_dir):
 
 
 def flip_images(dir):
+    import cv2
+    from scipy.misc import imsave
+
     image_list = os.listdir(dir)
     for image in image_list:
         img = cv2.imread(os.path.join(dir, image))
@@ -142,14 +147,15 @@ def copy_mat_files(src_dir, dest_dir):
         print("Copied: ", img)
 
 
-mat_dir = ''
-patch_dir = os.path.join('/home', 'adithya', 'Normalized_MRIs')
-dataset_dir = os.path.join('/home', 'adithya', 'MRI_Dataset')
-param_csv = os.path.join('/home', 'adithya', 'Breast_Style_Transfer', 'ctyle-transfer', 'scanner_params.csv')
+if __name__ == '__main__':
+    mat_dir = ''
+    patch_dir = os.path.join('/home', 'adithya', 'Normalized_MRIs')
+    dataset_dir = os.path.join('/home', 'adithya', 'MRI_Dataset')
+    param_csv = os.path.join('/home', 'adithya', 'Breast_Style_Transfer', 'ctyle-transfer', 'scanner_params.csv')
 
 
 
-#convert_patch_to_png(patch_dir, dataset_dir, param_csv)
-flip_images(os.path.join('/home', 'adithya', 'MRI_Dataset', 'Train_Siemens'))
-#copy_mat_files(os.path.join('/home', 'adithya', 'MRI_Dataset', 'Train_GE', 'Train_GE'), os.path.join('/home', 'adithya', 'Training_Set_Mat_Files'))
-#copy_mat_files(os.path.join('/home', 'adithya', 'MRI_Dataset', 'Train_Siemens', 'Train_Siemens'), os.path.join('/home', 'adithya', 'Training_Set_Mat_Files'))
+    #convert_patch_to_png(patch_dir, dataset_dir, param_csv)
+    flip_images(os.path.join('/home', 'adithya', 'MRI_Dataset', 'Train_Siemens'))
+    #copy_mat_files(os.path.join('/home', 'adithya', 'MRI_Dataset', 'Train_GE', 'Train_GE'), os.path.join('/home', 'adithya', 'Training_Set_Mat_Files'))
+    #copy_mat_files(os.path.join('/home', 'adithya', 'MRI_Dataset', 'Train_Siemens', 'Train_Siemens'), os.path.join('/home', 'adithya', 'Training_Set_Mat_Files'))
@@ -0,0 +1,216 @@
+# Progressive previews: low-resolution results first, full resolution last, with cancellation
+
+import os
+import time
+import queue
+import argparse
+import threading
+import collections
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from inference import InferenceEngine, load_image, inference_mode
+from metrics import psnr, ssim
+
+
+class Cancelled(Exception):
+    pass
+
+
+"""Runs one image through the generator at a fraction of its resolution and upsamples the output back
+   to the input size (the generators are fully convolutional; sizes are rounded to a multiple of 4, the
+   downsampling factor of CycleGenerator, and kept at least min_size so that InstanceNorm still sees more than
+   one pixel at the bottleneck). A scale of 1 runs the image as it is."""
+def render_at_scale(stylize, image, scale, multiple=4, min_size=32):
+    if scale >= 1:
+        return stylize(image[None])[0]
+
+    H, W = image.shape[1:]
+    h = max(min(H, min_size), int(round(H * scale / multiple)) * multiple)
+    w = max(min(W, min_size), int(round(W * scale / multiple)) * multiple)
+    small = F.interpolate(image[None], size=(h, w), mode='bilinear', align_corners=False, antialias=True)
+    return F.interpolate(stylize(small), size=(H, W), mode='bilinear', align_corners=False)[0]
+
+
+"""One submitted image. Results become available scale by scale (smallest first); wait() blocks for one of them.
+   cancel() stops the work at the next layer of the generator."""
+class PreviewRequest():
+    def __init__(self, image, scales):
+        self.image = image
+        self.scales = scales
+        self.results = collections.OrderedDict()
+        self.cancelled = False
+        self.finished = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    """Waits for the output at scale (the final scale if None). Returns None if the request was cancelled
+       (or failed, see .error) first, or on timeout."""
+    def wait(self, scale=None, timeout=None):
+        scale = self.scales[-1] if scale is None else scale
+        with self.condition:
+            self.condition.wait_for(lambda: scale in self.results or self.cancelled or self.finished, timeout)
+            return self.results.get(scale)
+
+    """(scale, output) of the most detailed result so far, or None."""
+    def latest(self):
+        with self.condition:
+            if not self.results:
+                return None
+            return next(reversed(self.results.items()))
+
+    def _publish(self, scale, output):
+        with self.condition:
+            self.results[scale] = output
+            self.condition.notify_all()
+
+    def _finish(self, error=None):
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify_all()
+
+
+"""Serves progressive previews from a background thread. submit() returns immediately; each image is run
+   at every scale in increasing order (e.g. 1/4 of the resolution, then full resolution) and on_result(request,
+   scale, output) is called as soon as each 3 x H x W output is ready. By default, submitting an image cancels
+   the requests it supersedes, which abort between two layers of the generator rather than finishing their pass.
+
+   Usage:
+        previewer = Previewer(InferenceEngine('checkpoints_cyclegan', 37000), scales=(0.25, 1.0))
+        request = previewer.submit(load_image('photo.jpg'))
+        preview = request.wait(0.25)
+        final = request.wait()
+        previewer.close()
+"""
+class Previewer():
+    def __init__(self, engine, direction='YtoX', scales=(0.25, 1.0), on_result=None):
+        self.engine = engine
+        self.direction = direction
+        self.scales = tuple(sorted(scales))
+        self.on_result = on_result
+
+        self.requests = queue.Queue()
+        self.outstanding = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        #cancellation checks before every layer (only in the preview thread, the engine may be shared)
+        G = engine.generator(direction)
+        self.hooks = []
+        if isinstance(G, nn.Module) and not isinstance(G, torch.jit.ScriptModule):
+            self.hooks = [module.register_forward_pre_hook(self._check_cancelled) for module in G.modules()]
+
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, image, cancel_previous=True):
+        request = PreviewRequest(image, self.scales)
+        with self.lock:
+            if cancel_previous:
+                for previous in self.outstanding:
+                    previous.cancel()
+            self.outstanding = [r for r in self.outstanding if not r.finished and not r.cancelled] + [request]
+        self.requests.put(request)
+        return request
+
+    def _check_cancelled(self, module, inputs):
+        request = getattr(self.local, 'request', None)
+        if request is not None and request.cancelled:
+            raise Cancelled()
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+
+            self.local.request = request
+            try:
+                for scale in self.scales:
+                    if request.cancelled:
+                        break
+                    with inference_mode():
+                        output = render_at_scale(lambda x: self.engine.stylize(x, self.direction), request.image, scale).cpu()
+                    request._publish(scale, output)
+                    if self.on_result is not None:
+                        self.on_result(request, scale, output)
+                request._finish()
+            except Cancelled:
+                request._finish()
+            except Exception as e:
+                request._finish(e)
+            finally:
+                self.local.request = None
+
+    def close(self):
+        with self.lock:
+            for request in self.outstanding:
+                request.cancel()
+        self.requests.put(None)
+        self.worker.join()
+        for hook in self.hooks:
+            hook.remove()
+
+
+"""Measures, for every scale, the preview latency and how closely the upsampled preview matches the full
+   resolution output (PSNR/SSIM) over a set of 3 x H x W images. Returns one dict per scale."""
+def preview_report(engine, images, direction='YtoX', scales=(0.125, 0.25, 0.5)):
+    stylize = lambda x: engine.stylize(x, direction)
+
+    with inference_mode():
+        final_times, finals = [], []
+        for image in images:
+            start = time.time()
+            finals.append(render_at_scale(stylize, image, 1.0).cpu())
+            final_times.append(time.time() - start)
+
+        report = []
+        for scale in sorted(scales):
+            times, psnrs, ssims = [], [], []
+            for image, final in zip(images, finals):
+                start = time.time()
+                preview = render_at_scale(stylize, image, scale).cpu()
+                times.append(time.time() - start)
+                psnrs.append(psnr(preview[None], final[None]))
+                ssims.append(ssim(preview[None], final[None]))
+            report.append({'scale': scale, 'seconds': sum(times) / len(times), 'speedup': sum(final_times) / sum(times),
+                           'psnr': sum(psnrs) / len(psnrs), 'ssim': sum(ssims) / len(ssims)})
+
+    print('full resolution: {:.1f} ms per image'.format(1000 * sum(final_times) / len(final_times)))
+    for row in report:
+        print('scale {:5.3f} | {:8.1f} ms | speedup {:5.1f}x | PSNR {:6.2f} dB | SSIM {:.4f}'.format(
+            row['scale'], 1000 * row['seconds'], row['speedup'], row['psnr'], row['ssim']))
+    return report
+
+
+"""Creates the command-line parser for the preview quality report."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input', type=str, required=True, help='Directory of test images.')
+    parser.add_argument('--num_images', type=int, default=16)
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints_cyclegan')
+    parser.add_argument('--iteration', type=int, default=37000)
+    parser.add_argument('--direction', type=str, default='YtoX', choices=['XtoY', 'YtoX'])
+    parser.add_argument('--scales', type=float, nargs='+', default=[0.125, 0.25, 0.5], help='Preview scales to report on.')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+
+    engine = InferenceEngine(opts.checkpoint_dir, opts.iteration, directions=(opts.direction,))
+    names = sorted(os.listdir(opts.input))[:opts.num_images]
+    preview_report(engine, [load_image(os.path.join(opts.input, name)) for name in names], opts.direction, opts.scales)
+    engine.close()
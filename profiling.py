@@ -0,0 +1,163 @@
+# Windowed torch.profiler integration for the training and inference scripts
+
+import os
+import collections
+
+import torch
+
+
+"""Adds the --profile_* command-line arguments to an existing parser."""
+def add_profiler_args(parser):
+    parser.add_argument('--profile_start', type=int, default=0, help='Step at which to start the profiler window (0 disables profiling).')
+    parser.add_argument('--profile_steps', type=int, default=5, help='Number of steps captured in the profiler window.')
+    parser.add_argument('--profile_dir', type=str, default='profiles', help='Directory for the Chrome trace and the text summary.')
+    parser.add_argument('--profile_top_n', type=int, default=15, help='Number of operators listed per module in the text summary.')
+    return parser
+
+
+"""Captures a bounded torch.profiler window over steps [profile_start, profile_start + profile_steps).
+   Nothing is attached to the models outside the window, so steps outside it run exactly as before.
+
+   Usage:
+        profiler = WindowedProfiler(opts, {'G_XtoY': G_XtoY, 'D_X': D_X})
+        for step in ...:
+            profiler.step_begin(step)
+            ...
+            profiler.step_end(step)
+"""
+class WindowedProfiler():
+    def __init__(self, opts, modules):
+        self.start = getattr(opts, 'profile_start', 0)
+        self.num_steps = getattr(opts, 'profile_steps', 0)
+        self.out_dir = getattr(opts, 'profile_dir', 'profiles')
+        self.top_n = getattr(opts, 'profile_top_n', 15)
+        self.modules = modules
+
+        self.prof = None
+        self.hooks = []
+        self.scopes = []
+
+    def enabled(self):
+        return self.start > 0 and self.num_steps > 0
+
+    def in_window(self, step):
+        return self.enabled() and self.start <= step < self.start + self.num_steps
+
+    def step_begin(self, step):
+        if not self.enabled() or step != self.start:
+            return
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        self.prof = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True, with_stack=True)
+        self.prof.__enter__()
+        self._attach_hooks()
+        print('Profiler window opened at step {} for {} steps.'.format(step, self.num_steps))
+
+    def step_end(self, step):
+        if self.prof is None:
+            return
+
+        self.prof.step()
+        if step == self.start + self.num_steps - 1:
+            self.close()
+
+    """Stops the profiler early (e.g. when the loop finishes inside the window) and writes the results."""
+    def close(self):
+        if self.prof is None:
+            return
+
+        self._detach_hooks()
+        self.prof.__exit__(None, None, None)
+
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+
+        trace_path = os.path.join(self.out_dir, 'trace_{:06d}.json'.format(self.start))
+        summary_path = os.path.join(self.out_dir, 'summary_{:06d}.txt'.format(self.start))
+
+        self.prof.export_chrome_trace(trace_path)
+        with open(summary_path, 'w') as f:
+            f.write(self.summary())
+
+        print('Saved {}'.format(trace_path))
+        print('Saved {}'.format(summary_path))
+        self.prof = None
+
+    """Builds the text report: overall top-N operators, top-N grouped by call stack, and top-N per model module."""
+    def summary(self):
+        sort_key = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        events = self.prof.key_averages()
+
+        lines = []
+        lines.append('=' * 80)
+        lines.append('Top {} operators'.format(self.top_n))
+        lines.append(events.table(sort_by=sort_key, row_limit=self.top_n))
+        lines.append('Top {} operators by allocated CPU memory'.format(self.top_n))
+        lines.append(events.table(sort_by='self_cpu_memory_usage', row_limit=self.top_n))
+        lines.append('Top {} call stacks'.format(self.top_n))
+        lines.append(self.prof.key_averages(group_by_stack_n=5).table(sort_by=sort_key, row_limit=self.top_n))
+
+        per_module = self._per_module_stats()
+        for name in self.modules:
+            stats = per_module.get(name, {})
+            total_time = sum(s[0] for s in stats.values())
+            lines.append('=' * 80)
+            lines.append('{} ({}) forward: {:.3f} ms self CPU time in window'.format(name, type(self.modules[name]).__name__, total_time / 1000.0))
+            lines.append('{:<40} {:>8} {:>14} {:>14}'.format('Operator', 'Calls', 'Self CPU (ms)', 'Self mem (MB)'))
+
+            ranked = sorted(stats.items(), key=lambda kv: kv[1][0], reverse=True)[:self.top_n]
+            for op_name, (cpu_time, calls, mem) in ranked:
+                lines.append('{:<40} {:>8d} {:>14.3f} {:>14.2f}'.format(op_name[:40], calls, cpu_time / 1000.0, mem / 2.0**20))
+
+        return '\n'.join(lines) + '\n'
+
+    #Attributes every operator to the innermost enclosing module scope recorded by the forward hooks
+    def _per_module_stats(self):
+        scope_names = set(self._scope_name(name) for name in self.modules)
+        per_module = collections.defaultdict(lambda: collections.defaultdict(lambda: [0.0, 0, 0]))
+
+        for evt in self.prof.events():
+            if evt.name in scope_names or getattr(evt, 'is_python_function', False):
+                continue
+
+            parent = evt.cpu_parent
+            while parent is not None and parent.name not in scope_names:
+                parent = parent.cpu_parent
+            if parent is None:
+                continue
+
+            stats = per_module[parent.name[len('module::'):]][evt.name]
+            stats[0] += evt.self_cpu_time_total
+            stats[1] += 1
+            stats[2] += max(evt.self_cpu_memory_usage, 0)
+
+        return per_module
+
+    @staticmethod
+    def _scope_name(name):
+        return 'module::' + name
+
+    def _attach_hooks(self):
+        for name, module in self.modules.items():
+            scope = self._scope_name(name)
+
+            def pre_hook(module, inputs, scope=scope):
+                ctx = torch.profiler.record_function(scope)
+                ctx.__enter__()
+                self.scopes.append(ctx)
+
+            def post_hook(module, inputs, outputs):
+                self.scopes.pop().__exit__(None, None, None)
+
+            self.hooks.append(module.register_forward_pre_hook(pre_hook))
+            self.hooks.append(module.register_forward_hook(post_hook))
+
+    def _detach_hooks(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+        while self.scopes:
+            self.scopes.pop().__exit__(None, None, None)
@@ -0,0 +1,173 @@
+# Static int8 post-training quantization of CycleGenerator for CPU inference
+
+import os
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+try:
+    import torch.ao.quantization as tq
+except ImportError:
+    import torch.quantization as tq
+
+from models import CycleGenerator, ResnetBlock2d
+from inference import load_generator, load_image, inference_mode
+from metrics import psnr, ssim
+
+
+"""ResnetBlock2d whose skip connection is a quantizable add."""
+class QuantizableResnetBlock2d(ResnetBlock2d):
+    def __init__(self, conv_dim):
+        super(QuantizableResnetBlock2d, self).__init__(conv_dim)
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        return self.skip_add.add(x, self.conv_layer(x))
+
+
+"""CycleGenerator with quant/dequant stubs around the float forward pass and quantizable residual adds.
+   It has the same state_dict keys as CycleGenerator, so it is built from a trained checkpoint directly.
+   ReflectionPad2d, ReLU and tanh run on quantized tensors as they are; InstanceNorm2d is swapped for the
+   quantized InstanceNorm2d, which still normalizes each image with its own statistics.
+"""
+class QuantizableCycleGenerator(CycleGenerator):
+    def __init__(self, **kwargs):
+        super(QuantizableCycleGenerator, self).__init__(**kwargs)
+        for name, module in list(self.named_children()):
+            if isinstance(module, ResnetBlock2d):
+                setattr(self, name, QuantizableResnetBlock2d(module.conv_layer[0].in_channels))
+
+        self.quant = tq.QuantStub()
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(super(QuantizableCycleGenerator, self).forward(self.quant(x)))
+
+
+"""Default quantized backend: x86 where available (fbgemm otherwise)."""
+def default_backend():
+    engines = torch.backends.quantized.supported_engines
+    return 'x86' if 'x86' in engines else 'fbgemm'
+
+
+"""Builds a static int8 copy of a float CycleGenerator, calibrated on the given 3 x H x W images.
+   Convolutions use per-channel weight quantization; transposed convolutions use per-tensor weights
+   (the only scheme the quantized ConvTranspose2d kernels support)."""
+def quantize_generator(G, calibration_images, backend=None):
+    backend = backend or default_backend()
+    torch.backends.quantized.engine = backend
+
+    qG = QuantizableCycleGenerator(conv_dim=G.conv_dim, n_res_blocks=G.n_res_blocks, n_downsampling=G.n_downsampling)
+    qG.load_state_dict(G.state_dict())
+    qG.eval()
+
+    qG.qconfig = tq.get_default_qconfig(backend)
+    for module in qG.modules():
+        if isinstance(module, nn.ConvTranspose2d):
+            module.qconfig = tq.default_qconfig
+
+    tq.prepare(qG, inplace=True)
+    with inference_mode():
+        for x in calibration_images:
+            qG(x[None])
+    tq.convert(qG, inplace=True)
+
+    return qG
+
+
+"""Saves a quantized generator as a standalone TorchScript file (no model code needed to load it)."""
+def save_quantized(qG, path, example):
+    with torch.no_grad():
+        traced = torch.jit.trace(qG, example[None])
+    torch.jit.save(traced, path, _extra_files={'backend': torch.backends.quantized.engine})
+    print('Saved {}'.format(path))
+
+
+"""Loads a file written by save_quantized() and selects the quantized backend it was built for."""
+def load_quantized(path):
+    extra_files = {'backend': ''}
+    model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    backend = extra_files['backend']
+    if isinstance(backend, bytes):
+        backend = backend.decode()
+    if backend:
+        torch.backends.quantized.engine = backend
+    return model.eval()
+
+
+"""Mean PSNR/SSIM of the int8 outputs against the fp32 outputs on held-out images."""
+def evaluate(G, qG, images):
+    scores = []
+    with inference_mode():
+        for x in images:
+            reference, quantized = G(x[None]), qG(x[None])
+            scores.append((psnr(reference, quantized), ssim(reference, quantized)))
+    return sum(s[0] for s in scores) / len(scores), sum(s[1] for s in scores) / len(scores)
+
+
+"""Mean latency (s) of one forward pass over a batch, after warm-up."""
+def benchmark(model, batch, repeats=5):
+    with inference_mode():
+        model(batch)
+        start = time.time()
+        for _ in range(repeats):
+            model(batch)
+    return (time.time() - start) / repeats
+
+
+#Loads up to n images of a directory, resized to image_size x image_size
+def load_images(img_dir, n, image_size):
+    import torchvision.transforms.functional as TF
+
+    names = sorted(os.listdir(img_dir))[:n]
+    return [TF.resize(load_image(os.path.join(img_dir, name)), [image_size, image_size]) for name in names]
+
+
+"""Quantizes a checkpoint, reports int8 vs fp32 quality and speed, and saves the int8 model."""
+def main(opts):
+    G = load_generator(opts.checkpoint_dir, opts.iteration, opts.direction).eval()
+
+    calibration = load_images(opts.calibration_dir, opts.num_calibration, opts.image_size)
+    holdout = load_images(opts.holdout_dir, opts.num_holdout, opts.image_size)
+
+    qG = quantize_generator(G, calibration, opts.backend)
+
+    output = opts.output or os.path.join(opts.checkpoint_dir, 'G_' + opts.direction + '_' + str(opts.iteration) + '_int8.pt')
+    save_quantized(qG, output, holdout[0])
+    qG = load_quantized(output)
+
+    mean_psnr, mean_ssim = evaluate(G, qG, holdout)
+    print('int8 vs fp32 on {} held-out images: PSNR {:.2f} dB | SSIM {:.4f}'.format(len(holdout), mean_psnr, mean_ssim))
+
+    for batch_size in (1, opts.batch_size):
+        batch = torch.stack((holdout * batch_size)[:batch_size])
+        fp32_time, int8_time = benchmark(G, batch), benchmark(qG, batch)
+        print('batch {:3d} | fp32 {:8.1f} ms ({:6.2f} img/s) | int8 {:8.1f} ms ({:6.2f} img/s) | speedup {:.2f}x'
+              .format(batch_size, fp32_time * 1000, batch_size / fp32_time, int8_time * 1000, batch_size / int8_time, fp32_time / int8_time))
+
+
+"""Creates the command-line parser for quantization."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints_cyclegan')
+    parser.add_argument('--iteration', type=int, default=37000)
+    parser.add_argument('--direction', type=str, default='YtoX', choices=['XtoY', 'YtoX'])
+    parser.add_argument('--calibration_dir', type=str, required=True, help='Directory of representative input images.')
+    parser.add_argument('--num_calibration', type=int, default=64)
+    parser.add_argument('--holdout_dir', type=str, required=True, help='Directory of held-out images for the quality check.')
+    parser.add_argument('--num_holdout', type=int, default=32)
+    parser.add_argument('--image_size', type=int, default=256, help='Images are resized to NxN for calibration, evaluation and timing.')
+    parser.add_argument('--batch_size', type=int, default=8, help='Batch size of the throughput comparison.')
+    parser.add_argument('--backend', type=str, default=default_backend(), choices=['x86', 'fbgemm', 'qnnpack'])
+    parser.add_argument('--output', type=str, default=None, help='Defaults to <checkpoint_dir>/G_<direction>_<iteration>_int8.pt')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+    main(opts)
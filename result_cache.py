@@ -0,0 +1,161 @@
+# Content-addressed on-disk cache of encoded generator outputs
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+import collections
+
+
+"""Adds the result cache command-line arguments to an existing parser."""
+def add_cache_args(parser):
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory of the result cache (disabled if not set).')
+    parser.add_argument('--cache_mb', type=int, default=1024, help='Size of the result cache; least recently used outputs are evicted beyond it.')
+    return parser
+
+
+"""Builds the ResultCache described by the options, or None if caching is disabled."""
+def create_cache(opts):
+    if getattr(opts, 'cache_dir', None) is None:
+        return None
+    return ResultCache(opts.cache_dir, opts.cache_mb * 2**20)
+
+
+"""SHA-256 hex digest of a file, read in chunks."""
+def file_digest(path, chunk_size=2**20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+"""Stores encoded outputs on disk under the SHA-256 of (input bytes, checkpoint digest, direction, settings),
+   so the same input rendered by the same checkpoint with the same settings is never run twice.
+   Entries are evicted least recently used first once their total size exceeds max_bytes. Recency survives
+   restarts through the file modification times, which are refreshed on every hit.
+
+   Usage:
+        cache = ResultCache('result_cache', 2**30)
+        key = cache.key(input_bytes, checkpoint_digest, 'YtoX', {'format': 'PNG'})
+        data = cache.get(key)
+        if data is None:
+            data = ...
+            cache.put(key, data)
+"""
+class ResultCache():
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        #key -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+
+        os.makedirs(root, exist_ok=True)
+        found = []
+        for prefix in os.listdir(root):
+            prefix_dir = os.path.join(root, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if name.endswith('.tmp'):
+                    continue
+                stat = os.stat(os.path.join(prefix_dir, name))
+                found.append((stat.st_mtime, name, stat.st_size))
+
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+        with self.lock:
+            self._evict()
+
+    """Cache key of one input (raw file bytes) for a checkpoint digest, direction and dict of output-affecting settings."""
+    @staticmethod
+    def key(data, checkpoint_digest, direction, settings):
+        h = hashlib.sha256()
+        h.update(hashlib.sha256(data).digest())
+        h.update(checkpoint_digest.encode())
+        h.update(direction.encode())
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    """Returns the cached bytes for key, or None."""
+    def get(self, key):
+        if not self._touch(key):
+            return None
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            self._forget(key)
+            return None
+
+    """Copies the cached output for key to output_path; returns False on a miss."""
+    def copy_to(self, key, output_path):
+        if not self._touch(key):
+            return False
+        try:
+            shutil.copyfile(self.path(key), output_path)
+            return True
+        except OSError:
+            self._forget(key)
+            return False
+
+    """Stores data under key (atomically) and evicts old entries beyond max_bytes."""
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            self._evict()
+
+    #Marks key as most recently used and counts the lookup
+    def _touch(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        return True
+
+    def _forget(self, key):
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+
+    #Caller holds the lock
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def __repr__(self):
+        return 'ResultCache({}: {} entries, {:.1f}/{:.1f} MB, {} hits, {} misses)'.format(
+            self.root, len(self.entries), self.total_bytes / 2**20, self.max_bytes / 2**20, self.hits, self.misses)
@@ -0,0 +1,349 @@
+# Local asyncio HTTP server around the cached generators, with dynamic batching
+
+import time
+import asyncio
+import argparse
+import collections
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from inference import InferenceEngine, decode_image, encode_image_hwc
+from result_cache import add_cache_args, create_cache
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+"""Fixed-bucket histogram, rendered in the Prometheus text format (cumulative bucket counts, sum and count)."""
+class Histogram():
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        lines.append('{}_sum {:.6f}'.format(self.name, self.sum))
+        lines.append('{}_count {}'.format(self.name, self.count))
+        return lines
+
+
+#One queued image and the future its HTTP handler waits on
+Request = collections.namedtuple('Request', ['image', 'future', 'arrival'])
+
+
+"""Groups queued requests into batches of equally sized images per direction and runs them on a bounded
+   pool of worker threads. A group is dispatched as soon as it holds max_batch images, or once its oldest
+   request has waited max_wait seconds. Batches are only formed when a worker is free, so requests keep
+   accumulating (and batches grow) while all workers are busy.
+"""
+class DynamicBatcher():
+    def __init__(self, engine, max_batch=8, max_wait=0.01, max_queue=64, num_workers=2):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+
+        self.groups = collections.OrderedDict()
+        self.pending = 0
+        self.wakeup = asyncio.Event()
+        self.slots = asyncio.Semaphore(num_workers)
+        self.workers = ThreadPoolExecutor(max_workers=num_workers)
+
+        self.queue_wait = Histogram('stylize_queue_wait_seconds', 'Time from admission to the start of the batch.', LATENCY_BUCKETS)
+        self.inference_time = Histogram('stylize_batch_seconds', 'Inference and encoding time per batch.', LATENCY_BUCKETS)
+        self.batch_size = Histogram('stylize_batch_size', 'Number of images per batch.', BATCH_BUCKETS)
+
+    """Reserves a queue slot for a request about to be decoded; False if max_queue requests are already being
+       decoded, queued or run. Every successful reserve() must be paired with a release()."""
+    def reserve(self):
+        if self.pending >= self.max_queue:
+            return False
+        self.pending += 1
+        return True
+
+    """Frees the slot of a request (once it is answered, or failed to decode)."""
+    def release(self):
+        self.pending -= 1
+
+    """Queues one request, which must hold a slot (see reserve). Returns the encoded output."""
+    async def submit(self, image, direction, arrival):
+        future = asyncio.get_event_loop().create_future()
+        self.groups.setdefault((direction, tuple(image.shape)), []).append(Request(image, future, arrival))
+        self.wakeup.set()
+        return await future
+
+    """Forms and dispatches batches until cancelled."""
+    async def run(self):
+        while True:
+            await self.slots.acquire()
+            key = await self._next_ready()
+
+            requests = self.groups[key][:self.max_batch]
+            del self.groups[key][:self.max_batch]
+            if not self.groups[key]:
+                del self.groups[key]
+
+            asyncio.ensure_future(self._execute(key[0], requests))
+
+    #Waits until a group is full or its oldest request is due, and returns its key
+    async def _next_ready(self):
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+
+            deadline, due = None, None
+            for key, requests in self.groups.items():
+                if len(requests) >= self.max_batch:
+                    return key
+                if deadline is None or requests[0].arrival + self.max_wait < deadline:
+                    deadline, due = requests[0].arrival + self.max_wait, key
+
+            if due is not None and deadline <= now:
+                return due
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), None if deadline is None else deadline - now)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, direction, requests):
+        start = time.time()
+        for request in requests:
+            self.queue_wait.observe(start - request.arrival)
+        self.batch_size.observe(len(requests))
+
+        try:
+            outputs = await asyncio.get_event_loop().run_in_executor(self.workers, self._infer, [r.image for r in requests], direction)
+            for request, output in zip(requests, outputs):
+                if not request.future.done():
+                    request.future.set_result(output)
+        except Exception as e:
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self.inference_time.observe(time.time() - start)
+            self.slots.release()
+
+    #Runs in a worker thread: one forward pass, then PNG encoding of every output
+    def _infer(self, images, direction):
+        outputs = self.engine.stylize(torch.stack(images), direction)
+        return [encode_image_hwc(output) for output in outputs.cpu().permute(0, 2, 3, 1)]
+
+    def close(self):
+        self.workers.shutdown()
+
+
+"""Minimal HTTP/1.1 server (keep-alive, Content-Length bodies) exposing
+        POST /stylize?direction=YtoX   image file in the body, PNG in the response
+        GET  /metrics                  Prometheus text format latency histograms and counters
+        GET  /healthz
+   Requests are rejected with 503 while the batcher is full, and with 413 above max_body bytes.
+"""
+class StyleServer():
+    def __init__(self, engine, batcher, directions, max_body=32 * 2**20):
+        self.engine = engine
+        self.batcher = batcher
+        self.directions = directions
+        self.max_body = max_body
+        self.decoders = ThreadPoolExecutor(max_workers=4)
+
+        #hash the checkpoints of the result cache keys now, rather than on the event loop at the first request
+        if engine.cache is not None:
+            for direction in directions:
+                engine.checkpoint_digest(direction)
+
+        self.latency = Histogram('stylize_request_seconds', 'Time from admission to response for /stylize.', LATENCY_BUCKETS)
+        self.responses = collections.Counter()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > self.max_body:
+                    self._respond(writer, 413, 'text/plain', b'Request body too large\n', keep_alive=False)
+                    await writer.drain()
+                    break
+                body = await reader.readexactly(length)
+
+                status, content_type, payload, extra_headers = await self.dispatch(method, target, body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                self._respond(writer, status, content_type, payload, keep_alive, extra_headers)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == '/stylize' and method == 'POST':
+            response = await self.stylize(body, query.get('direction', [self.directions[0]])[0])
+        elif url.path == '/metrics' and method == 'GET':
+            response = 200, 'text/plain; version=0.0.4', self.metrics().encode(), {}
+        elif url.path == '/healthz' and method == 'GET':
+            response = 200, 'text/plain', b'ok\n', {}
+        else:
+            response = 404, 'text/plain', b'Not found\n', {}
+
+        self.responses[response[0]] += 1
+        return response
+
+    async def stylize(self, body, direction):
+        if direction not in self.directions:
+            return 400, 'text/plain', 'Unknown direction {}\n'.format(direction).encode(), {}
+        loop = asyncio.get_event_loop()
+        arrival = time.time()
+
+        #cache hits are answered without decoding and regardless of the queue (the body is hashed off the event loop)
+        key = None
+        if self.engine.cache is not None:
+            key = await loop.run_in_executor(self.decoders, self.engine.cache_key, body, direction)
+            output = await loop.run_in_executor(self.decoders, self.engine.cache.get, key)
+            if output is not None:
+                self.latency.observe(time.time() - arrival)
+                return 200, 'image/png', output, {}
+
+        #the slot is taken before decoding, so requests waiting for a decoder count against max_queue too
+        if not self.batcher.reserve():
+            return 503, 'text/plain', b'Queue full\n', {'Retry-After': '1'}
+
+        try:
+            try:
+                image = await loop.run_in_executor(self.decoders, decode_image, body)
+            except Exception as e:
+                return 400, 'text/plain', 'Cannot decode image: {}\n'.format(e).encode(), {}
+
+            try:
+                output = await self.batcher.submit(image, direction, arrival)
+            except Exception as e:
+                return 500, 'text/plain', 'Inference failed: {}\n'.format(e).encode(), {}
+        finally:
+            self.batcher.release()
+
+        if key is not None:
+            loop.run_in_executor(self.decoders, self.engine.cache.put, key, output)
+
+        self.latency.observe(time.time() - arrival)
+        return 200, 'image/png', output, {}
+
+    def metrics(self):
+        lines = []
+        for histogram in (self.latency, self.batcher.queue_wait, self.batcher.inference_time, self.batcher.batch_size):
+            lines.extend(histogram.render())
+
+        lines.append('# TYPE stylize_responses_total counter')
+        for status, count in sorted(self.responses.items()):
+            lines.append('stylize_responses_total{{status="{}"}} {}'.format(status, count))
+        lines.append('# TYPE stylize_pending gauge')
+        lines.append('stylize_pending {}'.format(self.batcher.pending))
+        if self.engine.cache is not None:
+            lines.append('# TYPE stylize_cache_lookups_total counter')
+            lines.append('stylize_cache_lookups_total{{result="hit"}} {}'.format(self.engine.cache.hits))
+            lines.append('stylize_cache_lookups_total{{result="miss"}} {}'.format(self.engine.cache.misses))
+        return '\n'.join(lines) + '\n'
+
+    def _respond(self, writer, status, content_type, payload, keep_alive, extra_headers=None):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+        headers = ['HTTP/1.1 {} {}'.format(status, reasons.get(status, '')),
+                   'Content-Type: {}'.format(content_type),
+                   'Content-Length: {}'.format(len(payload)),
+                   'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+        headers.extend('{}: {}'.format(name, value) for name, value in (extra_headers or {}).items())
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + payload)
+
+    def close(self):
+        self.decoders.shutdown()
+
+
+async def serve(opts):
+    engine = InferenceEngine(opts.checkpoint_dir, opts.iteration, directions=tuple(opts.directions), device=opts.device, quantized=opts.quantized, cache=create_cache(opts), optimize=opts.optimize)
+    batcher = DynamicBatcher(engine, opts.max_batch, opts.max_wait_ms / 1000.0, opts.max_queue, opts.workers)
+    server = StyleServer(engine, batcher, opts.directions, opts.max_body_mb * 2**20)
+
+    batching = asyncio.ensure_future(batcher.run())
+    listener = await asyncio.start_server(server.handle, opts.host, opts.port)
+    print('Serving {} on http://{}:{} (max batch {}, max wait {} ms, max queue {}, {} workers)'.format(
+        ', '.join(opts.directions), opts.host, opts.port, opts.max_batch, opts.max_wait_ms, opts.max_queue, opts.workers))
+
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        batching.cancel()
+        batcher.close()
+        server.close()
+        engine.close()
+
+
+"""Creates the command-line parser for the server."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints_cyclegan')
+    parser.add_argument('--iteration', type=int, default=37000)
+    parser.add_argument('--directions', type=str, nargs='+', default=['YtoX'], choices=['XtoY', 'YtoX'], help='Generators to load; the first is the default.')
+    parser.add_argument('--device', type=str, default=None)
+    parser.add_argument('--quantized', action='store_true', default=False, help='Serve the int8 generators written by quantize.py (CPU only).')
+    parser.add_argument('--optimize', action='store_true', default=False, help='Serve the generators rewritten for inference (folded pads, in-place activations).')
+
+    # Batching and backpressure
+    parser.add_argument('--max_batch', type=int, default=8, help='Maximum number of equally sized images per batch.')
+    parser.add_argument('--max_wait_ms', type=float, default=10, help='Maximum time a request waits for its batch to fill.')
+    parser.add_argument('--max_queue', type=int, default=64, help='Requests queued or running beyond which new ones get 503.')
+    parser.add_argument('--workers', type=int, default=2, help='Number of batches run concurrently.')
+    parser.add_argument('--max_body_mb', type=int, default=32)
+
+    # Result cache
+    add_cache_args(parser)
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+    try:
+        asyncio.run(serve(opts))
+    except KeyboardInterrupt:
+        pass
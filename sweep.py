@@ -0,0 +1,136 @@
+# Renders one test set across many checkpoints, with one contact sheet per image
+
+import os
+import re
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image, ImageDraw
+
+import utils
+from models import build_generator
+from inference import load_image, hwc_to_uint8, inference_mode, load_generator_config
+
+
+LABEL_HEIGHT = 14
+
+
+"""Sorted iterations of the saved generators of a direction (G_<direction>_<iteration>_.pkl) in checkpoint_dir."""
+def find_iterations(checkpoint_dir, direction='YtoX'):
+    pattern = re.compile('^G_' + direction + r'_(\d+)_\.pkl$')
+    matches = [pattern.match(name) for name in os.listdir(checkpoint_dir)]
+    return sorted(int(m.group(1)) for m in matches if m)
+
+
+#Runs in the prefetch thread: reads one state_dict to (pinned, when copying to a GPU) host memory
+def _read_state(path, pin):
+    state = torch.load(path, map_location=lambda storage, loc: storage)
+    if pin:
+        state = collections.OrderedDict((k, v.pin_memory()) for k, v in state.items())
+    return state
+
+
+#Downscales an N x C x H x W batch so its longer side is at most size, then converts to N x h x w x C uint8 arrays
+def _thumbnails(batch, size):
+    scale = min(1.0, float(size) / max(batch.shape[2:]))
+    if scale < 1.0:
+        batch = F.interpolate(batch, scale_factor=scale, mode='bilinear', align_corners=False, antialias=True)
+    return [hwc_to_uint8(image) for image in batch.permute(0, 2, 3, 1)]
+
+
+#Writes a grid of labelled cells (uint8 h x w x 3 arrays of equal size), columns cells per row
+def _contact_sheet(cells, labels, columns, path):
+    h, w = cells[0].shape[:2]
+    rows = (len(cells) + columns - 1) // columns
+    sheet = np.full((rows * (h + LABEL_HEIGHT), min(columns, len(cells)) * w, 3), 255, dtype=np.uint8)
+    for i, cell in enumerate(cells):
+        r, c = divmod(i, columns)
+        top = r * (h + LABEL_HEIGHT) + LABEL_HEIGHT
+        sheet[top:top + h, c * w:(c + 1) * w] = cell
+
+    image = Image.fromarray(sheet)
+    draw = ImageDraw.Draw(image)
+    for i, label in enumerate(labels):
+        r, c = divmod(i, columns)
+        draw.text((c * w + 2, r * (h + LABEL_HEIGHT) + 1), label, fill=(0, 0, 0))
+    image.save(path)
+
+
+"""Renders every image of img_dir with the generator of each iteration and writes one contact sheet per image
+   (the input followed by the output of each iteration, in order) to output_dir.
+   The inputs are decoded once and kept on the device as batches of equally sized images. All checkpoints are
+   loaded into one preallocated generator by copying their state_dicts in place, and the next checkpoint is read
+   from disk by a background thread while the current one runs. Outputs are kept as thumbnails whose longer side
+   is thumb_size. Returns the number of seconds spent waiting for checkpoints that were not prefetched in time.
+"""
+def sweep(img_dir, output_dir, checkpoint_dir, iterations, direction='YtoX', batch_size=8, thumb_size=256, columns=8, device=None):
+    start_time = time.time()
+    paths = [os.path.join(checkpoint_dir, 'G_' + direction + '_' + str(iteration) + '_.pkl') for iteration in iterations]
+    if not paths:
+        raise ValueError('No {} generator checkpoints (G_{}_<iteration>_.pkl) to sweep in {}.'.format(direction, direction, checkpoint_dir))
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise ValueError('Missing {} generator checkpoints in {}: {}'.format(direction, checkpoint_dir, ', '.join(os.path.basename(path) for path in missing)))
+
+    device = torch.device(device if device is not None else ('cuda' if torch.cuda.is_available() else 'cpu'))
+    utils.create_dir(output_dir)
+
+    #1. decode and batch the test set once
+    names = sorted(entry.name for entry in os.scandir(img_dir) if entry.is_file())
+    groups = collections.OrderedDict()
+    for name in names:
+        x = load_image(os.path.join(img_dir, name))
+        groups.setdefault(tuple(x.shape), []).append((name, x))
+
+    batches = []
+    for group in groups.values():
+        for start in range(0, len(group), batch_size):
+            chunk = group[start:start + batch_size]
+            batches.append(([name for name, _ in chunk], torch.stack([x for _, x in chunk]).to(device)))
+
+    cells = {name: [] for name in names}
+    for batch_names, batch in batches:
+        for name, thumbnail in zip(batch_names, _thumbnails(batch, thumb_size)):
+            cells[name].append(thumbnail)
+
+    #2. stream the checkpoints through one model, prefetching the next one
+    G = build_generator(load_generator_config(checkpoint_dir)).to(device).eval()
+    for param in G.parameters():
+        param.requires_grad_(False)
+
+    pin = device.type == 'cuda'
+    prefetcher = ThreadPoolExecutor(max_workers=1)
+    next_state = prefetcher.submit(_read_state, paths[0], pin)
+    load_wait = 0.0
+
+    for i, iteration in enumerate(iterations):
+        wait_start = time.time()
+        state = next_state.result()
+        load_wait += time.time() - wait_start
+        if i + 1 < len(iterations):
+            next_state = prefetcher.submit(_read_state, paths[i + 1], pin)
+
+        G.load_state_dict(state)
+        del state
+
+        iteration_start = time.time()
+        with inference_mode():
+            for batch_names, batch in batches:
+                for name, thumbnail in zip(batch_names, _thumbnails(G(batch), thumb_size)):
+                    cells[name].append(thumbnail)
+        print('Iteration {}: {} images in {:.1f}s'.format(iteration, len(names), time.time() - iteration_start))
+
+    prefetcher.shutdown()
+
+    #3. one contact sheet per image
+    labels = ['input'] + [str(iteration) for iteration in iterations]
+    for name in names:
+        _contact_sheet(cells[name], labels, columns, os.path.join(output_dir, os.path.splitext(name)[0] + '_sweep.png'))
+
+    print('Swept {} checkpoints over {} images in {:.1f}s ({:.1f}s waiting for checkpoint reads)'.format(
+        len(iterations), len(names), time.time() - start_time, load_wait))
+    return load_wait
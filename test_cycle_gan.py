@@ -1,42 +1,92 @@
 import os
-import numpy as np
-import torch
-import torchvision.transforms.functional as TF
-from PIL import Image
-from scipy import misc
-from models import CycleGenerator2d
+import argparse
+
+from inference import InferenceEngine, load_generator
+from profiling import WindowedProfiler, add_profiler_args
+from result_cache import add_cache_args, create_cache
+from sweep import sweep, find_iterations
 
 """Loads the generator and discriminator models from checkpoints."""
 def load_checkpoint(checkpoint_dir, iteration_num):
-    G_YtoX_path = os.path.join(checkpoint_dir, 'G_YtoX_' + str(iteration_num) + '_.pkl')
-    G_YtoX = CycleGenerator2d()
-    G_YtoX.load_state_dict(torch.load(G_YtoX_path, map_location=lambda storage, loc: storage))
-    return G_YtoX
+    return load_generator(checkpoint_dir, iteration_num, 'YtoX')
 
 """Loads the real image found in img_dir and transfer it to the style of Van Gogh using the specified model iteration. Then, save the painting in output_dir."""
-def test_image_to_painting(img_dir, output_dir, iteration):
-        image = Image.open(img_dir)
-        image = np.stack((image, image, image), axis=2)
+def test_image_to_painting(img_dir, output_dir, iteration, engine=None):
+    if engine is not None:
+        engine.stylize_files([img_dir], [output_dir], 'YtoX')
+        return
+
+    engine = InferenceEngine(os.path.join('./checkpoints_cyclegan'), iteration)
+    engine.stylize_files([img_dir], [output_dir], 'YtoX')
+    engine.close()
+
+def test_all_images_in_dir(img_dir, output_dir, iteration, opts=None):
+    checkpoint_dir = getattr(opts, 'checkpoint_dir', os.path.join('./checkpoints_cyclegan'))
+    direction = getattr(opts, 'direction', 'YtoX')
+
+    engine = InferenceEngine(checkpoint_dir, iteration, directions=(direction,), batch_size=getattr(opts, 'batch_size', 8), num_writers=getattr(opts, 'num_writers', 4),
+                             memory_budget=getattr(opts, 'memory_budget_mb', 0) * 2**20, tile_batch=getattr(opts, 'tile_batch', 4), quantized=getattr(opts, 'quantized', False), cache=create_cache(opts), optimize=getattr(opts, 'optimize', False))
+    engine.profiler = WindowedProfiler(opts, {} if engine.quantized else {'G_' + direction: engine.generator(direction)})
+
+    if getattr(opts, 'pipeline', False):
+        engine.stylize_dir_pipelined(img_dir, output_dir, direction, decode_workers=opts.decode_workers, queue_depth=opts.queue_depth, skip_existing=not opts.overwrite)
+    else:
+        engine.stylize_dir(img_dir, output_dir, direction)
+
+    engine.profiler.close()
+    engine.close()
+    if engine.cache is not None:
+        print(engine.cache)
+
+
+"""Creates the command-line parser for inference."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input', type=str, default=os.path.join('./MRI_Data_2d', 'Test_pre_contrast'), help='An image file or a directory of images.')
+    parser.add_argument('--output', type=str, default=os.path.join('./MRI_Data_2d', 'pre_contrast_to_flair'), help='Output file (for a single input image) or directory.')
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints_cyclegan')
+    parser.add_argument('--iteration', type=int, default=37000, help='Iteration of the checkpoint to load.')
+    parser.add_argument('--direction', type=str, default='YtoX', choices=['XtoY', 'YtoX'], help='Which generator to run.')
+    parser.add_argument('--batch_size', type=int, default=8, help='Maximum number of equally sized images run together.')
+    parser.add_argument('--num_writers', type=int, default=4, help='Number of threads encoding and writing outputs.')
+    parser.add_argument('--memory_budget_mb', type=int, default=0, help='Run each image in overlapping tiles whose activations fit this budget (0 runs whole frames).')
+    parser.add_argument('--tile_batch', type=int, default=4, help='Number of tiles run together in tiled mode.')
+    parser.add_argument('--quantized', action='store_true', default=False, help='Run the int8 generator written by quantize.py (CPU only).')
+    parser.add_argument('--optimize', action='store_true', default=False, help='Run the generator rewritten for inference (folded pads, in-place activations).')
+
+    # Streaming directory mode
+    parser.add_argument('--pipeline', action='store_true', default=False, help='Overlap decoding, inference and encoding (for large directories).')
+    parser.add_argument('--decode_workers', type=int, default=4, help='Number of threads decoding inputs in pipeline mode.')
+    parser.add_argument('--queue_depth', type=int, default=64, help='Maximum number of decoded images waiting for the model in pipeline mode.')
+    parser.add_argument('--overwrite', action='store_true', default=False, help='In pipeline mode, also redo outputs that are newer than the checkpoint.')
 
-        x = TF.to_tensor(image)
-        x.unsqueeze_(0)
+    # Checkpoint sweep
+    parser.add_argument('--sweep', action='store_true', default=False, help='Render the input directory with several checkpoints into one contact sheet per image.')
+    parser.add_argument('--iterations', type=int, nargs='*', default=None, help='Iterations to sweep (all checkpoints found in checkpoint_dir by default).')
+    parser.add_argument('--thumb_size', type=int, default=256, help='Longer side of each image in the contact sheets.')
+    parser.add_argument('--sheet_columns', type=int, default=8, help='Number of images per contact sheet row.')
 
-        G_YtoX = load_checkpoint(os.path.join('./checkpoints_cyclegan'), iteration)
+    # Result cache
+    add_cache_args(parser)
 
-        generated_van_gogh = G_YtoX(x)
-        generated_van_gogh = torch.squeeze(generated_van_gogh)
-        generated_van_gogh = generated_van_gogh.detach().numpy()
-        generated_van_gogh = np.swapaxes(generated_van_gogh, 0, 2)
-        generated_van_gogh = np.rot90(np.flip(generated_van_gogh, 0), k=1, axes=(1,0))
+    # Profiling
+    add_profiler_args(parser)
 
-        misc.imsave(output_dir, generated_van_gogh)
+    return parser
 
-def test_all_images_in_dir(img_dir, output_dir, iteration):
-    all_test_images = os.listdir(img_dir)
-    for img in all_test_images:
-        test_image_to_painting(os.path.join(img_dir, img), os.path.join(output_dir, img), iteration)
 
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
 
-#transfer the specified image to a van gogh style painting
-test_all_images_in_dir(os.path.join('./MRI_Data_2d', 'Test_pre_contrast'), os.path.join('./MRI_Data_2d', 'pre_contrast_to_flair'), 37000)
-#test_image_to_painting(os.path.join('./test_images', 'baldwin.jpg'), os.path.join('./test_images', 'baldwin_painting.jpg'), 37000)
+    #transfer the specified image(s) to a van gogh style painting
+    if opts.sweep:
+        iterations = opts.iterations or find_iterations(opts.checkpoint_dir, opts.direction)
+        sweep(opts.input, opts.output, opts.checkpoint_dir, iterations, opts.direction, opts.batch_size, opts.thumb_size, opts.sheet_columns)
+    elif os.path.isdir(opts.input):
+        test_all_images_in_dir(opts.input, opts.output, opts.iteration, opts)
+    else:
+        engine = InferenceEngine(opts.checkpoint_dir, opts.iteration, directions=(opts.direction,), memory_budget=opts.memory_budget_mb * 2**20, tile_batch=opts.tile_batch, quantized=opts.quantized, cache=create_cache(opts), optimize=opts.optimize)
+        engine.stylize_files([opts.input], [opts.output], opts.direction)
+        engine.close()
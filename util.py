@@ -1,39 +1,39 @@
-import itertools, imageio, torch, random
-import matplotlib.pyplot as plt
+import os, itertools, torch, random
 import numpy as np
-from torchvision import datasets
-from scipy.misc import imresize
 from torch.autograd import Variable
 
-def show_result(G, x_, y_, num_epoch, show = False, save = False, path = 'result.png'):
-    test_images = G(x_)
+# matplotlib, imageio, torchvision and PIL are imported by the functions that use them,
+# so that importing util (e.g. for ImagePool) stays cheap
 
-    size_figure_grid = 3
-    fig, ax = plt.subplots(x_.size()[0], size_figure_grid, figsize=(5, 5))
-    for i, j in itertools.product(range(x_.size()[0]), range(size_figure_grid)):
-        ax[i, j].get_xaxis().set_visible(False)
-        ax[i, j].get_yaxis().set_visible(False)
+"""Uint8 image of an array in [-1, 1] (the range of the generator outputs)."""
+def to_uint8(array):
+    return np.clip((np.asarray(array) + 1) * 127.5 + 0.5, 0, 255).astype(np.uint8)
 
-    for i in range(x_.size()[0]):
-        ax[i, 0].cla()
-        ax[i, 0].imshow((x_[i].cpu().data.numpy().transpose(1, 2, 0) + 1) / 2)
-        ax[i, 1].cla()
-        ax[i, 1].imshow((test_images[i].cpu().data.numpy().transpose(1, 2, 0) + 1) / 2)
-        ax[i, 2].cla()
-        ax[i, 2].imshow((y_[i].numpy().transpose(1, 2, 0) + 1) / 2)
+"""Uint8 H x W x 3 image of a grid of [-1, 1] image batches, composed with array reshapes: row i holds image i of
+   every batch in columns (each an N x C x H x W tensor or array; single-band images are repeated to RGB)."""
+def sample_grid(columns):
+    columns = [c.detach().cpu().numpy() if torch.is_tensor(c) else np.asarray(c) for c in columns]
+    grid = np.stack([np.repeat(c, 3, axis=1) if c.shape[1] == 1 else c for c in columns], axis=1)
+    n, k, c, h, w = grid.shape
+    return to_uint8(grid.transpose(0, 3, 1, 4, 2).reshape(n * h, k * w, c))
 
-    label = 'Epoch {0}'.format(num_epoch)
-    fig.text(0.5, 0.04, label, ha='center')
+def show_result(G, x_, y_, num_epoch, show = False, save = False, path = 'result.png'):
+    grid = sample_grid([x_, G(x_), y_])
 
     if save:
-        plt.savefig(path)
+        from PIL import Image
+        Image.fromarray(grid).save(path)
 
     if show:
+        import matplotlib.pyplot as plt
+        plt.imshow(grid)
+        plt.title('Epoch {0}'.format(num_epoch))
+        plt.axis('off')
         plt.show()
-    else:
-        plt.close()
 
 def show_train_hist(hist, show = False, save = False, path = 'Train_hist.png'):
+    import matplotlib.pyplot as plt
+
     x = range(len(hist['D_A_losses']))
 
     y1 = hist['D_A_losses']
@@ -67,53 +67,233 @@ def show_train_hist(hist, show = False, save = False, path = 'Train_hist.png'):
         plt.close()
 
 def generate_animation(root, model, opt):
-    images = []
-    for e in range(opt.train_epoch):
-        img_name = root + 'Fixed_results/' + model + str(e + 1) + '.png'
-        images.append(imageio.imread(img_name))
-    imageio.mimsave(root + model + 'generate_animation.gif', images, fps=5)
+    from PIL import Image
 
-def data_load(path, subfolder, transform, batch_size, shuffle=False):
-    dset = datasets.ImageFolder(path, transform)
-    ind = dset.class_to_idx[subfolder]
+    with AnimationWriter(root + model + 'generate_animation.gif', fps=5) as writer:
+        for e in range(opt.train_epoch):
+            img_name = root + 'Fixed_results/' + model + str(e + 1) + '.png'
+            writer.append(np.asarray(Image.open(img_name).convert('RGB')))
+
+"""Writes an animation frame by frame as frames are produced, without holding them in memory:
+   - .gif and .png (animated PNG) files are encoded and written one frame at a time,
+   - other extensions (e.g. .mp4) go through an imageio writer (ffmpeg streams the frames).
+   Frames are H x W x 3 uint8 arrays; frames larger than max_size (longest side, 0 for no limit) are downscaled,
+   and every frame is resized to the size of the first one. For long runs, only every stride-th appended frame
+   is written, and the stride doubles after every max_frames written frames, so the file grows with the log of
+   the run length.
+   Usage:
+        with AnimationWriter('samples/progress.gif', fps=5) as writer:
+            writer.append(sample_grid([x, G(x)]))
+"""
+class AnimationWriter():
+    def __init__(self, path, fps=5, max_frames=200, max_size=0):
+        self.path = path
+        self.fps = fps
+        self.max_frames = max_frames
+        self.max_size = max_size
+        self.size = None
+        self.stride = 1
+        self.appended = 0
+        self.written = 0
+
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.gif':
+            self.stream = _GifStream(path, fps)
+        elif extension in ('.png', '.apng'):
+            self.stream = _ApngStream(path, fps)
+        else:
+            import imageio
+            self.stream = imageio.get_writer(path, fps=fps)
+
+    """Adds a frame (written only if it falls on the current stride)."""
+    def append(self, frame):
+        self.appended += 1
+        if (self.appended - 1) % self.stride:
+            return
+
+        self.stream.append_data(self._resize(np.asarray(frame, dtype=np.uint8)))
+        self.written += 1
+        if self.max_frames and self.written % self.max_frames == 0:
+            self.stride *= 2
+
+    #Downscales the first frame to max_size and every later frame to the size of the first
+    def _resize(self, frame):
+        if frame.ndim == 2:
+            frame = np.repeat(frame[:, :, None], 3, axis=2)
+        frame = frame[:, :, :3]
+        if self.size is None:
+            h, w = frame.shape[:2]
+            scale = min(1.0, float(self.max_size) / max(h, w)) if self.max_size else 1.0
+            self.size = (max(int(round(w * scale)), 1), max(int(round(h * scale)), 1))
+        if frame.shape[1::-1] != self.size:
+            from PIL import Image
+            frame = np.asarray(Image.fromarray(frame).resize(self.size, Image.BILINEAR))
+        return np.ascontiguousarray(frame)
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#Looping GIF written frame by frame (each frame with its own adaptive palette)
+class _GifStream():
+    def __init__(self, path, fps):
+        self.file = open(path, 'wb')
+        self.duration = int(round(1000.0 / fps))
+        self.started = False
+
+    def append_data(self, frame):
+        from PIL import Image, GifImagePlugin
+
+        image = Image.fromarray(frame).convert('P', palette=Image.ADAPTIVE)
+        if not self.started:
+            header, _ = GifImagePlugin.getheader(image, info={'loop': 0, 'duration': self.duration})
+            self.file.write(b''.join(header))
+            self.started = True
+        self.file.write(b''.join(GifImagePlugin.getdata(image, duration=self.duration, disposal=1, include_color_table=True)))
+
+    def close(self):
+        if not self.file.closed:
+            if self.started:
+                self.file.write(b';')
+            self.file.close()
+
+#Looping animated PNG written frame by frame; the frame count of the acTL chunk is filled in on close
+class _ApngStream():
+    def __init__(self, path, fps):
+        self.file = open(path, 'wb')
+        self.delay = int(round(1000.0 / fps))
+        self.frames = 0
+        self.sequence = 0
+
+    #Writes a chunk (length, type, data, CRC) and returns the file offset of its data
+    def _chunk(self, kind, data):
+        import struct, zlib
+
+        self.file.write(struct.pack('>I', len(data)) + kind)
+        offset = self.file.tell()
+        self.file.write(data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+        return offset
 
-    n = 0
-    for i in range(dset.__len__()):
-        if ind != dset.imgs[n][1]:
-            del dset.imgs[n]
-            n -= 1
+    def append_data(self, frame):
+        import struct, zlib
 
-        n += 1
+        h, w = frame.shape[:2]
+        if self.frames == 0:
+            self.file.write(b'\x89PNG\r\n\x1a\n')
+            self._chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0))
+            self.actl = self._chunk(b'acTL', struct.pack('>II', 0, 0))
 
+        self._chunk(b'fcTL', struct.pack('>IIIIIHHBB', self.sequence, w, h, 0, 0, self.delay, 1000, 0, 0))
+        self.sequence += 1
+
+        #scanlines with filter type 0 (none)
+        pixels = zlib.compress(np.concatenate([np.zeros((h, 1), np.uint8), frame.reshape(h, w * 3)], axis=1).tobytes(), 6)
+        if self.frames == 0:
+            self._chunk(b'IDAT', pixels)
+        else:
+            self._chunk(b'fdAT', struct.pack('>I', self.sequence) + pixels)
+            self.sequence += 1
+        self.frames += 1
+
+    def close(self):
+        import struct, zlib
+
+        if self.file.closed:
+            return
+        if self.frames:
+            self._chunk(b'IEND', b'')
+            data = struct.pack('>II', self.frames, 0)
+            self.file.seek(self.actl)
+            self.file.write(data + struct.pack('>I', zlib.crc32(b'acTL' + data) & 0xffffffff))
+        self.file.close()
+
+# Image files of the class folders data_load has listed: folder -> ({directory: mtime} of every walked directory, sorted paths)
+_class_index = {}
+
+#Sorted image files below one class folder, in ImageFolder's order; listed once per folder and listed again only
+#if one of its directories (at any depth) changed, which only takes a stat per directory
+def _class_files(folder):
+    from torchvision.datasets.folder import IMG_EXTENSIONS
+
+    key = os.path.abspath(folder)
+    if key in _class_index:
+        mtimes, files = _class_index[key]
+        try:
+            if all(os.stat(directory).st_mtime_ns == mtime for directory, mtime in mtimes.items()):
+                return files
+        except OSError:
+            pass
+
+    mtimes, files = {}, []
+    for dirpath, _, filenames in sorted(os.walk(folder, followlinks=True)):
+        mtimes[dirpath] = os.stat(dirpath).st_mtime_ns
+        files.extend(os.path.join(dirpath, f) for f in sorted(filenames) if f.lower().endswith(IMG_EXTENSIONS))
+    _class_index[key] = (mtimes, files)
+    return files
+
+"""The images of one class folder of an ImageFolder root, with the same items (image, class index) and the same
+   classes, class_to_idx, samples, imgs and targets as datasets.ImageFolder(path) restricted to that class.
+   Only the requested folder is listed (see _class_files)."""
+class ClassFolder(torch.utils.data.Dataset):
+    def __init__(self, path, subfolder, transform=None):
+        from torchvision.datasets.folder import default_loader
+
+        self.classes = sorted(entry.name for entry in os.scandir(path) if entry.is_dir())
+        self.class_to_idx = {name: i for i, name in enumerate(self.classes)}
+        target = self.class_to_idx[subfolder]
+
+        self.samples = [(f, target) for f in _class_files(os.path.join(path, subfolder))]
+        self.imgs = self.samples
+        self.targets = [target] * len(self.samples)
+        self.transform = transform
+        self.loader = default_loader
+
+    def __getitem__(self, index):
+        path, target = self.samples[index]
+        sample = self.loader(path)
+        if self.transform is not None:
+            sample = self.transform(sample)
+        return sample, target
+
+    def __len__(self):
+        return len(self.samples)
+
+def data_load(path, subfolder, transform, batch_size, shuffle=False):
+    dset = ClassFolder(path, subfolder, transform)
     return torch.utils.data.DataLoader(dset, batch_size=batch_size, shuffle=shuffle)
 
+"""Resizes an N x C x H x W batch to resize_scale x resize_scale with one bilinear interpolate call. As the former
+   scipy.misc.imresize path (which byte-scaled each image before resizing), every image is stretched from its own
+   min..max to [-1, 1]."""
 def imgs_resize(imgs, resize_scale = 286):
-    outputs = torch.FloatTensor(imgs.size()[0], imgs.size()[1], resize_scale, resize_scale)
-    for i in range(imgs.size()[0]):
-        img = imresize(imgs[i].numpy(), [resize_scale, resize_scale])
-        outputs[i] = torch.FloatTensor((img.transpose(2, 0, 1).astype(np.float32).reshape(-1, imgs.size()[1], resize_scale, resize_scale) - 127.5) / 127.5)
+    imgs = imgs.float()
+    low, high = imgs.view(imgs.size(0), -1).aminmax(dim=1)
+    scale = (2 / (high - low).clamp(min=1e-8)).view(-1, 1, 1, 1)
+    imgs = torch.addcmul(-1 - low.view(-1, 1, 1, 1) * scale, imgs, scale)
 
-    return outputs
+    return torch.nn.functional.interpolate(imgs, size=(resize_scale, resize_scale), mode='bilinear', align_corners=False)
 
+"""Crops a random crop_size x crop_size window out of every image of an N x C x H x W batch: the offsets of the
+   whole batch are drawn at once (from np.random, as before) and the windows are picked out of an unfold view of the
+   batch with a single gather."""
 def random_crop(imgs, crop_size = 256):
-    outputs = torch.FloatTensor(imgs.size()[0], imgs.size()[1], crop_size, crop_size)
-    for i in range(imgs.size()[0]):
-        img = imgs[i]
-        rand1 = np.random.randint(0, imgs.size()[2] - crop_size)
-        rand2 = np.random.randint(0, imgs.size()[2] - crop_size)
-        outputs[i] = img[:, rand1: crop_size + rand1, rand2: crop_size + rand2]
+    n, _, h, w = imgs.size()
+    rows = torch.from_numpy(np.random.randint(0, h - crop_size + 1, size=n)).to(imgs.device)
+    cols = torch.from_numpy(np.random.randint(0, w - crop_size + 1, size=n)).to(imgs.device)
 
-    return outputs
+    windows = imgs.unfold(2, crop_size, 1).unfold(3, crop_size, 1)
+    return windows[torch.arange(n, device=imgs.device), :, rows, cols].float()
 
+"""Flips each image of an N x C x H x W batch left-right with probability 0.5 (one masked flip for the batch)."""
 def random_fliplr(imgs):
-    outputs = torch.FloatTensor(imgs.size())
-    for i in range(imgs.size()[0]):
-        if torch.rand(1)[0] < 0.5:
-            img = torch.FloatTensor(
-                (np.fliplr(imgs[i].numpy().transpose(1, 2, 0)).transpose(2, 0, 1).reshape(-1, imgs.size()[1], imgs.size()[2], imgs.size()[3]) + 1) / 2)
-            outputs[i] = (img - 0.5) / 0.5
-        else:
-            outputs[i] = imgs[i]
+    mask = (torch.rand(imgs.size(0)) < 0.5).to(imgs.device)
+    outputs = imgs.float().clone()
+    outputs[mask] = outputs[mask].flip(3)
 
     return outputs
 
@@ -175,4 +355,15 @@ class ImagePool():
                 else:
                     return_images.append(image)
         return_images = Variable(torch.cat(return_images, 0))
-        return return_images
\ No newline at end of file
+        return return_images
+
+    def state_dict(self):
+        if self.pool_size == 0:
+            return {}
+        return {'num_imgs': self.num_imgs, 'images': [image.cpu() for image in self.images]}
+
+    def load_state_dict(self, state):
+        if self.pool_size == 0:
+            return
+        self.num_imgs = state['num_imgs']
+        self.images = [image.cuda() if torch.cuda.is_available() else image for image in state['images']]
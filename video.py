@@ -0,0 +1,197 @@
+# Frame-sequence style transfer that recomputes only the tiles that changed since they were last run
+
+import os
+import time
+import shutil
+import threading
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+import utils
+from inference import (InferenceEngine, load_image, inference_mode, receptive_field, pad_to_stride,
+                       round_tile_size, tile_layout, tile_weight)
+from metrics import psnr
+
+
+"""Converts a C x H x W tanh output to an H x W x C uint8 array with a fixed [-1, 1] -> [0, 255] mapping
+   (per-frame min-max scaling would make the brightness of a sequence flicker)."""
+def tanh_to_uint8(image):
+    return ((image.permute(1, 2, 0) + 1) * 127.5 + 0.5).clamp(0, 255).to(torch.uint8).numpy()
+
+
+"""Stylizes the frames of a sequence one at a time, in a fixed grid of overlapping tiles (as tiled_forward).
+   Each tile keeps the input window it was last run on and its weighted output. A tile is recomputed only if
+   its window (including the receptive-field margin around it) differs from that reference: the per-pixel
+   absolute difference is averaged over channels and pool x pool blocks, and any block above threshold marks the
+   tile as changed. Comparing against the reference rather than the previous frame keeps slow drifts from
+   accumulating. Changed tiles are run tile_batch at a time and patched into a running blend of all tiles.
+"""
+class TemporalStylizer():
+    def __init__(self, model, tile_size=512, threshold=0.02, pool=8, tile_batch=4):
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.margin, self.stride = receptive_field(model)
+        self.tile = round_tile_size(tile_size, self.margin, self.stride)
+        self.threshold = threshold
+        self.pool = pool
+        self.tile_batch = tile_batch
+        self.shape = None
+
+    #Sets up the tile grid and empty caches for frames of a new size
+    def _reset(self, shape):
+        _, Hp, Wp = shape
+        self.shape = shape
+        self.th, self.tw, self.tiles = tile_layout(Hp, Wp, self.tile, self.margin, self.stride)
+        self.weights = [tile_weight(y, z, self.th, self.tw, Hp, Wp, self.margin) for y, z in self.tiles]
+
+        self.weight_sum = torch.zeros(1, Hp, Wp)
+        for w, (y, z) in zip(self.weights, self.tiles):
+            self.weight_sum[:, y:y + self.th, z:z + self.tw] += w
+
+        self.references = [None] * len(self.tiles)
+        self.contributions = [None] * len(self.tiles)
+        self.blend = None
+
+    def _changed(self, window, reference):
+        diff = (window - reference).abs().mean(0, keepdim=True)
+        return F.avg_pool2d(diff[None], self.pool, ceil_mode=True).max().item() > self.threshold
+
+    """Stylizes one 3 x H x W frame. Returns (output C x H x W, number of tiles recomputed, number of tiles)."""
+    def __call__(self, x):
+        _, H, W = x.shape
+        x = pad_to_stride(x, self.stride)
+        if self.shape != tuple(x.shape):
+            self._reset(tuple(x.shape))
+
+        th, tw = self.th, self.tw
+        changed = [i for i, (y, z) in enumerate(self.tiles)
+                   if self.references[i] is None or self._changed(x[:, y:y + th, z:z + tw], self.references[i])]
+
+        for start in range(0, len(changed), self.tile_batch):
+            chunk = changed[start:start + self.tile_batch]
+            batch = torch.stack([x[:, y:y + th, z:z + tw] for y, z in (self.tiles[i] for i in chunk)]).to(self.device)
+            result = self.model(batch).float().cpu()
+
+            if self.blend is None:
+                self.blend = torch.zeros(result.size(1), *x.shape[1:])
+
+            for i, tile_out in zip(chunk, result):
+                y, z = self.tiles[i]
+                contribution = tile_out * self.weights[i]
+                if self.contributions[i] is not None:
+                    contribution_delta = contribution - self.contributions[i]
+                else:
+                    contribution_delta = contribution
+                self.blend[:, y:y + th, z:z + tw] += contribution_delta
+
+                self.contributions[i] = contribution
+                self.references[i] = x[:, y:y + th, z:z + tw].clone()
+
+        return (self.blend / self.weight_sum)[:, :H, :W], len(changed), len(self.tiles)
+
+
+#Runs in a writer thread
+def _save(image, path):
+    Image.fromarray(image).save(path)
+
+
+#Runs in a writer thread: copies the output of a fully reused frame once it has been written
+def _copy_after(future, src, dst):
+    future.result()
+    shutil.copyfile(src, dst)
+
+
+"""Stylizes every frame of frame_dir (in name order) into output_dir as PNG files. Frames in which no tile
+   changed reuse the previous encoded output. The first baseline_frames frames are also run naively (the whole
+   frame, with no reuse) to report the speedup and the PSNR of the temporal result against naive inference."""
+def stylize_frames(G, frame_dir, output_dir, tile_size=512, threshold=0.02, pool=8, tile_batch=4, baseline_frames=8, num_writers=4):
+    utils.create_dir(output_dir)
+    names = sorted(entry.name for entry in os.scandir(frame_dir) if entry.is_file())
+    stylizer = TemporalStylizer(G, tile_size, threshold, pool, tile_batch)
+    writers = ThreadPoolExecutor(max_workers=num_writers)
+    pending_writes = threading.BoundedSemaphore(4 * num_writers)
+    futures, samples, last = [], [], None
+
+    computed, total, reused_frames = 0, 0, 0
+    start_time = time.time()
+
+    with inference_mode():
+        for i, name in enumerate(names):
+            x = load_image(os.path.join(frame_dir, name))
+            output, n_changed, n_tiles = stylizer(x)
+            computed += n_changed
+            total += n_tiles
+            if i < baseline_frames:
+                samples.append(output.clone())
+
+            #at most 4 * num_writers frames wait for a writer; completed writes are dropped (and their errors raised)
+            output_path = os.path.join(output_dir, os.path.splitext(name)[0] + '.png')
+            pending_writes.acquire()
+            if n_changed == 0 and last is not None:
+                reused_frames += 1
+                last = writers.submit(_copy_after, last, previous_path, output_path)
+            else:
+                last = writers.submit(_save, tanh_to_uint8(output), output_path)
+            last.add_done_callback(lambda f: pending_writes.release())
+            previous_path = output_path
+
+            done = [f for f in futures if f.done()]
+            for future in done:
+                future.result()
+            futures = [f for f in futures if f not in done] + [last]
+
+    for future in futures:
+        future.result()
+    writers.shutdown()
+    seconds = time.time() - start_time
+
+    print('Stylized {} frames in {:.1f}s ({:.3f} s/frame): recomputed {}/{} tiles ({:.1f}%), {} frames fully reused'.format(
+        len(names), seconds, seconds / max(len(names), 1), computed, total, 100.0 * computed / max(total, 1), reused_frames))
+
+    if samples:
+        device = next(G.parameters()).device
+        naive_time, scores = 0.0, []
+        with inference_mode():
+            for name, ours in zip(names, samples):
+                x = load_image(os.path.join(frame_dir, name))
+                start = time.time()
+                naive = G(x[None].to(device))[0].float().cpu()
+                naive_time += time.time() - start
+                scores.append(psnr(ours[None], naive[None]))
+
+        naive_per_frame = naive_time / len(samples)
+        print('Naive per-frame inference: {:.3f} s/frame (on the first {} frames) -> speedup {:.2f}x | PSNR vs naive {:.2f} dB'.format(
+            naive_per_frame, len(samples), naive_per_frame * len(names) / seconds, sum(scores) / len(scores)))
+
+    return seconds
+
+
+"""Creates the command-line parser for frame-sequence inference."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input', type=str, required=True, help='Directory of frames (processed in name order).')
+    parser.add_argument('--output', type=str, required=True, help='Directory of the stylized frames.')
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints_cyclegan')
+    parser.add_argument('--iteration', type=int, default=37000)
+    parser.add_argument('--direction', type=str, default='XtoY', choices=['XtoY', 'YtoX'])
+    parser.add_argument('--tile_size', type=int, default=512, help='Tile size including the receptive-field margin (at least 4 margins).')
+    parser.add_argument('--threshold', type=float, default=0.02, help='Mean absolute difference (0..1) of a pool x pool block above which a tile is recomputed.')
+    parser.add_argument('--pool', type=int, default=8, help='Block size of the frame differencing.')
+    parser.add_argument('--tile_batch', type=int, default=4, help='Number of changed tiles run together.')
+    parser.add_argument('--baseline_frames', type=int, default=8, help='Number of frames also run naively for the speedup report (0 disables it).')
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+
+    engine = InferenceEngine(opts.checkpoint_dir, opts.iteration, directions=(opts.direction,))
+    stylize_frames(engine.generator(opts.direction), opts.input, opts.output, opts.tile_size, opts.threshold, opts.pool, opts.tile_batch, opts.baseline_frames)
+    engine.close()
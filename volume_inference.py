@@ -0,0 +1,198 @@
+# Harmonizes whole MRI volumes (pre_img.mat or .npy files) with a trained generator, many patients at a time
+
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from models import CycleGenerator3d
+from inference import load_generator, inference_mode, receptive_field, activation_bytes_per_pixel, tiled_forward
+from volumes import read_volume, to_dhw, intensity_range, normalize, denormalize, stitched_forward
+
+
+"""Volumes to harmonize below input, as (source path, output path) pairs. input may be a single volume, a directory
+   of volumes, or a directory of patient directories each holding a pre_img.mat (the layout preprocess.py reads);
+   the output paths mirror the input layout under output."""
+def find_volumes(input, output, name='pre_img.mat'):
+    if os.path.isfile(input):
+        return [(input, output if os.path.splitext(output)[1] else os.path.join(output, os.path.basename(input)))]
+
+    volumes = []
+    for entry in sorted(os.scandir(input), key=lambda e: e.name):
+        if entry.is_file() and entry.name.endswith(('.mat', '.npy')):
+            volumes.append((entry.path, os.path.join(output, entry.name)))
+        elif entry.is_dir() and os.path.exists(os.path.join(entry.path, name)):
+            volumes.append((os.path.join(entry.path, name), os.path.join(output, entry.name, name)))
+    return volumes
+
+
+"""Number of H x W slices that fit in memory_budget (bytes) in one forward pass (0 if a single slice does not)."""
+def slices_per_batch(G, H, W, memory_budget):
+    return int(memory_budget // (activation_bytes_per_pixel(G) * H * W))
+
+
+"""The three input channels of the slices of D x H x W normalized slices listed in indices: the slice itself
+   replicated (as the generators were trained on single-band PNG slices) or, with neighbors=True, the slices
+   before and after it (2.5D context; clamped at the ends of the volume)."""
+def slice_channels(slices, indices, neighbors=False):
+    if not neighbors:
+        return np.repeat(slices[indices][:, None], 3, axis=1)
+    below = np.maximum(np.asarray(indices) - 1, 0)
+    above = np.minimum(np.asarray(indices) + 1, len(slices) - 1)
+    return np.stack([slices[below], slices[indices], slices[above]], axis=1)
+
+
+"""Harmonizes an H x W x S volume with a 2D generator into out (an array of the same shape, e.g. a memmap).
+   Each slice is scaled from its own min..max to [-1, 1], the range of the training PNG slices (scipy.misc.imsave
+   byte-scaled every slice), and the output is mapped back to that slice's range and rounded to the volume's dtype.
+   Slices are run in batches that fit memory_budget; slices too large for it are run in tiles (see tiled_forward).
+   Only one batch of slices is held in float at a time, so the input can stay memory-mapped.
+"""
+def harmonize_slices(G, volume, out, memory_budget, neighbors=False, tile_batch=4):
+    device = next(G.parameters()).device
+    _, stride = receptive_field(G)
+    volume, out = to_dhw(volume), to_dhw(out)
+    S, H, W = volume.shape
+    batch_size = slices_per_batch(G, H, W, memory_budget)
+
+    for start in range(0, S, max(batch_size, 1)):
+        indices = list(range(start, min(start + max(batch_size, 1), S)))
+        first, last = max(indices[0] - 1, 0), min(indices[-1] + 2, S)
+        window = np.asarray(volume[first:last], dtype=np.float32)
+        ranges = [(window[s].min(), window[s].max()) for s in range(len(window))]
+        window = np.stack([normalize(window[s], *ranges[s]) for s in range(len(window))])
+
+        x = torch.from_numpy(slice_channels(window, [s - first for s in indices], neighbors))
+        if batch_size == 0:
+            result = tiled_forward(G, x[0], memory_budget, tile_batch)[None]
+        else:
+            x = F.pad(x, (0, (-W) % stride, 0, (-H) % stride), mode='reflect').to(device)
+            result = G(x)[:, :, :H, :W].float().cpu()
+
+        for s, slice_out in zip(indices, result.mean(1).numpy()):
+            _store(out, s, denormalize(slice_out, *ranges[s - first]))
+
+
+"""Harmonizes an H x W x S volume with a 3D generator (CycleGenerator3d) into out: the whole volume is scaled
+   from its min..max to [-1, 1] and run in overlapping patches of patch_size (see volumes.stitched_forward)."""
+def harmonize_volume_3d(G, volume, out, patch_size, patch_batch=2):
+    low, high = intensity_range(volume)
+    x = torch.from_numpy(np.ascontiguousarray(normalize(to_dhw(volume), low, high)))[None]
+    result = stitched_forward(G, x, patch_size, patch_batch)[0].numpy()
+    out_dhw = to_dhw(out)
+    for s in range(len(result)):
+        _store(out_dhw, s, denormalize(result[s], low, high))
+
+
+#Writes one harmonized slice into out, rounded and clipped to the range of an integer dtype
+def _store(out, s, values):
+    if np.issubdtype(out.dtype, np.integer):
+        info = np.iinfo(out.dtype)
+        values = np.clip(np.rint(values), info.min, info.max)
+    out[s] = values.astype(out.dtype)
+
+
+"""Harmonizes one volume file into output_path, in the input's format (.mat with the other variables of the file
+   kept, or .npy written through a memmap), with the same array shape and dtype. Returns the number of slices."""
+def harmonize_file(G, input_path, output_path, opts):
+    from scipy.io import loadmat, savemat
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    if input_path.endswith('.npy'):
+        volume = read_volume(input_path)
+        partial = output_path + '.partial.npy'
+        out = np.lib.format.open_memmap(partial, mode='w+', dtype=volume.dtype, shape=volume.shape)
+    else:
+        contents = {k: v for k, v in loadmat(input_path).items() if not k.startswith('__')}
+        volume = contents[opts.key]
+        out = np.empty_like(volume)
+
+    with inference_mode():
+        if isinstance(G, CycleGenerator3d):
+            harmonize_volume_3d(G, volume, out, opts.patch_size, opts.patch_batch)
+        else:
+            harmonize_slices(G, volume, out, opts.memory_budget_mb * 2**20, opts.neighbors, opts.tile_batch)
+
+    if input_path.endswith('.npy'):
+        out.flush()
+        del out
+        os.replace(partial, output_path)
+    else:
+        contents[opts.key] = out
+        savemat(output_path, contents, do_compression=opts.compress)
+
+    return volume.shape[-1]
+
+
+_worker = {}
+
+
+#Runs once in every worker process: loads the generator and limits the torch threads
+def _init_worker(opts):
+    torch.set_num_threads(opts.threads)
+    device = torch.device(opts.device if opts.device else ('cuda' if torch.cuda.is_available() else 'cpu'))
+    _worker['G'] = load_generator(opts.checkpoint_dir, opts.iteration, opts.direction).to(device).eval()
+    _worker['opts'] = opts
+
+
+#Runs in a worker process
+def _harmonize(input_path, output_path):
+    start = time.time()
+    slices = harmonize_file(_worker['G'], input_path, output_path, _worker['opts'])
+    return slices, time.time() - start
+
+
+"""Harmonizes every volume found under opts.input with opts.workers processes (each loading the generator once
+   and using opts.threads torch threads), skipping outputs that already exist unless opts.overwrite is set."""
+def main(opts):
+    volumes = [(src, dst) for src, dst in find_volumes(opts.input, opts.output) if opts.overwrite or not os.path.exists(dst)]
+    print('Harmonizing {} volumes with {} workers'.format(len(volumes), opts.workers))
+
+    start, total = time.time(), 0
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=opts.workers, mp_context=context, initializer=_init_worker, initargs=(opts,)) as pool:
+        futures = [(src, dst, pool.submit(_harmonize, src, dst)) for src, dst in volumes]
+        for src, dst, future in futures:
+            slices, seconds = future.result()
+            total += slices
+            print('{} -> {} ({} slices, {:.1f}s)'.format(src, dst, slices, seconds))
+
+    seconds = time.time() - start
+    print('Harmonized {} volumes ({} slices) in {:.1f}s ({:.1f} slices/s)'.format(len(volumes), total, seconds, total / max(seconds, 1e-9)))
+
+
+"""Creates the command-line parser for volume inference."""
+def create_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input', type=str, required=True, help='A volume, a directory of volumes, or a directory of patient directories with a pre_img.mat each.')
+    parser.add_argument('--output', type=str, required=True, help='Output directory (or file, for a single input volume).')
+    parser.add_argument('--key', type=str, default='dcmat', help='Variable of the .mat files holding the H x W x S volume.')
+    parser.add_argument('--checkpoint_dir', type=str, default='checkpoints_cyclegan')
+    parser.add_argument('--iteration', type=int, default=37000)
+    parser.add_argument('--direction', type=str, default='YtoX', choices=['XtoY', 'YtoX'])
+    parser.add_argument('--device', type=str, default=None, help='Device of every worker (default: cuda if available).')
+
+    parser.add_argument('--memory_budget_mb', type=float, default=1024, help='Activation memory per worker; sets the number of slices per batch.')
+    parser.add_argument('--neighbors', action='store_true', default=False, help='Feed the previous/current/next slices as the three input channels (2.5D).')
+    parser.add_argument('--tile_batch', type=int, default=4, help='Tiles run together for slices larger than the memory budget.')
+    parser.add_argument('--patch_size', type=int, nargs=3, default=[32, 64, 64], help='Patch size of 3D (CycleGenerator3d) checkpoints.')
+    parser.add_argument('--patch_batch', type=int, default=2)
+
+    parser.add_argument('--workers', type=int, default=2, help='Number of patients processed concurrently.')
+    parser.add_argument('--threads', type=int, default=max(torch.get_num_threads() // 2, 1), help='Torch threads per worker.')
+    parser.add_argument('--compress', action='store_true', default=False, help='Compress the written .mat files.')
+    parser.add_argument('--overwrite', action='store_true', default=False)
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    opts = parser.parse_args()
+    main(opts)
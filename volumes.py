@@ -0,0 +1,141 @@
+# Volume I/O, patch sampling and overlapping-patch inference for the 3D models
+
+import itertools
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from inference import receptive_field, _tile_starts, _feather
+
+
+"""Reads an MRI volume stored as H x W x S (slices last): the 'dcmat' array of a pre_img.mat file, or a .npy file,
+   which is memory-mapped so that patches only read the slices they cover."""
+def read_volume(path, key='dcmat'):
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    from scipy.io import loadmat
+    return loadmat(path)[key]
+
+
+"""D x H x W view (slices first) of an H x W x S volume, without copying it."""
+def to_dhw(volume):
+    return np.moveaxis(volume, -1, 0)
+
+
+"""(low, high) intensities of a volume, used to map it to [-1, 1] and back."""
+def intensity_range(volume):
+    return float(volume.min()), float(volume.max())
+
+
+"""Maps intensities from [low, high] to [-1, 1] (float32)."""
+def normalize(array, low, high):
+    return (np.asarray(array, dtype=np.float32) - low) / max(high - low, 1e-8) * 2 - 1
+
+
+"""Maps [-1, 1] back to the [low, high] intensities of the source volume."""
+def denormalize(array, low, high):
+    return (np.asarray(array, dtype=np.float32) + 1) / 2 * (high - low) + low
+
+
+"""Smooth random D x H x W volume in [-1, 1] for CPU tests: trilinearly upsampled low-resolution noise.
+   Domain 'Y' is the same anatomy as domain 'X' for the same seed, with a different contrast (a gamma curve)
+   and a smooth multiplicative bias field, i.e. a toy scanner-harmonization problem."""
+def synthetic_volume(shape, domain='X', seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    coarse = torch.rand(1, 1, *[max(s // 8, 2) for s in shape], generator=generator)
+    volume = F.interpolate(coarse, size=tuple(shape), mode='trilinear', align_corners=False)[0, 0]
+    volume = (volume - volume.min()) / (volume.max() - volume.min())
+
+    if domain == 'Y':
+        bias = F.interpolate(torch.rand(1, 1, 2, 2, 2, generator=generator), size=tuple(shape), mode='trilinear', align_corners=True)[0, 0]
+        volume = volume.pow(0.6) * (0.8 + 0.4 * bias)
+        volume = volume / volume.max()
+
+    return (volume * 2 - 1).numpy()
+
+
+"""Size of a patch along each axis of a D x H x W volume: patch_size, with 0 meaning the whole axis (e.g. (16, 0, 0)
+   for slabs of 16 full slices)."""
+def patch_shape(patch_size, shape):
+    return tuple(p if p > 0 else s for p, s in zip(patch_size, shape))
+
+
+"""Copies a random patch of the given size out of a D x H x W volume (which may be memory-mapped; only the patch is
+   read). Axes shorter than the patch are reflect-padded."""
+def random_patch(volume, size, rng):
+    starts = [rng.randint(0, max(s - p, 0)) for s, p in zip(volume.shape, size)]
+    patch = np.array(volume[tuple(slice(start, start + p) for start, p in zip(starts, size))], dtype=np.float32)
+
+    padding = [(0, p - s) for s, p in zip(patch.shape, size)]
+    if any(after for _, after in padding):
+        patch = np.pad(patch, padding, mode='reflect' if min(patch.shape) > 1 else 'edge')
+    return patch
+
+
+"""Estimate of the activation memory (bytes) a forward pass needs per input voxel (the 3D counterpart of
+   inference.activation_bytes_per_pixel)."""
+def activation_bytes_per_voxel(model, live_maps=4):
+    density, jump = 1.0, 1.0
+    for module in model.modules():
+        if isinstance(module, torch.nn.Conv3d):
+            jump *= module.stride[0]
+            density = max(density, module.out_channels / jump**3)
+        elif isinstance(module, torch.nn.ConvTranspose3d):
+            jump /= module.stride[0]
+            density = max(density, module.out_channels / jump**3)
+    return 4.0 * live_maps * density
+
+
+"""Overlapping patches of at most patch_size covering a (stride-padded) volume of the given shape, each extending
+   margin voxels beyond the part it contributes. Returns (size, [start, ...]) with the patch size and corners."""
+def patch_layout(shape, patch_size, margin, stride):
+    size = tuple(min(max(p // stride * stride, stride), s) for p, s in zip(patch_size, shape))
+    steps = [max((p - 2 * margin) // stride * stride, stride) for p in size]
+    starts = [_tile_starts(s, p, step) for s, p, step in zip(shape, size, steps)]
+    return size, list(itertools.product(*starts))
+
+
+"""Feathered 1 x d x h x w blending weights of the patch at start in a volume of the given shape."""
+def patch_weight(start, size, shape, margin):
+    w = [_feather(p, margin, a > 0, a + p < s) for a, p, s in zip(start, size, shape)]
+    return (w[0][:, None, None] * w[1][None, :, None] * w[2][None, None, :])[None]
+
+
+"""Runs a fully convolutional 3D model on one C x D x H x W volume in overlapping patches of at most patch_size
+   (voxels along D, H, W; 0 takes the whole axis, see patch_shape), patch_batch at a time, and blends them with feathered weights (as inference.tiled_forward
+   does for images). Activation memory is bounded by the patch size; only the output accumulator scales with the
+   volume. The overlap is the model's receptive-field margin, capped at a quarter of the smallest patch side (the
+   full 3D receptive field of a generator is far wider than its effective one, and would leave almost no stride
+   between patches); pass margin to override it.
+"""
+def stitched_forward(model, x, patch_size, patch_batch=2, margin=None):
+    device = next(model.parameters()).device
+    patch_size = patch_shape(patch_size, x.shape[1:])
+    full_margin, stride = receptive_field(model)
+    if margin is None:
+        margin = min(full_margin, min(patch_size) // 4)
+
+    #1. Pad to a multiple of the model stride so that the output has the size of the input
+    _, D, H, W = x.shape
+    x = F.pad(x[None], (0, (-W) % stride, 0, (-H) % stride, 0, (-D) % stride), mode='replicate')[0]
+    shape = tuple(x.shape[1:])
+
+    size, starts = patch_layout(shape, patch_size, margin, stride)
+    out, weight = None, torch.zeros(1, *shape)
+
+    #2. Run the patches in batches and blend them into the output
+    for first in range(0, len(starts), patch_batch):
+        chunk = starts[first:first + patch_batch]
+        batch = torch.stack([x[:, a:a + size[0], b:b + size[1], c:c + size[2]] for a, b, c in chunk]).to(device)
+        result = model(batch).float().cpu()
+
+        if out is None:
+            out = torch.zeros(result.size(1), *shape)
+
+        for patch_out, (a, b, c) in zip(result, chunk):
+            w = patch_weight((a, b, c), size, shape, margin)
+            out[:, a:a + size[0], b:b + size[1], c:c + size[2]] += patch_out * w
+            weight[:, a:a + size[0], b:b + size[1], c:c + size[2]] += w
+
+    return (out / weight)[:, :D, :H, :W]
@@ -12,16 +12,15 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 
-# Numpy & Scipy imports
+# Numpy imports (scipy.misc is only imported when samples are saved)
 import numpy as np
-import scipy
-import scipy.misc
 
 # Local imports
 import utils
-from data_loader import get_data_loader2d
-from models import XNetEncoder2d, XNetDecoder2d, XNetTranslator2d, PatchGANDiscriminator2d
-from torchvision import transforms
+from data_loader import get_data_loader
+from models import XNetEncoder, XNetDecoder, XNetTranslator, PatchGANDiscriminator, DualGenerator
+from profiling import WindowedProfiler, add_profiler_args
+from preemption import PreemptionHandler, add_preemption_args, resume_path, set_rng_state, save_resume_state, load_resume_state, training_state, restore_training_state
 
 SEED = 14
 
@@ -34,17 +33,17 @@ if torch.cuda.is_available():
 
 """Builds the generators and discriminators using the CycleGenerator."""
 def create_model(opts):
-    E_XtoY = XNetEncoder2d(init_zero_weights=opts.init_zero_weights)
-    E_YtoX = XNetEncoder2d(init_zero_weights=opts.init_zero_weights)
+    E_XtoY = XNetEncoder(init_zero_weights=opts.init_zero_weights, conv_dim=opts.g_conv_dim, n_res_blocks=opts.g_res_blocks, n_downsampling=opts.g_downsampling)
+    E_YtoX = XNetEncoder(init_zero_weights=opts.init_zero_weights, conv_dim=opts.g_conv_dim, n_res_blocks=opts.g_res_blocks, n_downsampling=opts.g_downsampling)
 
-    D_X = XNetDecoder2d(init_zero_weights=opts.init_zero_weights)
-    D_Y = XNetDecoder2d(init_zero_weights=opts.init_zero_weights)
+    D_X = XNetDecoder(init_zero_weights=opts.init_zero_weights, conv_dim=opts.g_conv_dim, n_downsampling=opts.g_downsampling)
+    D_Y = XNetDecoder(init_zero_weights=opts.init_zero_weights, conv_dim=opts.g_conv_dim, n_downsampling=opts.g_downsampling)
 
-    T_XtoY = XNetTranslator2d(init_zero_weights=opts.init_zero_weights)
-    T_YtoX = XNetTranslator2d(init_zero_weights=opts.init_zero_weights)
+    T_XtoY = XNetTranslator(init_zero_weights=opts.init_zero_weights, conv_dim=opts.g_conv_dim, n_res_blocks=opts.g_res_blocks, n_downsampling=opts.g_downsampling)
+    T_YtoX = XNetTranslator(init_zero_weights=opts.init_zero_weights, conv_dim=opts.g_conv_dim, n_res_blocks=opts.g_res_blocks, n_downsampling=opts.g_downsampling)
 
-    Q_X = PatchGANDiscriminator2d()
-    Q_Y = PatchGANDiscriminator2d()
+    Q_X = PatchGANDiscriminator(conv_dim=opts.d_conv_dim, n_layers=opts.d_layers)
+    Q_Y = PatchGANDiscriminator(conv_dim=opts.d_conv_dim, n_layers=opts.d_layers)
 
     if torch.cuda.is_available():
         E_XtoY.cuda()
@@ -63,8 +62,8 @@ def create_model(opts):
     return E_XtoY, E_YtoX, D_X, D_Y, T_XtoY, T_YtoX, Q_X, Q_Y
 
 
-"""Saves the parameters of both generators G_YtoX, G_XtoY and discriminators D_X, D_Y."""
-def checkpoint(iteration, E_XtoY, E_YtoX, D_X, D_Y, T_XtoY, T_YtoX, Q_X, Q_Y, opts):
+"""Saves the parameters of all encoders, decoders, translators and discriminators as well as the optimizers."""
+def checkpoint(iteration, E_XtoY, E_YtoX, D_X, D_Y, T_XtoY, T_YtoX, Q_X, Q_Y, e_optimizer, d_optimizer, t_optimizer, q_optimizer, opts):
     E_XtoY_path = os.path.join(opts.checkpoint_dir, 'E_XtoY_' +  str(iteration) + '_.pkl')
     E_YtoX_path = os.path.join(opts.checkpoint_dir, 'E_YtoX_' + str(iteration) + '_.pkl')
     D_X_path = os.path.join(opts.checkpoint_dir, 'D_X_' + str(iteration) + '_.pkl')
@@ -74,6 +73,11 @@ def checkpoint(iteration, E_XtoY, E_YtoX, D_X, D_Y, T_XtoY, T_YtoX, Q_X, Q_Y, op
     Q_X_path = os.path.join(opts.checkpoint_dir, 'Q_X_' + str(iteration) + '_.pkl')
     Q_Y_path = os.path.join(opts.checkpoint_dir, 'Q_Y_' + str(iteration) + '_.pkl')
 
+    e_optimizer_path = os.path.join(opts.checkpoint_dir, 'e_optimizer_' + str(iteration) + '_.pkl')
+    d_optimizer_path = os.path.join(opts.checkpoint_dir, 'd_optimizer_' + str(iteration) + '_.pkl')
+    t_optimizer_path = os.path.join(opts.checkpoint_dir, 't_optimizer_' + str(iteration) + '_.pkl')
+    q_optimizer_path = os.path.join(opts.checkpoint_dir, 'q_optimizer_' + str(iteration) + '_.pkl')
+
     torch.save(E_XtoY.state_dict(), E_XtoY_path)
     torch.save(E_YtoX.state_dict(), E_YtoX_path)
     torch.save(D_X.state_dict(), D_X_path)
@@ -83,6 +87,11 @@ def checkpoint(iteration, E_XtoY, E_YtoX, D_X, D_Y, T_XtoY, T_YtoX, Q_X, Q_Y, op
     torch.save(Q_X.state_dict(), Q_X_path)
     torch.save(Q_Y.state_dict(), Q_Y_path)
 
+    torch.save(e_optimizer.state_dict(), e_optimizer_path)
+    torch.save(d_optimizer.state_dict(), d_optimizer_path)
+    torch.save(t_optimizer.state_dict(), t_optimizer_path)
+    torch.save(q_optimizer.state_dict(), q_optimizer_path)
+
 
 """Creates a grid for sampling GAN results. Consist of pairs of columns,
    where the first column in each pair contains images source images and
@@ -106,6 +115,8 @@ def merge_images(sources, targets, opts, k=10):
 
 """Saves samples from both generators X->Y and Y->X."""
 def save_samples(iteration, fixed_Y, fixed_X, E_XtoY, E_YtoX, D_X, D_Y, T_XtoY, T_YtoX, opts):
+    import scipy.misc
+
     fake_X = D_X(E_YtoX(fixed_Y))
     fake_Y = D_Y(E_XtoY(fixed_X))
 
@@ -137,6 +148,45 @@ def save_samples(iteration, fixed_Y, fixed_X, E_XtoY, E_YtoX, D_X, D_Y, T_XtoY,
     print('Saved {}'.format(path))
 
 
+"""Generator-phase losses of one training step: (L_gan, L_zid, L_id, L_ctc, L_zcyc, fake_X, fake_Y).
+   E_pair, T_pair and D_pair run the XtoY/YtoX encoders and translators and the X/Y decoders (see DualGenerator);
+   each network call is evaluated once per step and reused by every loss term.
+"""
+def generator_losses(images_X, images_Y, E_pair, T_pair, D_pair, Q_X, Q_Y):
+    #Shared encodings
+    z_XtoY_X, z_YtoX_Y = E_pair(images_X, images_Y)
+    z_XtoY_Y, z_YtoX_X = E_pair(images_Y, images_X)
+
+    #Shared translations
+    t_XtoY_z_YtoX_Y, t_YtoX_z_XtoY_X = T_pair(z_YtoX_Y, z_XtoY_X)
+    t_XtoY_z_YtoX_X, t_YtoX_z_XtoY_Y = T_pair(z_YtoX_X, z_XtoY_Y)
+    t_XtoY_z_XtoY_Y, t_YtoX_z_YtoX_X = T_pair(z_XtoY_Y, z_YtoX_X)
+    cyc_z_YtoX_X, cyc_z_XtoY_Y = T_pair(t_YtoX_z_YtoX_X, t_XtoY_z_XtoY_Y)
+
+    #Shared decodings
+    fake_X, fake_Y = D_pair(z_YtoX_Y, z_XtoY_X)
+    rec_X, rec_Y = D_pair(t_YtoX_z_XtoY_X, t_XtoY_z_YtoX_Y)
+    id_X, id_Y = D_pair(z_YtoX_X, z_XtoY_Y)
+
+    #GAN Loss
+    #L_gan = Q_X_loss + Q_Y_loss
+    L_gan = torch.mean((Q_X(fake_X) - 1)**2) + torch.mean((Q_Y(fake_Y) - 1)**2)
+
+    #Cross ID Loss
+    L_zid = torch.mean(torch.abs((rec_X - images_X))) + torch.mean(torch.abs((rec_Y - images_Y)))
+
+    #ID loss
+    L_id = torch.mean(torch.abs(id_X - images_X)) + torch.mean(torch.abs(id_Y - images_Y))
+
+    #Cross-Translation Consistency Loss
+    L_ctc = torch.mean(torch.abs(t_XtoY_z_YtoX_X - z_XtoY_X)) + torch.mean(torch.abs(t_YtoX_z_XtoY_Y - z_YtoX_Y))
+
+    #Latent Cycle-Consistency Loss
+    L_zcyc = torch.mean(torch.abs(cyc_z_YtoX_X - z_YtoX_X)) + torch.mean(torch.abs(cyc_z_XtoY_Y - z_XtoY_Y))
+
+    return L_gan, L_zid, L_id, L_ctc, L_zcyc, fake_X, fake_Y
+
+
 """Runs the training loop.
         1. Saves checkpoint every opts.checkpoint_every iterations
         2. Saves generated samples every opts.sample_every iterations
@@ -166,43 +216,60 @@ def training_loop(dataloader_X, dataloader_Y, test_dataloader_X, test_dataloader
 
     # Set fixed data from domains X and Y for sampling. They areheld
     # constant throughout training, that allow us to inspect the model's performance.
-    fixed_X = utils.to_var(test_iter_X.next()[0])
-    fixed_Y = utils.to_var(test_iter_Y.next()[0])
+    fixed_X = utils.to_var(next(test_iter_X)[0])
+    fixed_Y = utils.to_var(next(test_iter_Y)[0])
 
     iter_per_epoch = min(len(iter_X), len(iter_Y))
 
-    for iteration in range(1, opts.train_iters+1):
+    # run each X/Y pair of networks together (as one vectorized call when --fused_generators is set)
+    E_pair = DualGenerator(E_XtoY, E_YtoX, fused=opts.fused_generators)
+    T_pair = DualGenerator(T_XtoY, T_YtoX, fused=opts.fused_generators)
+    D_pair = DualGenerator(D_X, D_Y, fused=opts.fused_generators)
+
+    # profiler (only hooks into the models inside the --profile_start/--profile_steps window)
+    profiler = WindowedProfiler(opts, {'E_XtoY': E_XtoY, 'E_YtoX': E_YtoX, 'D_X': D_X, 'D_Y': D_Y,
+                                       'T_XtoY': T_XtoY, 'T_YtoX': T_YtoX, 'Q_X': Q_X, 'Q_Y': Q_Y})
+
+    # everything restored on resume (consumed counts the samples used from the current epoch of each loader)
+    models = {'E_XtoY': E_XtoY, 'E_YtoX': E_YtoX, 'D_X': D_X, 'D_Y': D_Y, 'T_XtoY': T_XtoY, 'T_YtoX': T_YtoX, 'Q_X': Q_X, 'Q_Y': Q_Y}
+    optimizers = {'e_optimizer': e_optimizer, 'd_optimizer': d_optimizer, 't_optimizer': t_optimizer, 'q_optimizer': q_optimizer}
+    loaders = {'X': dataloader_X, 'Y': dataloader_Y}
+    consumed = {'X': 0, 'Y': 0}
+    start_iteration = 1
+
+    state = load_resume_state(resume_path(opts)) if opts.resume else None
+    if state is not None:
+        start_iteration, consumed = restore_training_state(state, models, optimizers, {}, loaders)
+        iter_X = iter(dataloader_X)
+        iter_Y = iter(dataloader_Y)
+        set_rng_state(state['rng'])
+        print('Resumed after iteration {}'.format(start_iteration - 1))
+
+    # flushes an emergency checkpoint when the job receives SIGTERM/SIGINT/SIGUSR1
+    preemption = PreemptionHandler(opts.preempt_budget).install()
+
+    for iteration in range(start_iteration, opts.train_iters+1):
+        profiler.step_begin(iteration)
+
         # Reset data_iter for each epoch
         if iteration % iter_per_epoch == 0:
             iter_X = iter(dataloader_X)
             iter_Y = iter(dataloader_Y)
+            consumed = {'X': 0, 'Y': 0}
 
-        images_X, labels_X = iter_X.next()
+        images_X, labels_X = next(iter_X)
         images_X, labels_X = utils.to_var(images_X), utils.to_var(labels_X).long().squeeze()
+        consumed['X'] += images_X.size(0)
 
-        images_Y, labels_Y = iter_Y.next()
+        images_Y, labels_Y = next(iter_Y)
         images_Y, labels_Y = utils.to_var(images_Y), utils.to_var(labels_Y).long().squeeze()
+        consumed['Y'] += images_Y.size(0)
 
         e_optimizer.zero_grad()
         d_optimizer.zero_grad()
         t_optimizer.zero_grad()
 
-        #GAN Loss
-        #L_gan = Q_X_loss + Q_Y_loss
-        L_gan = torch.mean((Q_X(D_X(E_YtoX(images_Y))) - 1)**2) + torch.mean((Q_Y(D_Y(E_XtoY(images_X))) - 1)**2))
-
-        #Cross ID Loss
-        L_zid = torch.mean(torch.abs((D_X(T_YtoX(E_XtoY(images_X))) - images_X))) + torch.mean(torch.abs((D_Y(T_XtoY(E_YtoX(images_Y))) - images_Y)))
-
-        #ID loss
-        L_id = torch.mean(torch.abs(D_X(E_YtoX(images_X)) - images_X)) + torch.mean(torch.abs(D_Y(E_XtoY(images_Y)) - images_Y))
-
-        #Cross-Translation Consistency Loss
-        L_ctc = torch.mean(torch.abs(T_XtoY(E_YtoX(images_X)) - E_XtoY(images_X))) + torch.mean(torch.abs(T_YtoX(E_XtoY(images_Y)) - E_YtoX(images_Y)))
-
-        #Latent Cycle-Consistency Loss
-        L_zcyc = torch.mean(torch.abs(T_XtoY(T_YtoX(E_YtoX(images_X))) - E_YtoX(images_X))) + torch.mean(torch.abs(T_YtoX(T_XtoY(E_XtoY(images_Y))) - E_XtoY(images_Y)))
-
+        L_gan, L_zid, L_id, L_ctc, L_zcyc, fake_X, fake_Y = generator_losses(images_X, images_Y, E_pair, T_pair, D_pair, Q_X, Q_Y)
 
         #Loss term lambdas
         lambda_gan = 1
@@ -228,13 +295,13 @@ def training_loop(dataloader_X, dataloader_Y, test_dataloader_X, test_dataloader
         #Zero out discriminator optimizer
         q_optimizer.zero_grad()
 
-        #Compute discriminator losses
+        #Compute discriminator losses (the fakes from the generator phase are reused, detached from E/D)
         Q_X_real_loss = torch.mean((Q_X(images_X)-1)**2)
-        Q_X_fake_loss = torch.mean((Q_X(D_X(E_YtoX(images_Y))))**2)
+        Q_X_fake_loss = torch.mean((Q_X(fake_X.detach()))**2)
         Q_X_loss = (Q_X_real_loss + Q_X_fake_loss) * .5
 
         Q_Y_real_loss = torch.mean((Q_Y(images_Y)-1)**2)
-        Q_Y_fake_loss = torch.mean((Q_Y(D_Y(E_XtoY(images_X))))**2)
+        Q_Y_fake_loss = torch.mean((Q_Y(fake_Y.detach()))**2)
         Q_Y_loss = (Q_Y_real_loss + Q_Y_fake_loss) * .5
 
         #compute gradients and update weights
@@ -254,13 +321,25 @@ def training_loop(dataloader_X, dataloader_Y, test_dataloader_X, test_dataloader
 
         # Save the model parameters
         if iteration % opts.checkpoint_every == 0:
-            checkpoint(iteration, E_XtoY, E_YtoX, D_X, D_Y, T_XtoY, T_YtoX, Q_X, Q_Y, opts)
+            checkpoint(iteration, E_XtoY, E_YtoX, D_X, D_Y, T_XtoY, T_YtoX, Q_X, Q_Y, e_optimizer, d_optimizer, t_optimizer, q_optimizer, opts)
+
+        # Save the resume state (and stop if the job is being preempted)
+        if iteration % opts.checkpoint_every == 0 or preemption.requested:
+            save_resume_state(training_state(iteration, models, optimizers, {}, loaders, consumed), resume_path(opts))
+
+        profiler.step_end(iteration)
+
+        if preemption.requested:
+            profiler.close()
+            preemption.exit()
+
+    profiler.close()
 
 """Loads the data, creates checkpoint and sample directories, and starts the training loop."""
 def main(opts):
     # Create train and test dataloaders for images from the two domains X and Y
-    dataloader_X, test_dataloader_X = get_data_loader2d(img_type=opts.X, opts=opts)
-    dataloader_Y, test_dataloader_Y = get_data_loader2d(img_type=opts.Y, opts=opts)
+    dataloader_X, test_dataloader_X = get_data_loader(opts=opts, image_type=opts.X)
+    dataloader_Y, test_dataloader_Y = get_data_loader(opts=opts, image_type=opts.Y)
 
     # Create checkpoint and sample directories
     utils.create_dir(opts.checkpoint_dir)
@@ -286,10 +365,14 @@ def create_parser():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--image_size', type=int, default=256, help='The side length N to convert images to NxN.')
-    parser.add_argument('--g_conv_dim', type=int, default=256)
-    parser.add_argument('--d_conv_dim', type=int, default=256)
+    parser.add_argument('--g_conv_dim', type=int, default=64, help='Width of the first encoder layer (doubled by each downsampling).')
+    parser.add_argument('--g_res_blocks', type=int, default=9, help='Number of ResNet blocks of the encoders and translators.')
+    parser.add_argument('--g_downsampling', type=int, default=2, help='Number of down/up-sampling stages of the encoders and decoders.')
+    parser.add_argument('--d_conv_dim', type=int, default=64, help='Width of the first discriminator layer (doubled by each strided layer).')
+    parser.add_argument('--d_layers', type=int, default=3, help='Number of strided instance-normalized discriminator layers.')
     parser.add_argument('--use_cycle_consistency_loss', action='store_true', default=True, help='Choose whether to include the cycle consistency term in the loss.')
     parser.add_argument('--init_zero_weights', action='store_true', default=False, help='Choose whether to initialize the generator conv weights to 0 (implements the identity function).')
+    parser.add_argument('--fused_generators', action='store_true', default=False, help='Run the X and Y encoders/translators/decoders in one vectorized call; measure with benchmark_fused.py, it is slower on CPU (checkpoints are unchanged).')
 
     # Training hyper-parameters
     parser.add_argument('--train_iters', type=int, default=200000, help='The number of training iterations to run (you can Ctrl-C out earlier if you want).')
@@ -300,9 +383,10 @@ def create_parser():
     parser.add_argument('--beta2', type=float, default=0.999)
     parser.add_argument('--cycle_consistency_lambda', type=float, default=10.0)
 
-    # Data sources
-    parser.add_argument('--X', type=str, default='A', choices=['A', 'B'], help='Choose the type of images for domain X.')
-    parser.add_argument('--Y', type=str, default='B', choices=['A', 'B'], help='Choose the type of images for domain Y.')
+    # Data sources (<data_dir>/Train_<X|Y> and Test_<X|Y>, as for cycle_gan.py)
+    parser.add_argument('--data_dir', type=str, default=os.path.join('/home', 'adithya', 'Breast_Style_Transfer','Datasets', 'horse2zebra'))
+    parser.add_argument('--X', type=str, default='A', help='Choose the type of images for domain X.')
+    parser.add_argument('--Y', type=str, default='B', help='Choose the type of images for domain Y.')
 
     # Saving directories and checkpoint/sample iterations
     parser.add_argument('--checkpoint_dir', type=str, default='checkpoints_xnet')
@@ -312,6 +396,12 @@ def create_parser():
     parser.add_argument('--sample_every', type=int , default=500)
     parser.add_argument('--checkpoint_every', type=int , default=1000)
 
+    # Preemption and resume
+    add_preemption_args(parser)
+
+    # Profiling
+    add_profiler_args(parser)
+
     return parser
 
 